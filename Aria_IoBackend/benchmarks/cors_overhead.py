@@ -0,0 +1,158 @@
+"""
+Per-request overhead of the CORS layer, before and after utils/cors.py.
+
+"before" rebuilds the old stack: a BaseHTTPMiddleware that stamps CORS
+headers on every response, Starlette's CORSMiddleware, and an explicit
+OPTIONS route answered by the old cors_options_response helper. "after"
+is the single pure ASGI middleware. Both wrap the same trivial app and are
+driven in-process, so the numbers are the middleware cost alone.
+
+Usage:
+    python benchmarks/cors_overhead.py [--requests 20000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware as StarletteCORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.cors import CORSMiddleware
+
+
+class CORSHeaderMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        response.headers["Access-Control-Allow-Credentials"] = "true"
+        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
+        response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+        return response
+
+
+async def endpoint(request):
+    return JSONResponse({"status": True})
+
+
+async def options_endpoint(request):
+    return PlainTextResponse(
+        content="",
+        status_code=200,
+        headers={
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "POST, OPTIONS",
+            "Access-Control-Allow-Headers": "Content-Type, Authorization",
+            "Access-Control-Allow-Credentials": "true",
+            "Access-Control-Max-Age": "86400",
+        },
+    )
+
+
+def before_app():
+    return Starlette(
+        routes=[
+            Route("/login", endpoint, methods=["POST"]),
+            Route("/login", options_endpoint, methods=["OPTIONS"]),
+        ],
+        middleware=[
+            Middleware(
+                StarletteCORSMiddleware,
+                allow_origins=["*"], allow_credentials=True,
+                allow_methods=["*"], allow_headers=["*"], expose_headers=["*"],
+            ),
+            Middleware(CORSHeaderMiddleware),
+        ],
+    )
+
+
+def after_app():
+    return Starlette(
+        routes=[Route("/login", endpoint, methods=["POST"])],
+        middleware=[
+            Middleware(
+                CORSMiddleware,
+                allow_origins=["*"], allow_credentials=True,
+                allow_headers=["*"], expose_headers=["*"],
+            ),
+        ],
+    )
+
+
+def make_scope(method, headers):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": "/login",
+        "raw_path": b"/login",
+        "root_path": "",
+        "query_string": b"",
+        "headers": headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+    }
+
+
+SIMPLE = make_scope("POST", [
+    (b"host", b"localhost"),
+    (b"origin", b"http://localhost:3000"),
+    (b"content-type", b"application/json"),
+    (b"authorization", b"Bearer token"),
+])
+PREFLIGHT = make_scope("OPTIONS", [
+    (b"host", b"localhost"),
+    (b"origin", b"http://localhost:3000"),
+    (b"access-control-request-method", b"POST"),
+    (b"access-control-request-headers", b"content-type, authorization"),
+])
+
+
+async def call(app, scope):
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(dict(scope), receive, send)
+    return status
+
+
+async def measure(app, scope, requests):
+    assert await call(app, scope) == 200
+    started = time.perf_counter()
+    for _ in range(requests):
+        await call(app, scope)
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+async def main(requests):
+    apps = {"before": before_app(), "after": after_app()}
+    # Run each app once so lazily built middleware stacks are in place
+    for app in apps.values():
+        await call(app, SIMPLE)
+    print(f"{'request':<10} {'before us':>10} {'after us':>10} {'speedup':>8}")
+    for label, scope in (("simple", SIMPLE), ("preflight", PREFLIGHT)):
+        before = await measure(apps["before"], scope, requests)
+        after = await measure(apps["after"], scope, requests)
+        print(f"{label:<10} {before:>10.1f} {after:>10.1f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
@@ -0,0 +1,300 @@
+"""
+Load test for the auth, OTP and authenticated endpoints.
+
+Boots the app under uvicorn with the in-memory datastore
+(ARIA_DATASTORE=memory) and a local SMTP sink, then runs many concurrent
+virtual users. Each one goes through signup OTP -> verify -> signup ->
+login -> login OTP -> login_with_otp and then makes a number of
+authenticated calls. The report shows throughput and p50/p95/p99 latency
+per endpoint.
+
+Usage:
+    python benchmarks/load_test.py --users 200 --concurrency 50
+    python benchmarks/load_test.py --save-baseline benchmarks/baseline.json
+    python benchmarks/load_test.py --baseline benchmarks/baseline.json --tolerance 0.2
+    python benchmarks/load_test.py --server-profile single --save-baseline /tmp/single.json
+    python benchmarks/load_test.py --server-profile multi --baseline /tmp/single.json
+
+--url targets a server that is already running instead. It must use the
+memory datastore, since OTPs are read from the debug_otp response field.
+With --baseline, the exit status is 1 when any endpoint's p95 got slower,
+or its throughput fell, by more than the tolerance.
+
+--server-profile boots the production setup instead (gunicorn with the
+given ARIA_SERVER_PROFILE, see gunicorn.conf.py). Every virtual user then
+keeps its requests on one connection, so its whole flow stays on one
+worker even though the memory datastore is per worker; that is what lets
+the multi profile start with it (ARIA_ALLOW_WORKER_LOCAL_STATE).
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from smtp_sink import SMTPSink
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "Bench-Passw0rd!"
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+
+    async def call(self, client, name, method, url, expect=(200,), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        self.samples.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+        if response.status_code not in expect:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        return response.json() if response.headers.get("content-type", "").startswith("application/json") else {}
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for name, samples in self.samples.items():
+            samples = sorted(samples)
+            endpoints[name] = {
+                "count": len(samples),
+                "errors": self.errors.get(name, 0),
+                "rps": round(len(samples) / elapsed, 1),
+                "p50": round(percentile(samples, 0.50), 2),
+                "p95": round(percentile(samples, 0.95), 2),
+                "p99": round(percentile(samples, 0.99), 2),
+            }
+        total = sum(len(samples) for samples in self.samples.values())
+        return {
+            "elapsed": round(elapsed, 2),
+            "requests": total,
+            "rps": round(total / elapsed, 1),
+            "errors": sum(self.errors.values()),
+            "endpoints": endpoints,
+        }
+
+
+async def user_flow(client, recorder, email, authenticated_calls):
+    body = await recorder.call(client, "request_signup_otp", "POST", "/request_signup_otp", json={"email": email})
+    if body is None:
+        return
+    await recorder.call(client, "verify_signup_otp", "POST", "/verify_signup_otp",
+                        json={"email": email, "otp": body["debug_otp"]})
+    if await recorder.call(client, "signup", "POST", "/signup", expect=(201,),
+                           json={"email": email, "password": PASSWORD, "username": "bench_user"}) is None:
+        return
+    body = await recorder.call(client, "login", "POST", "/login", json={"email": email, "password": PASSWORD})
+    if body is None:
+        return
+    headers = {"Authorization": f"Bearer {body['access_token']}"}
+
+    body = await recorder.call(client, "request_login_otp", "POST", "/request_login_otp", json={"email": email})
+    if body is not None:
+        await recorder.call(client, "login_with_otp", "POST", "/login_with_otp",
+                            json={"email": email, "otp": body["debug_otp"]})
+
+    await recorder.call(client, "add_domain", "POST", "/add_domain", headers=headers,
+                        json={"email": email, "domain": f"{email.split('@')[0]}.example.com"})
+    for _ in range(authenticated_calls):
+        await recorder.call(client, "search", "POST", "/search", headers=headers,
+                            json={"queries": ["leave policy"], "k": 5, "mode": "lexical"})
+        await recorder.call(client, "get_filterwords", "POST", "/get_filterwords", json={"email": email})
+
+
+async def run_load(url, users, concurrency, authenticated_calls, pin_connections=False):
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:8]
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def one_user(number):
+            email = f"bench-{run_id}-{number}@example.com"
+            async with semaphore:
+                if not pin_connections:
+                    await user_flow(client, recorder, email, authenticated_calls)
+                    return
+                # One keep-alive connection per user keeps it on one worker
+                pinned = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+                async with httpx.AsyncClient(base_url=url, limits=pinned, timeout=60) as user_client:
+                    await user_flow(user_client, recorder, email, authenticated_calls)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one_user(number) for number in range(users)))
+        elapsed = time.perf_counter() - started
+    return recorder.summary(elapsed)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, smtp_port, data_dir, latency_ms, extra_args, profile=None):
+    env = dict(os.environ)
+    env.update(
+        ARIA_DATASTORE="memory",
+        ARIA_MEMORY_LATENCY_MS=str(latency_ms),
+        ARIA_DATA_DIR=data_dir,
+        ARIA_UPLOAD_DIR=os.path.join(data_dir, "uploads"),
+        WRITE_BEHIND_SPOOL=os.path.join(data_dir, "write_behind_spool.jsonl"),
+        SMTP_HOST="127.0.0.1",
+        SMTP_PORT=str(smtp_port),
+        SMTP_STARTTLS="false",
+        # Every virtual user shares one client IP
+        RATE_LIMIT_ENABLED="false",
+        EMBEDDING_BACKEND="hashing",
+        LOG_LEVEL=env.get("LOG_LEVEL", "WARNING"),
+    )
+    # The app refuses to start without these; their values don't matter here
+    for name in ("SECRET_KEY", "DB_URL", "STORAGE_BUCKET", "MAIL_USER", "MAIL_PASS"):
+        env.setdefault(name, f"bench-{name.lower()}")
+    if profile:
+        env.update(ARIA_SERVER_PROFILE=profile, ARIA_BIND=f"127.0.0.1:{port}",
+                   ARIA_ALLOW_WORKER_LOCAL_STATE="true")
+        command = [sys.executable, "-m", "gunicorn", "main:app", "--log-level", "warning", *extra_args]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                   "--port", str(port), "--no-access-log", "--log-level", "warning", *extra_args]
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+
+async def wait_until_up(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"Server exited with status {process.returncode}")
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not become healthy in time")
+
+
+def compare(result, baseline, tolerance):
+    """Print per-endpoint deltas against a baseline; return the regressed endpoints."""
+    regressions = []
+    print(f"\n{'endpoint':<20} {'p95 base':>9} {'p95 now':>9} {'delta':>8} {'rps base':>9} {'rps now':>9} {'delta':>8}")
+    for name, now in sorted(result["endpoints"].items()):
+        base = baseline["endpoints"].get(name)
+        if base is None:
+            print(f"{name:<20} {'-':>9} {now['p95']:>9.2f} {'new':>8}")
+            continue
+        p95_delta = (now["p95"] - base["p95"]) / base["p95"] if base["p95"] else 0.0
+        rps_delta = (now["rps"] - base["rps"]) / base["rps"] if base["rps"] else 0.0
+        flag = ""
+        if p95_delta > tolerance or rps_delta < -tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<20} {base['p95']:>9.2f} {now['p95']:>9.2f} {p95_delta:>+8.1%} "
+              f"{base['rps']:>9.1f} {now['rps']:>9.1f} {rps_delta:>+8.1%}{flag}")
+    return regressions
+
+
+def print_report(result):
+    print(f"{'endpoint':<20} {'count':>7} {'errors':>7} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in sorted(result["endpoints"].items()):
+        print(f"{name:<20} {stats['count']:>7} {stats['errors']:>7} {stats['rps']:>8.1f} "
+              f"{stats['p50']:>9.2f} {stats['p95']:>9.2f} {stats['p99']:>9.2f}")
+    print(f"\n{result['requests']} requests in {result['elapsed']}s: "
+          f"{result['rps']} req/s, {result['errors']} errors")
+
+
+async def main(args):
+    process = None
+    sink = None
+    url = args.url
+    with tempfile.TemporaryDirectory(prefix="aria-bench-") as data_dir:
+        try:
+            if url is None:
+                sink = await SMTPSink().start()
+                port = free_port()
+                process = start_server(port, sink.port, data_dir, args.datastore_latency_ms, args.server_arg,
+                                       profile=args.server_profile)
+                url = f"http://127.0.0.1:{port}"
+            await wait_until_up(url, process)
+            pin = args.server_profile is not None
+            if args.warmup:
+                await run_load(url, args.warmup, args.concurrency, 1, pin)
+            result = await run_load(url, args.users, args.concurrency, args.authenticated_calls, pin)
+            if sink is not None:
+                result["emails_received"] = sink.messages
+        finally:
+            if process is not None:
+                process.terminate()
+                # Wait off the event loop: the SMTP sink has to keep answering
+                # while the server's shutdown delivers and closes its mail
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, process.wait, 60)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            if sink is not None:
+                await sink.stop()
+
+    result["config"] = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "authenticated_calls": args.authenticated_calls,
+        "datastore_latency_ms": args.datastore_latency_ms,
+        "server_profile": args.server_profile,
+    }
+    print_report(result)
+    if sink is not None:
+        print(f"SMTP sink received {result['emails_received']} emails")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the auth/OTP endpoints")
+    parser.add_argument("--users", type=int, default=100, help="Virtual users, each running the full flow")
+    parser.add_argument("--concurrency", type=int, default=25, help="Users running at the same time")
+    parser.add_argument("--authenticated-calls", type=int, default=5,
+                        help="Authenticated request pairs per user after login")
+    parser.add_argument("--warmup", type=int, default=10, help="Users run before measuring")
+    parser.add_argument("--datastore-latency-ms", type=float, default=0,
+                        help="Simulated round-trip time of every datastore call")
+    parser.add_argument("--url", help="Benchmark an already running server instead of booting one")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument for the uvicorn or gunicorn command line (repeatable)")
+    parser.add_argument("--server-profile", choices=("single", "multi"),
+                        help="Boot gunicorn with this ARIA_SERVER_PROFILE instead of plain uvicorn")
+    parser.add_argument("--baseline", help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", help="Write this run's results to a JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative p95/throughput regression")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,90 @@
+"""
+Production server settings, picked up by running from this directory:
+
+    gunicorn main:app
+
+The app is imported once in the master and forked into uvicorn workers.
+ARIA_SERVER_PROFILE selects the worker layout:
+
+    single (default): one worker
+    multi: one worker per CPU, once the shared state below is configured
+
+Environment:
+    ARIA_SERVER_PROFILE: single or multi
+    ARIA_ALLOW_WORKER_LOCAL_STATE: true to start several workers anyway
+        with memory OTPs or the memory datastore, for clients that keep
+        each session on one connection (benchmarks/load_test.py does)
+    WEB_CONCURRENCY: Number of workers, overrides the profile
+    ARIA_BIND: Address to listen on (default 0.0.0.0:8000)
+    GRACEFUL_TIMEOUT: Seconds a stopping worker gets before it is killed
+    WORKER_TIMEOUT: Seconds a worker may be unresponsive before it is restarted
+    KEEPALIVE: Seconds idle keep-alive connections are held open
+    SHUTDOWN_FLUSH_SECONDS: Part of GRACEFUL_TIMEOUT kept for flushing
+        pending writes and emails after connections are drained
+
+Shared state: OTPs, the memory datastore, rate limits, single-flight
+results and admission queues live in each worker. Running more than one
+worker needs OTP_STORE=redis or firestore (the default, memory, is per
+worker) and the firestore datastore; the server refuses to start with
+several workers otherwise. RATE_LIMIT_BACKEND=redis makes limits hold
+across workers. Search indexes and ingestion jobs are kept in step
+through the files under ARIA_DATA_DIR, which the workers must share.
+"""
+import multiprocessing
+import os
+
+PROFILES = {
+    "single": {"workers": 1},
+    "multi": {"workers": multiprocessing.cpu_count()},
+}
+
+profile = os.getenv("ARIA_SERVER_PROFILE", "single").lower()
+if profile not in PROFILES:
+    raise RuntimeError(f"Unknown ARIA_SERVER_PROFILE {profile!r}, expected one of {sorted(PROFILES)}")
+
+bind = os.getenv("ARIA_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "0")) or PROFILES[profile]["workers"]
+
+# State that only exists inside each worker: a user would sign up on one
+# worker and be unknown, or have no OTP, on the next
+_worker_local_state = [
+    name for name, value in (("OTP_STORE", os.getenv("OTP_STORE", "memory")),
+                             ("ARIA_DATASTORE", os.getenv("ARIA_DATASTORE", "firestore")))
+    if value.lower() == "memory"
+]
+allow_worker_local_state = os.getenv("ARIA_ALLOW_WORKER_LOCAL_STATE", "false").lower() == "true"
+if workers > 1 and _worker_local_state and not allow_worker_local_state:
+    raise RuntimeError(
+        f"{workers} workers need shared state but {' and '.join(_worker_local_state)} "
+        f"{'is' if len(_worker_local_state) == 1 else 'are'} memory; configure a shared "
+        "backend, run ARIA_SERVER_PROFILE=single, or set ARIA_ALLOW_WORKER_LOCAL_STATE=true"
+    )
+worker_class = "utils.server.AriaUvicornWorker"
+preload_app = True
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "45"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+
+# Split the CPU-bound pools (password hashing, document parsing) between
+# workers instead of giving every worker one process per CPU. Set before
+# the app is preloaded so main picks them up.
+_cpus_per_worker = str(max(1, multiprocessing.cpu_count() // workers))
+os.environ.setdefault("PASSWORD_POOL_WORKERS", _cpus_per_worker)
+os.environ.setdefault("INGEST_WORKERS", _cpus_per_worker)
+
+
+def on_starting(server):
+    server.log.info("Server profile %s: %d worker(s) on %s", profile, workers, bind)
+    if workers > 1 and _worker_local_state:
+        server.log.warning(
+            "%s=memory with %d workers: each worker has its own, as allowed by ARIA_ALLOW_WORKER_LOCAL_STATE",
+            " and ".join(_worker_local_state), workers
+        )
+
+
+def post_fork(server, worker):
+    # The app was imported in the master; give the worker its own logging
+    # thread and database connections
+    import main
+
+    main.reinit_after_fork()
@@ -1,69 +1,158 @@
-from typing import List
-from fastapi import FastAPI, HTTPException, Depends, status, Request
+import time
+_import_started = time.perf_counter()
+from typing import List, Optional
+from urllib.parse import quote
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from datetime import datetime, timedelta
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from fastapi.concurrency import run_in_threadpool
+from datetime import datetime, timedelta, timezone
 import os
 import re
+import json
+import asyncio
+import logging
 import warnings
-from pydantic import BaseModel, EmailStr, field_validator
-import firebase_admin
-from firebase_admin import credentials, firestore
-from datetime import datetime, timedelta
+from pydantic import BaseModel, EmailStr, ValidationError, field_validator
 from dotenv import load_dotenv
-import smtplib
 import random
 import string
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
-from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
-from utils.cors_helpers import cors_options_response  # Import the helper function
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from utils.cors import CORSMiddleware
+from utils.admission import AdmissionController, AdmissionMiddleware
+from utils.datastore import ARRAY_REMOVE, ARRAY_UNION, DocumentNotFound, create_datastore, use_memory_backend
+from utils.user_cache import UserCache
+from utils.otp_store import OTP_MISSING, OTP_OK, OTP_USED, create_otp_store
+from utils.sweeper import Sweeper, SweepRule
+from utils.single_flight import SingleFlight
+from utils.rate_limit import create_rate_limiter
+from utils.user_import import IMPORT_FORMATS, LineTooLong, iter_lines, iter_records
+from utils.hashing import PasswordHasher, PoolSaturated, hash_otp, verify_otp_hash
+from utils.mailer import Mailer, SMTPConnectionPool
+from utils.write_behind import WriteBehindBuffer
+from utils.token_cache import TokenCache
+from utils.ingestion import SUPPORTED_EXTENSIONS, ChunkStore, IngestionEngine, ingest_files
+from utils.embeddings import create_embedder
+from utils.embedding_cache import CachedEmbedder, EmbeddingCache
+from utils.vector_store import VectorStoreRegistry
+from utils.manifest import Manifest
+from utils.jobs import JobManager
+from utils.file_lock import file_lock
+from utils.search import SEARCH_MODES, hybrid_search
+from utils.log import configure_logging, logging_stats, restart_logging_after_fork, stop_logging
+from utils.metrics import REGISTRY, MetricsMiddleware
 
 load_dotenv()
-
-# Create a custom middleware to add CORS headers to all responses
-class CORSHeaderMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        response.headers["Access-Control-Allow-Origin"] = "*"
-        response.headers["Access-Control-Allow-Credentials"] = "true"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-        return response
+configure_logging()
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    replayed = write_behind.replay_spool()
+    if replayed:
+        logger.info("Replayed %d spooled write-behind updates", replayed)
+    if not use_memory_backend() and FIREBASE_INIT == "lifespan":
+        # Connect in the background so the worker starts serving immediately
+        asyncio.get_running_loop().run_in_executor(None, warm_up_firebase)
+    if sweeper.interval > 0:
+        sweeper.start()
+    startup["ready_ms"] = round((time.perf_counter() - _import_started) * 1000, 1)
+    logger.info(
+        "Startup completed in %.1f ms (imports and setup %.1f ms)",
+        startup["ready_ms"], startup["import_ms"]
+    )
+    yield
+    sweeper.stop()
+    # Deliver queued emails and pending writes before the worker exits
+    mailer.stop()
+    write_behind.stop()
+    job_manager.shutdown()
+    ingestion_engine.shutdown()
+    password_hasher.shutdown()
+    vector_stores.close()
+    embedding_cache.close()
+    otp_store.close()
+    # Last, once nothing above can still dispatch datastore calls
+    datastore.shutdown(wait=True)
 
 # FastAPI setup - use only one app instance
-app = FastAPI()
-
-# Add our custom CORS middleware
-app.add_middleware(CORSHeaderMiddleware)
+app = FastAPI(lifespan=lifespan)
+
+# Admission control: requests beyond a pool's concurrency limit wait in a
+# bounded queue for at most ADMISSION_QUEUE_TIMEOUT seconds and are then
+# shed with a 503, so a slow Firestore or SMTP can't pile requests up.
+# OTP endpoints get their own pools (ADMISSION_ROUTE_LIMITS, "path=limit"
+# pairs) so an OTP storm can't starve the rest of the API.
+ADMISSION_ROUTE_LIMITS = os.getenv(
+    "ADMISSION_ROUTE_LIMITS",
+    "/request_signup_otp=32,/request_login_otp=32,/verify_signup_otp=32,/login_with_otp=32",
+)
+# Probes, scrapes and long-lived streams are never queued or shed
+ADMISSION_EXEMPT_PATHS = {"/health", "/ready", "/metrics", "/admin/users/import", "/admin/users/export"}
+
+def admission_exempt(path):
+    return path in ADMISSION_EXEMPT_PATHS or path.endswith("/events")
+
+def admission_priority(scope):
+    """Requests with a valid bearer token are served ahead of anonymous ones"""
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer" or not token:
+                return False
+            try:
+                decode_access_token(token)
+            except InvalidToken:
+                return False
+            return True
+    return False
+
+admission = AdmissionController(
+    max_concurrency=int(os.getenv("ADMISSION_MAX_CONCURRENCY", "256")),
+    route_limits={
+        path.strip(): int(limit)
+        for path, _, limit in (pair.partition("=") for pair in ADMISSION_ROUTE_LIMITS.split(","))
+        if path.strip() and limit.strip()
+    },
+    queue_size=int(os.getenv("ADMISSION_QUEUE_SIZE", "512")),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2.0")),
+    retry_after=int(os.getenv("ADMISSION_RETRY_AFTER", "1")),
+    exempt=admission_exempt,
+    is_priority=admission_priority,
+)
+# Innermost, so shed requests still get CORS headers and are counted in metrics
+app.add_middleware(AdmissionMiddleware, controller=admission)
 
-# Configure standard CORS middleware
+# One pure ASGI layer adds CORS headers and answers every preflight itself.
+# CORS_ALLOW_ORIGINS is a comma-separated list, "*" allows all origins.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Allow all origins
-    allow_credentials=True,
-    allow_methods=["*"],
+    allow_origins=[o.strip() for o in os.getenv("CORS_ALLOW_ORIGINS", "*").split(",") if o.strip()],
+    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    allow_credentials=True,
     expose_headers=["*"],
+    max_age=int(os.getenv("CORS_MAX_AGE", "86400")),
 )
 
+# Outermost, so the recorded latency covers the whole middleware stack
+app.add_middleware(MetricsMiddleware)
+
                      
 # Check for required environment variables, False for production
 def check_required_env_vars():
     required_vars = ['SECRET_KEY', 'DB_URL', 'STORAGE_BUCKET', 'MAIL_USER', 'MAIL_PASS']
     missing_vars = [var for var in required_vars if not os.getenv(var)]
     if missing_vars:
-        print(f"ERROR: Missing required environment variables: {', '.join(missing_vars)}")
-        print("Please check your .env file")
+        logger.error("Missing required environment variables: %s. Please check your .env file", ', '.join(missing_vars))
         return False
     return True
 
 if not check_required_env_vars():
-    print("Application cannot start due to missing environment variables")
+    logger.critical("Application cannot start due to missing environment variables")
+    stop_logging()
     exit(1)
 
 warnings.filterwarnings("ignore")
@@ -137,79 +226,181 @@ class Login(BaseModel):
 class FileProcess(BaseModel):
     files: List[str]
     rewrite: bool = False
+    domain: Optional[str] = None
+    prune: bool = False
+
+class SearchRequest(BaseModel):
+    queries: List[str]
+    k: int = 10
+    domain: Optional[str] = None
+    mode: str = "hybrid"
+    budget_ms: Optional[float] = None
 
 class Domain(BaseModel):
     email: str
     domain: str
 
+class DomainMembership(BaseModel):
+    domain: str
+    remove: bool = False
+
 class FilterWords(BaseModel):
     email: str
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+class FilterWordsUpdate(BaseModel):
+    email: str
+    words: List[str]
+
+class BulkDomains(BaseModel):
+    add: List[Domain] = []
+    remove: List[Domain] = []
+
+class BulkFilterWords(BaseModel):
+    add: List[FilterWordsUpdate] = []
+    remove: List[FilterWordsUpdate] = []
+
+# bcrypt runs in a process pool sized to the CPU count; when its queue is
+# full, requests get a 503 instead of freezing the event loop
+password_hasher = PasswordHasher(
+    max_workers=int(os.getenv("PASSWORD_POOL_WORKERS", "0")) or None,
+    max_pending=int(os.getenv("PASSWORD_POOL_MAX_PENDING", "0")) or None,
+    retry_after=int(os.getenv("PASSWORD_POOL_RETRY_AFTER", "1")),
+)
+# "hmac" hashes short-lived OTPs with a keyed HMAC, "bcrypt" keeps the old behaviour
+OTP_HASH_MODE = os.getenv("OTP_HASH_MODE", "hmac").lower()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# Verified JWT claims, so hot authenticated paths skip jwt.decode
+token_cache = TokenCache(maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")))
+
+# Firebase initialization. firebase_admin is imported and initialised on
+# first use, or in the background from lifespan with FIREBASE_INIT=lifespan
+# (the default), so importing this module stays fast. The connection test
+# lives in /ready instead of running on every worker boot.
+FIREBASE_INIT = os.getenv("FIREBASE_INIT", "lifespan").lower()
 
-# Firebase initialization
 def initialize_firebase():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
     try:
         # Check if already initialized
         if not firebase_admin._apps:
             credential_path = os.path.join(os.path.dirname(__file__), "serviceAccountKey.json")
             if not os.path.exists(credential_path):
-                print(f"ERROR: Service account key file not found at {credential_path}")
+                logger.error("Service account key file not found at %s", credential_path)
                 raise ValueError(f"Service account key file not found at {credential_path}")
             
-            # Print service account info for debugging (without sensitive data)
-            try:
-                import json
-                with open(credential_path, 'r') as f:
-                    cred_data = json.load(f)
-                    print(f"DEBUG: Using service account: {cred_data.get('client_email')}")
-                    print(f"DEBUG: Project ID: {cred_data.get('project_id')}")
-            except Exception as e:
-                print(f"DEBUG: Could not read service account details: {str(e)}")
+            # The key file is read once and handed to the SDK as a dict
+            with open(credential_path, 'r') as f:
+                cred_data = json.load(f)
+            logger.debug("Using service account %s, project %s",
+                         cred_data.get('client_email'), cred_data.get('project_id'))
             
-            cred = credentials.Certificate(credential_path)
+            cred = credentials.Certificate(cred_data)
             database_url = os.getenv('DB_URL')
             if not database_url:
-                print("WARNING: DB_URL environment variable is missing")
+                logger.warning("DB_URL environment variable is missing")
                 raise ValueError("Missing required environment variables: DB_URL")
             
             # Initialize Firebase with detailed options
-            print(f"DEBUG: Initializing Firebase with database URL: {database_url}")
+            logger.debug("Initializing Firebase with database URL %s", database_url)
+            started = time.perf_counter()
             firebase_admin.initialize_app(cred, {
                 'databaseURL': database_url,
                 'storageBucket': os.getenv('STORAGE_BUCKET')
             })
-            
-            # Test Firestore connection with explicit transaction
             firestore_client = firestore.client()
-            try:
-                # Try a simple write operation to verify permissions
-                test_doc = firestore_client.collection("_test_connection").document("test")
-                test_doc.set({"timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
-                print("Firebase connection verified with successful write test")
-                # Clean up test document
-                test_doc.delete()
-            except Exception as test_error:
-                print(f"WARNING: Firebase connection test write failed: {str(test_error)}")
-                # Continue anyway, as the error might be permission-specific
-            
-            print("Firebase connection established successfully")
+            logger.info("Firebase initialized in %.1f ms", (time.perf_counter() - started) * 1000)
             return firestore_client
         else:
             return firestore.client()
     except Exception as e:
-        print(f"Firebase Initialization Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Firebase initialization error: %s", e)
         raise
 
-# Initialize Firebase at startup
-try:
-    firest = initialize_firebase()
-except Exception as e:
-    print(f"Critical Initialization Error: {str(e)}")
-    raise
+def warm_up_firebase():
+    try:
+        datastore.backend.client
+    except Exception:
+        # Already logged; the next request retries the initialisation
+        pass
+
+def check_firestore_connection():
+    """Write and delete a probe document to verify connectivity and permissions"""
+    client = datastore.backend.client
+    test_doc = client.collection("_test_connection").document("test")
+    test_doc.set({"timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+    test_doc.delete()
+
+if use_memory_backend():
+    logger.warning("Using in-memory datastore (ARIA_DATASTORE=memory), data is not persisted")
+
+# All document access goes through the datastore so async endpoints can
+# offload blocking Firestore calls to its bounded thread pool
+datastore = create_datastore(initialize_firebase)
+
+# Updates nothing reads back synchronously (e.g. the stored apikey) are
+# coalesced and flushed in batched writes off the request path
+write_behind = WriteBehindBuffer(
+    datastore.backend,
+    max_batch=int(os.getenv("WRITE_BEHIND_BATCH", "500")),
+    flush_interval=float(os.getenv("WRITE_BEHIND_INTERVAL", "1.0")),
+    spool_path=os.getenv(
+        "WRITE_BEHIND_SPOOL",
+        os.path.join(os.path.dirname(__file__), "write_behind_spool.jsonl"),
+    ),
+)
+
+# Pending OTPs live in a TTL store (in process by default, see OTP_STORE)
+# rather than as Firestore documents that were never cleaned up
+otp_store = create_otp_store(datastore.backend)
+OTP_TTL = int(os.getenv("OTP_TTL", "300"))
+# How long a verified signup OTP lets /signup proceed
+OTP_VERIFIED_TTL = int(os.getenv("OTP_VERIFIED_TTL", "900"))
+# Duplicate OTP requests for the same (email, purpose), from double clicks
+# or client retries, share one issuance for OTP_COALESCE_WINDOW seconds:
+# same code, one email, one store write. Emails are compared ignoring case.
+# Issuers raise HTTPException on failure, which is never reused, so a retry
+# after an error issues again.
+otp_requests = SingleFlight(
+    "otp_request",
+    window=float(os.getenv("OTP_COALESCE_WINDOW", "10")),
+    maxsize=int(os.getenv("OTP_COALESCE_SIZE", "10000")),
+)
+
+def _local_timestamp(seconds_ago):
+    # Older documents carry "%Y-%m-%d %H:%M:%S" local-time strings, which sort chronologically
+    return (datetime.now() - timedelta(seconds=seconds_ago)).strftime("%Y-%m-%d %H:%M:%S")
+
+# Documents named in /process are read from the caller's own directory
+# under UPLOAD_DIR; everything derived from them (chunks, later indexes)
+# lives under DATA_DIR, one directory per tenant
+UPLOAD_DIR = os.getenv("ARIA_UPLOAD_DIR", os.path.join(os.path.dirname(__file__), "uploads"))
+DATA_DIR = os.getenv("ARIA_DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
+
+# Deletes expired OTP documents (abandoned signups, or OTPs from before
+# expires_at existed) and connection probes left behind by failed checks.
+# Every worker starts one; the lock file lets only one of them sweep.
+sweeper = Sweeper(
+    datastore.backend,
+    [
+        SweepRule("otp_expired", "OTP DB", "expires_at", lambda: datetime.now(timezone.utc)),
+        SweepRule("otp_legacy", "OTP DB", "timestamp",
+                  lambda: _local_timestamp(int(os.getenv("SWEEP_LEGACY_OTP_AGE", "86400")))),
+        SweepRule("connection_probe", "_test_connection", "timestamp", lambda: _local_timestamp(3600)),
+    ],
+    interval=float(os.getenv("SWEEP_INTERVAL", "300")),
+    batch_size=int(os.getenv("SWEEP_BATCH", "500")),
+    max_rate=float(os.getenv("SWEEP_MAX_RATE", "500")),
+    max_per_pass=int(os.getenv("SWEEP_MAX_PER_PASS", "10000")),
+    lock_path=os.path.join(DATA_DIR, "sweeper.lock"),
+)
+
+# Process-local cache of User documents, invalidated by our own writes
+user_cache = UserCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "60")),
+)
 
 # Authentication helper functions
 def generate_otp(length=6):
@@ -218,16 +409,145 @@ def generate_otp(length=6):
     otp = ''.join(random.choices(digits, k=length))
     return otp
 
+ingestion_engine = IngestionEngine(
+    max_workers=int(os.getenv("INGEST_WORKERS", "0")) or None,
+    pages_per_task=int(os.getenv("INGEST_PAGES_PER_TASK", "8")),
+    max_tokens=int(os.getenv("CHUNK_TOKENS", "512")),
+    overlap=int(os.getenv("CHUNK_OVERLAP", "64")),
+)
+
+def path_component(name):
+    """
+    Directory name for a user or domain. Percent-encoding keeps it
+    reversible, so different names never share a directory, and "/" can't
+    escape the parent; "." and ".." are rejected.
+    """
+    if not name or name in (".", ".."):
+        raise ValueError(f"Invalid name: {name!r}")
+    return quote(name, safe="@._-")
+
+def tenant_dir(tenant):
+    """Data directory of a tenant (user email or domain)"""
+    return os.path.join(DATA_DIR, path_component(tenant))
+
+# Chunk embeddings are cached by content hash and model, so re-ingesting a
+# mostly unchanged document only embeds the chunks that changed
+base_embedder = create_embedder()
+embedding_cache = EmbeddingCache(
+    os.path.join(DATA_DIR, "embedding_cache", re.sub(r"[^A-Za-z0-9._-]", "_", base_embedder.model_id)),
+    base_embedder.dim,
+    capacity=int(os.getenv("EMBEDDING_CACHE_SIZE", "200000")),
+)
+embedder = CachedEmbedder(base_embedder, embedding_cache)
+
+# One FAISS-backed vector store per tenant, under <tenant dir>/index
+vector_stores = VectorStoreRegistry(lambda tenant: os.path.join(tenant_dir(tenant), "index"), embedder)
+
+def user_upload_dir(username):
+    """Upload directory of one user; /process only reads files from here"""
+    return os.path.join(UPLOAD_DIR, path_component(username))
+
+def resolve_upload(username, name):
+    """Map a file name from /process to a path inside the user's upload directory"""
+    root = os.path.realpath(user_upload_dir(username))
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Invalid file path: {name}")
+    return path
+
+# /process runs as a background job; progress is streamed from /process/{job_id}/events.
+# Job state and events are kept under DATA_DIR so every worker can serve them,
+# and jobs of one tenant run one at a time. A job whose worker stops
+# refreshing its state for INGEST_JOB_STALE_AFTER seconds is reported failed.
+job_manager = JobManager(
+    max_workers=int(os.getenv("INGEST_JOBS", "2")),
+    retention=int(os.getenv("INGEST_JOB_RETENTION", "3600")),
+    store_dir=os.path.join(DATA_DIR, "jobs"),
+    heartbeat=float(os.getenv("INGEST_JOB_HEARTBEAT", "10")),
+    stale_after=float(os.getenv("INGEST_JOB_STALE_AFTER", "60")),
+)
+# Longest a single event stream stays open; clients reconnect with their cursor
+INGEST_EVENTS_TIMEOUT = float(os.getenv("INGEST_EVENTS_TIMEOUT", "1800"))
+
+def run_ingestion_job(job, tenant, files, rewrite, prune):
+    """Ingest files for a tenant, reporting progress and throughput as job events"""
+    store = ChunkStore(os.path.join(tenant_dir(tenant), "chunks"))
+    index = vector_stores.get(tenant)
+    run_embedder = embedder.session()
+    started = time.monotonic()
+    totals = {"pages": 0, "chunks": 0}
+
+    def throughput():
+        elapsed = max(time.monotonic() - started, 1e-9)
+        return {
+            "elapsed": round(elapsed, 3),
+            "pages_per_sec": round(totals["pages"] / elapsed, 2),
+            "chunks_per_sec": round(totals["chunks"] / elapsed, 2),
+        }
+
+    def progress(event, data):
+        if event == "page":
+            totals["pages"] += 1
+            totals["chunks"] += data["chunks"]
+            data = {**data, **totals, **throughput()}
+        elif event == "chunks":
+            data = {**data, **throughput()}
+        job.emit(event, data)
+
+    # The job manager runs one job per tenant at a time within a worker; the
+    # lock file extends that to jobs started on other workers
+    os.makedirs(tenant_dir(tenant), exist_ok=True)
+    with file_lock(os.path.join(tenant_dir(tenant), ".ingest.lock")):
+        # Read under the lock so a run on another worker is seen in full
+        manifest = Manifest(os.path.join(tenant_dir(tenant), "manifest.json"))
+        results = ingest_files(
+            ingestion_engine, store, files, rewrite,
+            index=index, embedder=run_embedder, manifest=manifest, prune=prune, progress=progress
+        )
+    diff = {
+        key: sum(r.get(key, 0) for r in results)
+        for key in ("pages_added", "pages_changed", "pages_unchanged", "pages_removed")
+    }
+    return {
+        "files_processed": sum(1 for r in results if r["status"] in ("new", "changed")),
+        "rewrite_enabled": rewrite,
+        "files": results,
+        "diff": diff,
+        "index": index.stats(),
+        "embedding_cache": run_embedder.stats(),
+        **totals,
+        **throughput(),
+    }
+
+# Emails are delivered by background workers over pooled SMTP connections.
+# Point SMTP_HOST/SMTP_PORT at a local sink (e.g. aiosmtpd) with
+# SMTP_STARTTLS=false for offline testing.
+mailer = Mailer(
+    SMTPConnectionPool(
+        host=os.getenv("SMTP_HOST", "smtp.gmail.com"),
+        port=int(os.getenv("SMTP_PORT", "587")),
+        username=os.getenv("MAIL_USER"),
+        password=os.getenv("MAIL_PASS"),
+        starttls=os.getenv("SMTP_STARTTLS", "true").lower() == "true",
+        size=int(os.getenv("SMTP_POOL_SIZE", "2")),
+        debug=int(os.getenv("SMTP_DEBUG", "0")),
+    ),
+    workers=int(os.getenv("MAIL_WORKERS", "2")),
+    batch_size=int(os.getenv("MAIL_BATCH_SIZE", "20")),
+    max_attempts=int(os.getenv("MAIL_MAX_ATTEMPTS", "4")),
+)
+
 def send_otp_via_email(receiver_email, otp, purpose="verification"):
-    """Send the OTP to the specified email address."""
+    """
+    Queue the OTP email for the specified address.
+
+    Returns the message id for /email_status, or False if email is not configured.
+    """
     sender_email = os.getenv('MAIL_USER')
     sender_password = os.getenv('MAIL_PASS')
     
-    # More detailed logging for email configuration
-    print(f"DEBUG: Email configuration - User: {sender_email}, Pass length: {len(sender_password) if sender_password else 0}")
-    
     if not sender_email or not sender_password:
-        print(f"ERROR: Email credentials not configured properly: {sender_email=}")
+        logger.error("Email credentials not configured properly (MAIL_USER=%r)", sender_email)
         return False
 
     message = MIMEMultipart()
@@ -254,132 +574,82 @@ The ARIA AI Team"""
     
     message.attach(MIMEText(body, 'plain'))
     
-    try:
-        print(f"DEBUG: Attempting to send email from {sender_email} to {receiver_email}")
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.set_debuglevel(1)  # Add SMTP debug logging
-        server.starttls()
-        
-        # Try to login with better error handling
-        try:
-            print(f"DEBUG: Attempting SMTP login for {sender_email}")
-            server.login(sender_email, sender_password)
-            print("DEBUG: SMTP login successful")
-            
-            print("DEBUG: Sending email message")
-            server.send_message(message)
-            server.quit()
-            print(f"DEBUG: OTP email sent successfully to {receiver_email}")
-            return True
-            
-        except smtplib.SMTPAuthenticationError as auth_error:
-            print(f"ERROR: SMTP Authentication Error: {auth_error}")
-            print("This error usually occurs when:")
-            print("1. Your email password is incorrect")
-            print("2. You need to use an App Password instead of your regular password")
-            print("3. You need to allow less secure apps in your Google account settings")
-            print("4. You need to enable IMAP access in your Gmail settings")
-            return False
-            
-        except Exception as login_error:
-            print(f"ERROR: SMTP Login Error: {login_error}")
-            return False
-            
-    except Exception as e:
-        print(f"ERROR: SMTP Connection Error: {e}")
-        return False
+    message_id = mailer.enqueue(message)
+    logger.debug("OTP email %s queued for %s", message_id, receiver_email)
+    return message_id
 
 def store_otp(email, otp, purpose="login"):
-    """Store OTP in Firestore with timestamp"""
+    """Store the hashed OTP in the OTP store, valid for OTP_TTL seconds"""
     try:
-        print(f"DEBUG: Storing OTP for {email} with purpose {purpose}")
-        doc_ref = firest.collection("OTP DB").document(email)
-        hashed_otp = get_password_hash(otp)
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        data = {
-            "otp": hashed_otp,
-            "timestamp": timestamp,
-            "purpose": purpose,
-            "verified": False
-        }
-        print(f"DEBUG: Writing OTP data with timestamp {timestamp}")
-        
-        # Use an explicit transaction for more reliable writes
-        transaction = firest.transaction()
-        
-        @firestore.transactional
-        def update_in_transaction(transaction, doc_ref, data):
-            transaction.set(doc_ref, data)
-            return True
-            
-        result = update_in_transaction(transaction, doc_ref, data)
-        print(f"DEBUG: OTP data successfully stored for {email}")
+        logger.debug("Storing OTP for %s with purpose %s", email, purpose)
+        if OTP_HASH_MODE == "hmac":
+            hashed_otp = hash_otp(otp, SECRET_KEY)
+        else:
+            hashed_otp = get_password_hash(otp)
+        result = otp_store.put(email, hashed_otp, purpose, OTP_TTL)
+        logger.debug("OTP stored for %s", email)
         return result
     except Exception as e:
-        print(f"ERROR storing OTP: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error storing OTP: %s", e)
         return False
 
 def verify_otp(email, user_otp):
-    """Verify OTP from Firestore"""
+    """Verify an OTP and consume it, so each code can be used once"""
     try:
-        user_ref = firest.collection("OTP DB").document(email)
-        user_doc = user_ref.get()
-        if not user_doc.exists:
-            return {"status": False, "error": "No OTP found or expired"}
-        data = user_doc.to_dict()
-        stored_otp = data.get("otp")
-        timestamp_str = data.get("timestamp")
-        purpose = data.get("purpose", "login")
-        
-        timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-        current_time = datetime.now()
-        
-        if current_time - timestamp > timedelta(minutes=5):
-            return {"status": False, "error": "OTP expired"}
+        def matches(stored_otp):
+            otp_valid = verify_otp_hash(user_otp, stored_otp, SECRET_KEY)
+            if otp_valid is None:
+                # OTP stored as a bcrypt hash
+                otp_valid = verify_password(user_otp, stored_otp)
+            return otp_valid
         
-        if verify_password(user_otp, stored_otp):
-            user_ref.update({"verified": True})
-            return {"status": True, "message": "OTP is valid", "purpose": purpose}
-        else:
+        outcome, record = otp_store.verify_and_consume(email, matches, OTP_VERIFIED_TTL)
+        if outcome == OTP_MISSING:
+            return {"status": False, "error": "No OTP found or expired"}
+        if outcome == OTP_USED:
+            return {"status": False, "error": "OTP already used"}
+        if outcome != OTP_OK:
             return {"status": False, "error": "Invalid OTP"}
+        purpose = record.get("purpose", "login")
+        # A new request right after using the code must issue a fresh one
+        otp_requests.forget((email.lower(), purpose))
+        return {"status": True, "message": "OTP is valid", "purpose": purpose}
     except Exception as e:
-        print(f"Error verifying OTP: {e}")
+        logger.error("Error verifying OTP: %s", e)
         return {"status": False, "error": str(e)}
 
+def get_user_record(email):
+    """Read a User document through the user cache, None if it doesn't exist"""
+    return user_cache.get_or_load(email, lambda key: datastore.backend.get("User", key))
+
 def check_user_exists(email):
     """Check if a user with the given email already exists"""
-    doc_ref = firest.collection("User").document(email)
-    return doc_ref.get().exists
+    return get_user_record(email) is not None
 
 def create_user_account(email, password, username):
     """Create a new user account after OTP verification"""
     try:
         # First check if the user is verified with OTP
-        print(f"DEBUG: Creating account for {email} with username {username}")
-        otp_ref = firest.collection("OTP DB").document(email)
-        otp_doc = otp_ref.get()
-        if not otp_doc.exists:
-            print(f"DEBUG: No OTP document found for {email}")
+        logger.debug("Creating account for %s with username %s", email, username)
+        otp_data = otp_store.get(email)
+        if otp_data is None:
+            logger.debug("No OTP document found for %s", email)
             return {"status": False, "message": "OTP verification required"}
             
-        otp_data = otp_doc.to_dict()
         if not otp_data.get("verified", False):
-            print(f"DEBUG: OTP not verified for {email}")
+            logger.debug("OTP not verified for %s", email)
             return {"status": False, "message": "Email not verified with OTP"}
             
         if otp_data.get("purpose") != "signup":
-            print(f"DEBUG: Invalid purpose for {email}: {otp_data.get('purpose')}")
+            logger.debug("Invalid purpose for %s: %s", email, otp_data.get('purpose'))
             return {"status": False, "message": "Invalid verification purpose"}
         
         # Create the user account
-        print(f"DEBUG: Verification passed, creating user account: {email}")
-        doc_ref = firest.collection("User").document(email)
+        logger.debug("Verification passed, creating user account: %s", email)
         
         # Check if user already exists
-        if doc_ref.get().exists:
-            print(f"DEBUG: User already exists: {email}")
+        if get_user_record(email) is not None:
+            logger.debug("User already exists: %s", email)
             return {"status": False, "message": "User already exists"}
         
         created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -392,108 +662,234 @@ def create_user_account(email, password, username):
         }
         
         # Use transaction for reliable write
-        transaction = firest.transaction()
-        
-        @firestore.transactional
-        def create_user_in_transaction(transaction, doc_ref, data):
-            transaction.set(doc_ref, data)
-            return True
-            
-        result = create_user_in_transaction(transaction, doc_ref, admin_data)
+        result = datastore.backend.set("User", email, admin_data, transactional=True)
+        user_cache.invalidate(email)
         
         if result:
-            print(f"DEBUG: User account created successfully: {email}")
-            # Clean up the OTP document after successful signup
-            otp_ref.delete()
+            logger.info("User account created: %s", email)
+            # Clean up the verified OTP record after successful signup
+            otp_store.delete(email)
             return {"status": True, "message": "Account created successfully"}
         else:
-            print(f"DEBUG: Failed to create user account for unknown reason")
+            logger.error("Failed to create user account for %s for unknown reason", email)
             return {"status": False, "message": "Failed to create user account"}
             
     except Exception as e:
-        print(f"ERROR creating user: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error creating user: %s", e)
         return {"status": False, "message": f"An error occurred: {e}"}
 
+def hashing_unavailable(error: PoolSaturated):
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please retry shortly",
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    try:
+        return password_hasher.verify(plain_password, hashed_password)
+    except PoolSaturated as e:
+        raise hashing_unavailable(e)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    try:
+        return password_hasher.hash(password)
+    except PoolSaturated as e:
+        raise hashing_unavailable(e)
+
+async def verify_password_async(plain_password, hashed_password):
+    try:
+        return await password_hasher.verify_async(plain_password, hashed_password)
+    except PoolSaturated as e:
+        raise hashing_unavailable(e)
 
 def get_user(db, username: str):
     try:
-        user_ref = firest.collection("User").document(username)
-        user_doc = user_ref.get()
-        if user_doc.exists:
-            data = user_doc.to_dict()
+        data = get_user_record(username)
+        if data is not None:
             username = data.get("username")
             password = data.get("password")
             disabled = data.get("disabled")
             return {"username": username, "password": password, "disabled": disabled}
         else:
-            print("No such document!")
+            logger.debug("No such user: %s", username)
             return None
     except Exception as e:
-        print(f"Error getting document: {e}")
+        logger.error("Error getting user document: %s", e)
         return None
 
-def authenticate_user(db, username: str, password: str):
-    user = get_user(db, username)
+async def authenticate_user(db, username: str, password: str):
+    user = await datastore.run(get_user, db, username)
     if not user:
         return False
-    if not verify_password(password, user['password']):
+    if not await verify_password_async(password, user['password']):
         return False
     return user
 
+class InvalidToken(Exception):
+    """A bearer token that failed verification"""
+
+# python-jose is imported on first use to keep startup fast
 def create_access_token(data: dict, expires_delta: timedelta or None = None):
+    from jose import jwt
+
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
+    # Tokens carry the user's token generation, which revoke_user_tokens()
+    # bumps. Callers look it up with token_generation() beforehand, through
+    # datastore.run() in async code, since it may read the datastore.
+    if "gen" not in to_encode:
+        raise ValueError("Token data needs the subject's token generation (\"gen\")")
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+def decode_access_token(token: str):
+    """Return the verified claims of a token, using token_cache when possible"""
+    payload = token_cache.get(token)
+    if payload is None:
+        from jose import JWTError, jwt
+
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError as e:
+            raise InvalidToken(str(e)) from e
+        token_cache.put(token, payload)
+    return payload
+
+def token_generation(subject):
+    """Token generation of a user; tokens issued under an older one are revoked"""
+    user = get_user_record(subject)
+    return user.get("token_generation", 0) if user else 0
+
+def revoke_user_tokens(email):
+    """
+    Revoke every token issued to a user so far by bumping their token
+    generation. Other workers see the new generation once their cached
+    User document expires (USER_CACHE_TTL). Returns False if the user
+    doesn't exist.
+    """
+    try:
+        # Atomic, so concurrent revocations each count
+        datastore.backend.increment("User", email, "token_generation")
+    except DocumentNotFound:
+        return False
+    user_cache.invalidate(email)
+    token_cache.revoke_subject(email)
+    logger.info("Revoked all tokens of %s", email)
+    return True
+
+async def get_token_subject(token: str = Depends(oauth2_scheme)):
+    """Shared auth dependency: the "sub" claim of a valid, unrevoked bearer token"""
     credential_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"}
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(token)
         username: str = payload.get("sub")
         if username is None:
             raise credential_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+    except InvalidToken:
+        raise credential_exception
+    if payload.get("gen", 0) < await datastore.run(token_generation, username):
         raise credential_exception
-    user = get_user(firest, username=token_data.username)
+    return username
+
+async def get_current_user(username: str = Depends(get_token_subject)):
+    credential_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+    token_data = TokenData(username=username)
+    user = await datastore.run(get_user, datastore, username=token_data.username)
     if user is None:
         raise credential_exception
     return user
 
 def store_token(uid, token):
-    doc_ref = firest.collection("User").document(uid)
+    """Queue the token write; it is flushed in the background by write_behind"""
     data = {"apikey": token}
     try:
-        doc_ref.update(data)
+        write_behind.update("User", uid, data)
+        user_cache.invalidate(uid)
         return True
     except Exception as e:
-        print(f"Error storing token: {e}")
+        logger.error("Error storing token: %s", e)
         return False
 
+# Token-bucket rate limits per client IP and per email, as
+# "<requests>/<seconds>" (RATE_LIMIT_<POLICY>_<IP|EMAIL>). OTP issuance is
+# the strictest since it sends mail; OTP checks are limited per email so a
+# 6-digit code can't be brute forced.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Take the client IP from the last X-Forwarded-For hop (set by our proxy)
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+RATE_LIMIT_DEFAULTS = {
+    ("otp_request", "ip"): "20/60",
+    ("otp_request", "email"): "3/60",
+    ("otp_verify", "ip"): "30/60",
+    ("otp_verify", "email"): "10/300",
+    ("login", "ip"): "30/60",
+    ("login", "email"): "10/60",
+}
+rate_limiters = {
+    (policy, kind): create_rate_limiter(
+        f"{policy}_{kind}",
+        os.getenv(f"RATE_LIMIT_{policy.upper()}_{kind.upper()}", spec),
+        maxsize=int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000")),
+    )
+    for (policy, kind), spec in RATE_LIMIT_DEFAULTS.items()
+} if RATE_LIMIT_ENABLED else {}
+
+def client_ip(request: Request):
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+def enforce_rate_limit(policy, request: Request, response: Response, email=None):
+    """Take a token from the IP and email buckets of policy; 429 if either is empty. Async endpoints use enforce_rate_limit_async."""
+    results = []
+    for kind, key in (("ip", client_ip(request)), ("email", email)):
+        limiter = rate_limiters.get((policy, kind))
+        if limiter is not None and key:
+            results.append(limiter.hit(key.lower()))
+    if not results:
+        return
+    # Report the bucket closest to rejecting the request
+    result = min(results, key=lambda r: (r.allowed, r.remaining))
+    if not result.allowed:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, please retry later",
+            headers=result.headers()
+        )
+    response.headers.update(result.headers())
+
+async def enforce_rate_limit_async(policy, request: Request, response: Response, email=None):
+    """enforce_rate_limit for async endpoints; limiters that make network calls run in the threadpool"""
+    if any(limiter.blocking for limiter in rate_limiters.values()):
+        await run_in_threadpool(enforce_rate_limit, policy, request, response, email)
+    else:
+        enforce_rate_limit(policy, request, response, email)
+
 # API Endpoints:
 @app.get("/")
 async def root():
     return {"message": "Authentication Service"}
 
 @app.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(firest, form_data.username, form_data.password)
+async def login_for_access_token(http_request: Request, response: Response,
+                                 form_data: OAuth2PasswordRequestForm = Depends()):
+    await enforce_rate_limit_async("login", http_request, response, form_data.username)
+    user = await authenticate_user(datastore, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -501,115 +897,85 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             headers={"WWW-Authenticate": "Bearer"}
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    # The subject is the account's email: tenants and ownership are keyed by
+    # it, while display usernames are not unique
+    generation = await datastore.run(token_generation, form_data.username)
     access_token = create_access_token(
-        data={"sub": user['username']}, expires_delta=access_token_expires
+        data={"sub": form_data.username, "gen": generation}, expires_delta=access_token_expires
     )
     store_token(form_data.username, access_token)
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.options("/request_signup_otp")
-async def options_signup_otp():
-    return cors_options_response()
-
-@app.options("/verify_signup_otp")
-async def options_verify_signup_otp():
-    return cors_options_response()
-
-@app.options("/request_login_otp")
-async def options_login_otp():
-    return cors_options_response()
-
-@app.options("/login_with_otp")
-async def options_login_with_otp():
-    return cors_options_response()
-
-@app.options("/login")
-async def options_login():
-    return cors_options_response()
-
-# Add OPTIONS handlers for other endpoints that need CORS
-@app.options("/signup")
-async def options_signup():
-    return cors_options_response()
-
-@app.options("/process")
-async def options_process():
-    return cors_options_response("POST, OPTIONS")
-
-@app.options("/add_domain")
-async def options_add_domain():
-    return cors_options_response()
-
-@app.options("/get_filterwords")
-async def options_get_filterwords():
-    return cors_options_response()
-
 @app.post("/request_signup_otp")
-async def request_signup_otp(request: EmailOTP):
+async def request_signup_otp(request: EmailOTP, http_request: Request, response: Response):
     """Request OTP for signup process"""
+    await enforce_rate_limit_async("otp_request", http_request, response, request.email)
+    return await otp_requests.do_async((request.email.lower(), "signup"), issue_signup_otp, request.email)
+
+async def issue_signup_otp(email):
     try:
-        email = request.email
-        print(f"DEBUG: Processing signup OTP request for email: {email}")
+        logger.debug("Processing signup OTP request for %s", email)
         # Check if the email already exists
-        if check_user_exists(email):
-            print(f"DEBUG: Email already registered: {email}")
-            return JSONResponse(
-                content={"detail": "Email already registered"},
-                status_code=409
+        if await datastore.run(check_user_exists, email):
+            logger.debug("Email already registered: %s", email)
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Email already registered"
             )
         
         # Generate OTP
         otp = generate_otp()
-        print(f"DEBUG: Generated OTP for {email}: {otp}")
         
         # For development, we'll always return the OTP in the response
         # This is not secure for production but helps with debugging
         
         # Try to send email but continue even if it fails
+        email_sent = False
         try:
             email_sent = send_otp_via_email(email, otp, purpose="signup")
             if not email_sent:
-                print("DEBUG: Email sending failed, but continuing with flow")
+                logger.warning("Email sending failed for %s, continuing with flow", email)
         except Exception as e:
-            print(f"DEBUG: Email error: {str(e)}")
+            logger.warning("Email error for %s: %s", email, e)
             # Continue even if email fails - we'll show OTP in response
         
         # Try to store OTP but continue even if it fails
         try:
-            store_result = store_otp(email, otp, purpose="signup")
+            store_result = await datastore.run(store_otp, email, otp, purpose="signup")
             if not store_result:
-                print("DEBUG: Failed to store OTP, using fallback storage")
+                logger.error("Failed to store signup OTP for %s", email)
                 # In a real app, implement fallback storage
         except Exception as e:
-            print(f"DEBUG: Storage error: {str(e)}")
+            logger.error("OTP storage error for %s: %s", email, e)
             # Continue anyway for testing
         
         # Return success with OTP for development
         return {
             "message": "OTP sent successfully for signup",
+            "email_id": email_sent or None,
             "debug_otp": otp  # Including OTP in response for development
         }
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        print(f"DEBUG: Unexpected error in request_signup_otp: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return JSONResponse(
-            content={"detail": f"Server error: {str(e)}"},
-            status_code=500
+        logger.exception("Unexpected error in request_signup_otp: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Server error: {str(e)}"
         )
 
-@app.options("/verify_signup_otp")  # Handle OPTIONS request for CORS preflight
 @app.post("/verify_signup_otp")
-def verify_signup_otp(request: OTP_AUTH = None):
+def verify_signup_otp(http_request: Request, response: Response, request: OTP_AUTH = None):
     """Verify OTP for signup process"""
     if request is None:
         return {}
         
+    enforce_rate_limit("otp_verify", http_request, response, request.email)
     try:
         email = request.email
         otp = request.otp
         
-        print(f"Verifying OTP for email: {email}")
+        logger.debug("Verifying signup OTP for %s", email)
         result = verify_otp(email, otp)
         if not result["status"]:
             raise HTTPException(
@@ -626,24 +992,26 @@ def verify_signup_otp(request: OTP_AUTH = None):
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"Unexpected error in verify_signup_otp: {str(e)}")
+        logger.exception("Unexpected error in verify_signup_otp: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An unexpected error occurred: {str(e)}"
         )
 
 @app.post("/signup", status_code=status.HTTP_201_CREATED)
-def signup(request: SignUp):
+def signup(request: SignUp, http_request: Request, response: Response):
+    # Signup hashes the password before checking the OTP, so it shares the login limits
+    enforce_rate_limit("login", http_request, response, request.email)
     try:
         email = request.email
         password = request.password
         username = request.username
         
-        print(f"DEBUG: Processing signup for {email} with username {username}")
+        logger.debug("Processing signup for %s with username %s", email, username)
         
         # Check if user already exists
         if check_user_exists(email):
-            print(f"DEBUG: User already exists during signup: {email}")
+            logger.debug("User already exists during signup: %s", email)
             return JSONResponse(
                 status_code=status.HTTP_409_CONFLICT,
                 content={"status": False, "message": "User already exists"}
@@ -651,11 +1019,10 @@ def signup(request: SignUp):
         
         # Hash the password
         hashed_password = get_password_hash(password)
-        print("DEBUG: Password hashed successfully")
         
         # Create user account (this will also check for OTP verification)
         result = create_user_account(email, hashed_password, username)
-        print(f"DEBUG: Account creation result: {result}")
+        logger.debug("Account creation result for %s: %s", email, result["message"])
         
         if not result["status"]:
             raise HTTPException(
@@ -666,28 +1033,25 @@ def signup(request: SignUp):
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"ERROR in signup: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in signup: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred: {str(e)}"
         )
 
-@app.options("/request_login_otp")
-async def options_login_otp():
-    return cors_options_response()
-
 @app.post("/request_login_otp")
-def request_login_otp(request: EmailOTP):
+def request_login_otp(request: EmailOTP, http_request: Request, response: Response):
     """Request OTP for login process"""
+    enforce_rate_limit("otp_request", http_request, response, request.email)
+    return otp_requests.do((request.email.lower(), "login"), issue_login_otp, request.email)
+
+def issue_login_otp(email):
     try:
-        email = request.email
-        print(f"DEBUG: Processing login OTP request for email: {email}")
+        logger.debug("Processing login OTP request for %s", email)
         
         # Check if the email exists
         if not check_user_exists(email):
-            print(f"DEBUG: Account not found for email: {email}")
+            logger.debug("Account not found for %s", email)
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Account not found"
@@ -695,17 +1059,16 @@ def request_login_otp(request: EmailOTP):
         
         # Generate and send OTP
         otp = generate_otp()
-        print(f"DEBUG: Generated login OTP for {email}: {otp}")
         
         # Try sending email with more detailed error reporting
         email_sent = send_otp_via_email(email, otp, purpose="login")
         if not email_sent:
-            print("DEBUG: Email sending failed but continuing with OTP flow for development")
+            logger.warning("Email sending failed for %s, continuing with OTP flow for development", email)
             # For development, we'll still continue and return the OTP
             # Store OTP in Firestore
             store_result = store_otp(email, otp, purpose="login")
             if not store_result:
-                print("DEBUG: Failed to store OTP in database")
+                logger.error("Failed to store login OTP for %s", email)
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                     detail="Failed to store OTP"
@@ -726,26 +1089,22 @@ def request_login_otp(request: EmailOTP):
             
         return {
             "message": "OTP sent successfully for login",
+            "email_id": email_sent,
             "debug_otp": otp  # Including OTP in response for development
         }
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"DEBUG: Unexpected error in request_login_otp: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return JSONResponse(
-            content={"detail": f"Server error: {str(e)}"},
-            status_code=500
+        logger.exception("Unexpected error in request_login_otp: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Server error: {str(e)}"
         )
 
-@app.options("/login_with_otp")
-async def options_login_with_otp():
-    return cors_options_response()
-
 @app.post("/login_with_otp")
-def login_with_otp(request: OTP_AUTH):
+def login_with_otp(request: OTP_AUTH, http_request: Request, response: Response):
     """Login with email and OTP"""
+    enforce_rate_limit("otp_verify", http_request, response, request.email)
     email = request.email
     otp = request.otp
     # Check if the email exists
@@ -771,7 +1130,9 @@ def login_with_otp(request: OTP_AUTH):
     
     # Generate access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data={"sub": email}, expires_delta=access_token_expires)
+    access_token = create_access_token(
+        data={"sub": email, "gen": token_generation(email)}, expires_delta=access_token_expires
+    )
     
     # Store token
     store_token(email, access_token)
@@ -783,25 +1144,22 @@ def login_with_otp(request: OTP_AUTH):
         "token_type": "bearer"
     }
 
-@app.options("/login")
-async def options_login():
-    return cors_options_response()
-
 @app.post("/login", status_code=status.HTTP_200_OK)
-async def login(request: Login):
+async def login(request: Login, http_request: Request, response: Response):
+    await enforce_rate_limit_async("login", http_request, response, request.email)
     try:
         email = request.email
         password = request.password
         # Check if email exists
-        if not check_user_exists(email):
+        if not await datastore.run(check_user_exists, email):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Account not found"
             )
         
         # Check password
-        user = get_user(firest, email)
-        if not user or not verify_password(password, user['password']):
+        user = await datastore.run(get_user, datastore, email)
+        if not user or not await verify_password_async(password, user['password']):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid credentials"
@@ -809,7 +1167,10 @@ async def login(request: Login):
         
         # Generate access token
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(data={"sub": email}, expires_delta=access_token_expires)
+        generation = await datastore.run(token_generation, email)
+        access_token = create_access_token(
+            data={"sub": email, "gen": generation}, expires_delta=access_token_expires
+        )
         
         # Store token
         store_token(email, access_token)
@@ -828,31 +1189,197 @@ async def login(request: Login):
             detail=f"An error occurred: {str(e)}"
         )
 
-@app.post("/process", status_code=status.HTTP_200_OK)
-async def process_files(request: FileProcess, token: str = Depends(oauth2_scheme)):
-    """Process uploaded files and optionally rewrite content"""
+DOMAIN_PATTERN = re.compile(r"^(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}$")
+
+def normalize_domain(domain):
+    """Lower-cased domain name, 400 if it isn't a valid one"""
+    domain = domain.strip().lower()
+    if not DOMAIN_PATTERN.match(domain):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid domain"
+        )
+    return domain
+
+def is_domain_member(username, user, domain):
+    """
+    Whether a user may use a domain's documents: their OTP-verified email
+    is at that domain, or an admin granted them membership. The
+    self-service "domains" list grants nothing.
+    """
+    _, at, email_domain = username.lower().rpartition("@")
+    if at and email_domain == domain:
+        return True
+    return bool(user) and domain in user.get("member_domains", [])
+
+async def resolve_tenant(username, domain):
+    """Documents are indexed per domain when one is given, else per user"""
+    if not domain:
+        return username
+    domain = normalize_domain(domain)
+    user = await datastore.run(get_user_record, username)
+    if not user or not is_domain_member(username, user, domain):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not a member of this domain"
+        )
+    return domain
+
+@app.post("/process", status_code=status.HTTP_202_ACCEPTED)
+async def process_files(request: FileProcess, username: str = Depends(get_token_subject)):
+    """
+    Start incrementally ingesting uploaded files: only new or changed pages are
+    chunked and indexed. rewrite reprocesses every page; prune removes
+    previously ingested files that are not listed.
+
+    Returns a job id right away; progress and the final stats are streamed
+    from /process/{job_id}/events.
+    """
     try:
-        # Verify token
-        credentials_exception = HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"}
+        files = []
+        for name in request.files:
+            if os.path.splitext(name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Unsupported file type: {name}"
+                )
+            try:
+                path = resolve_upload(username, name)
+            except ValueError as e:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+            if not os.path.isfile(path):
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"File not found: {name}"
+                )
+            files.append((name, path))
+        
+        tenant = await resolve_tenant(username, request.domain)
+        job = job_manager.submit(
+            username, run_ingestion_job, tenant, files, request.rewrite, request.prune, key=tenant
+        )
+        return {
+            "status": True,
+            "message": "Processing started",
+            "job_id": job.id,
+            "events": f"/process/{job.id}/events"
+        }
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred: {str(e)}"
+        )
+
+def get_owned_job(job_id, username):
+    job = job_manager.get(job_id)
+    if job is None or job.owner != username:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+@app.get("/process/{job_id}")
+async def process_status(job_id: str, username: str = Depends(get_token_subject)):
+    """Current state of an ingestion job, with its result once finished"""
+    return get_owned_job(job_id, username).summary()
+
+@app.get("/process/{job_id}/events")
+async def process_events(
+    job_id: str,
+    request: Request,
+    cursor: int = 0,
+    format: str = "sse",
+    username: str = Depends(get_token_subject)
+):
+    """
+    Stream the events of an ingestion job as Server-Sent Events, or as NDJSON
+    with format=ndjson. The stream ends after the job's final event, or
+    after INGEST_EVENTS_TIMEOUT seconds.
+
+    A client that reconnects resumes after the last event it saw, given
+    either as ?cursor=<next event id> or, for SSE, the Last-Event-ID header.
+    """
+    job = get_owned_job(job_id, username)
+    if format not in ("sse", "ndjson"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="format must be sse or ndjson")
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        cursor = max(cursor, int(last_event_id) + 1)
+
+    async def stream():
+        position = max(cursor, 0)
+        idle = 0.0
+        deadline = time.monotonic() + INGEST_EVENTS_TIMEOUT
+        while time.monotonic() < deadline:
+            # Read the state first so events emitted just before finishing are not missed
+            finished = job.finished
+            events = job.events_since(position)
+            for event in events:
+                if format == "sse":
+                    yield f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+                else:
+                    yield json.dumps(event) + "\n"
+            position += len(events)
+            if finished and not job.events_since(position):
+                return
+            if events:
+                idle = 0.0
+            elif format == "sse" and idle >= 15:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                idle = 0.0
+            await asyncio.sleep(0.25)
+            idle += 0.25
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+MAX_SEARCH_QUERIES = int(os.getenv("MAX_SEARCH_QUERIES", "32"))
+MAX_SEARCH_K = int(os.getenv("MAX_SEARCH_K", "100"))
+
+@app.post("/search", status_code=status.HTTP_200_OK)
+async def search(request: SearchRequest, username: str = Depends(get_token_subject)):
+    """
+    Hybrid BM25 + vector search over the caller's ingested documents.
+
+    Accepts a batch of queries; budget_ms trades recall for latency.
+    """
+    try:
+        if not request.queries or len(request.queries) > MAX_SEARCH_QUERIES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Between 1 and {MAX_SEARCH_QUERIES} queries are allowed"
+            )
+        if not 1 <= request.k <= MAX_SEARCH_K:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"k must be between 1 and {MAX_SEARCH_K}"
+            )
+        if request.mode not in SEARCH_MODES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"mode must be one of: {', '.join(SEARCH_MODES)}"
+            )
+        if request.budget_ms is not None and request.budget_ms <= 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="budget_ms must be positive"
+            )
+        
+        tenant = await resolve_tenant(username, request.domain)
+        index = await run_in_threadpool(vector_stores.get, tenant)
+        found = await run_in_threadpool(
+            hybrid_search, index, embedder, request.queries, request.k,
+            mode=request.mode, budget_ms=request.budget_ms
         )
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username: str = payload.get("sub")
-            if username is None:
-                raise credentials_exception
-        except JWTError:
-            raise credentials_exception
-        
-        # You can implement actual file processing logic here
-        # For now, we'll just return success
         return {
             "status": True,
-            "message": "Files processed successfully",
-            "files_processed": len(request.files),
-            "rewrite_enabled": request.rewrite
+            "queries": [
+                {"query": query, "results": results}
+                for query, results in zip(request.queries, found["results"])
+            ],
+            "truncated": found["truncated"],
+            "took_ms": found["took_ms"]
         }
     except HTTPException as e:
         raise e
@@ -862,39 +1389,91 @@ async def process_files(request: FileProcess, token: str = Depends(oauth2_scheme
             detail=f"An error occurred: {str(e)}"
         )
 
-@app.options("/add_domain")
-async def options_add_domain():
-    return cors_options_response()
+# Domains and filter words are changed with atomic array union/remove
+# writes: one round trip, and concurrent changes can't overwrite each other
+MAX_BULK_ENTRIES = int(os.getenv("MAX_BULK_ENTRIES", "1000"))
+
+def clean_values(values):
+    """Strip entries and drop empty ones, keeping order"""
+    return [value.strip() for value in values if value and value.strip()]
+
+async def update_user_array(email, field, op, values):
+    """Apply one array update to a User document, 404 if it doesn't exist"""
+    try:
+        await datastore.run(datastore.backend.array_update, "User", email, field, op, values)
+    except DocumentNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Account not found"
+        )
+    finally:
+        user_cache.invalidate(email)
+
+async def bulk_update_user_arrays(field, additions, removals):
+    """
+    Apply (email, value) additions and removals to many User documents.
+
+    Values are grouped per user so each user costs one write per
+    operation, and the writes go out in batches. Removals are applied
+    after additions.
+
+    Returns:
+        Response dict with the number of users updated and the missing emails
+    """
+    if sum(len(values) for _, values in additions + removals) > MAX_BULK_ENTRIES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {MAX_BULK_ENTRIES} values per request"
+        )
+    ops = []
+    for op, entries in ((ARRAY_UNION, additions), (ARRAY_REMOVE, removals)):
+        grouped = {}
+        for email, values in entries:
+            grouped.setdefault(email, []).extend(clean_values(values))
+        ops.extend((email, field, op, values) for email, values in grouped.items() if values)
+    emails = {op[0] for op in ops}
+    missing = await datastore.run(datastore.backend.batch_array_update, "User", ops) if ops else set()
+    for email in emails:
+        user_cache.invalidate(email)
+    return {"updated": len(emails - missing), "missing": sorted(missing)}
+
+# Accounts allowed to use the admin and bulk endpoints
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv("ADMIN_EMAILS", "").split(",") if e.strip()}
+
+async def require_admin(username: str = Depends(get_token_subject)):
+    if username.lower() not in ADMIN_EMAILS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return username
+
+def require_own_account(email, username):
+    """403 unless email is the account of the authenticated caller"""
+    if email.lower() != username.lower():
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Cannot change another account"
+        )
 
 @app.post("/add_domain", status_code=status.HTTP_200_OK)
-async def add_domain(request: Domain):
-    """Add a domain for a user"""
+async def add_domain(request: Domain, username: str = Depends(get_token_subject)):
+    """Add a domain for the caller's account"""
     try:
+        require_own_account(request.email, username)
         email = request.email
         domain = request.domain
-        # Check if email exists
-        if not check_user_exists(email):
+        # Check if email exists; the cached record also answers "already added"
+        current_data = await datastore.run(get_user_record, email)
+        if current_data is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Account not found"
             )
-        
-        # Store the domain in Firestore
-        user_ref = firest.collection("User").document(email)
-        user_doc = user_ref.get()
-        if user_doc.exists:
-            current_data = user_doc.to_dict()
-            domains = current_data.get('domains', [])
-        else:
-            domains = []
-        
-        # Check if domain already exists
-        if domain in domains:
+        if domain in current_data.get('domains', []):
             return {"message": "Domain already added for this user"}
         
-        # Add new domain
-        domains.append(domain)
-        user_ref.update({"domains": domains})
+        await update_user_array(email, "domains", ARRAY_UNION, [domain])
         return {"message": "Domain added successfully"}
     except HTTPException as e:
         raise e
@@ -904,9 +1483,98 @@ async def add_domain(request: Domain):
             detail=f"An error occurred: {str(e)}"
         )
 
-@app.options("/get_filterwords")
-async def options_get_filterwords():
-    return cors_options_response()
+@app.post("/remove_domain", status_code=status.HTTP_200_OK)
+async def remove_domain(request: Domain, username: str = Depends(get_token_subject)):
+    """Remove a domain from the caller's account"""
+    try:
+        require_own_account(request.email, username)
+        await update_user_array(request.email, "domains", ARRAY_REMOVE, [request.domain])
+        return {"message": "Domain removed successfully"}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred: {str(e)}"
+        )
+
+@app.post("/bulk_domains", status_code=status.HTTP_200_OK)
+async def bulk_domains(request: BulkDomains, admin: str = Depends(require_admin)):
+    """Add and remove domains for many users in batched writes"""
+    try:
+        result = await bulk_update_user_arrays(
+            "domains",
+            [(entry.email, [entry.domain]) for entry in request.add],
+            [(entry.email, [entry.domain]) for entry in request.remove],
+        )
+        return {"message": "Domains updated", **result}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred: {str(e)}"
+        )
+
+@app.post("/add_filterwords", status_code=status.HTTP_200_OK)
+async def add_filter_words(request: FilterWordsUpdate, username: str = Depends(get_token_subject)):
+    """Add filter words for the caller's account"""
+    try:
+        require_own_account(request.email, username)
+        words = clean_values(request.words)
+        if not words:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No filter words given"
+            )
+        await update_user_array(request.email, "filter_words", ARRAY_UNION, words)
+        return {"message": "Filter words added successfully"}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred: {str(e)}"
+        )
+
+@app.post("/remove_filterwords", status_code=status.HTTP_200_OK)
+async def remove_filter_words(request: FilterWordsUpdate, username: str = Depends(get_token_subject)):
+    """Remove filter words from the caller's account"""
+    try:
+        require_own_account(request.email, username)
+        words = clean_values(request.words)
+        if not words:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No filter words given"
+            )
+        await update_user_array(request.email, "filter_words", ARRAY_REMOVE, words)
+        return {"message": "Filter words removed successfully"}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred: {str(e)}"
+        )
+
+@app.post("/bulk_filterwords", status_code=status.HTTP_200_OK)
+async def bulk_filter_words(request: BulkFilterWords, admin: str = Depends(require_admin)):
+    """Add and remove filter words for many users in batched writes"""
+    try:
+        result = await bulk_update_user_arrays(
+            "filter_words",
+            [(entry.email, entry.words) for entry in request.add],
+            [(entry.email, entry.words) for entry in request.remove],
+        )
+        return {"message": "Filter words updated", **result}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred: {str(e)}"
+        )
 
 @app.post("/get_filterwords", status_code=status.HTTP_200_OK)
 async def get_filter_words(request: FilterWords):
@@ -914,16 +1582,14 @@ async def get_filter_words(request: FilterWords):
     try:
         email = request.email
         # Check if email exists
-        if not check_user_exists(email):
+        if not await datastore.run(check_user_exists, email):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Account not found"
             )
         
-        user_ref = firest.collection("User").document(email)
-        user_doc = user_ref.get()
-        if user_doc.exists:
-            current_data = user_doc.to_dict()
+        current_data = await datastore.run(get_user_record, email)
+        if current_data is not None:
             filter_words = current_data.get('filter_words', [])
         else:
             filter_words = []
@@ -939,11 +1605,309 @@ async def get_filter_words(request: FilterWords):
             detail=f"An error occurred: {str(e)}"
         )
 
+# Admin endpoints
+# Documents per batched write, and bcrypt hashes in flight, during an import
+IMPORT_BATCH = min(int(os.getenv("IMPORT_BATCH", "500")), 500)
+IMPORT_HASH_CONCURRENCY = int(os.getenv("IMPORT_HASH_CONCURRENCY", "0")) or password_hasher.max_workers
+# Errors listed in an import response; the counts cover all of them
+IMPORT_MAX_REPORTED_ERRORS = 100
+# User fields never included in an export
+EXPORT_EXCLUDED_FIELDS = {"password", "apikey"}
+
+@app.post("/admin/users/{email}/member_domains", status_code=status.HTTP_200_OK)
+async def admin_domain_membership(email: str, request: DomainMembership, admin: str = Depends(require_admin)):
+    """Grant or withdraw a user's access to a domain's documents"""
+    try:
+        domain = normalize_domain(request.domain)
+        op = ARRAY_REMOVE if request.remove else ARRAY_UNION
+        await update_user_array(email, "member_domains", op, [domain])
+        logger.info("Admin %s %s %s membership of %s", admin,
+                    "withdrew" if request.remove else "granted", email, domain)
+        return {"status": True, "message": "Membership updated", "domain": domain}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.exception("Error updating domain membership: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to update membership"
+        )
+
+@app.post("/revoke_tokens", status_code=status.HTTP_200_OK)
+async def revoke_tokens(username: str = Depends(get_token_subject)):
+    """Sign out everywhere: revoke every token issued to the caller, including this one"""
+    try:
+        await datastore.run(revoke_user_tokens, username)
+        return {"status": True, "message": "All tokens revoked"}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.exception("Error revoking tokens: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to revoke tokens"
+        )
+
+@app.post("/admin/users/{email}/revoke_tokens", status_code=status.HTTP_200_OK)
+async def admin_revoke_tokens(email: str, admin: str = Depends(require_admin)):
+    """Revoke every token issued to a user, e.g. after their account was compromised"""
+    try:
+        if not await datastore.run(revoke_user_tokens, email):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Account not found"
+            )
+        logger.info("Admin %s revoked the tokens of %s", admin, email)
+        return {"status": True, "message": "All tokens revoked"}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.exception("Error revoking tokens: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to revoke tokens"
+        )
+
+async def hash_for_import(password):
+    """Hash in the shared pool, backing off instead of failing when it is busy with logins"""
+    while True:
+        try:
+            return await password_hasher.hash_async(password)
+        except PoolSaturated as e:
+            await asyncio.sleep(e.retry_after)
+
+async def prepare_import_record(line_number, record):
+    """Validate a record like /signup does and hash its password; returns (line, email, document)"""
+    user = SignUp(
+        email=record.get("email"),
+        password=record.get("password"),
+        username=record.get("username"),
+    )
+    domains = record.get("domains") or []
+    if not isinstance(domains, list) or not all(isinstance(d, str) for d in domains):
+        raise ValueError("domains must be a list of strings")
+    document = {
+        "email": user.email,
+        "password": await hash_for_import(user.password),
+        "username": user.username,
+        "disabled": False,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    if domains:
+        document["domains"] = domains
+    return line_number, user.email, document
+
+@app.post("/admin/users/import", status_code=status.HTTP_200_OK)
+async def import_users(request: Request, format: Optional[str] = None, admin: str = Depends(require_admin)):
+    """
+    Create users from a CSV or NDJSON request body, streamed.
+
+    Each record needs email, password and username (validated like
+    /signup) and may have domains. Passwords are hashed in the bcrypt pool
+    with IMPORT_HASH_CONCURRENCY in flight, and documents are created in
+    batched writes of IMPORT_BATCH; existing users are never overwritten.
+    """
+    fmt = (format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")).lower()
+    if fmt not in IMPORT_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"format must be one of {', '.join(IMPORT_FORMATS)}"
+        )
+
+    counts = {"imported": 0, "existing": 0, "invalid": 0}
+    errors = []
+    batch = {}
+    pending = set()
+
+    def report(line_number, kind, error, email=None):
+        counts[kind] += 1
+        if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+            entry = {"line": line_number, "error": error}
+            if email:
+                entry["email"] = email
+            errors.append(entry)
+
+    async def flush():
+        docs = [(email, document) for email, (_, document) in batch.items()]
+        existing = await datastore.run(datastore.backend.batch_create, "User", docs)
+        for email, (line_number, _) in batch.items():
+            user_cache.invalidate(email)
+            if email in existing:
+                report(line_number, "existing", "User already exists", email)
+            else:
+                counts["imported"] += 1
+        batch.clear()
+
+    async def collect(tasks):
+        for task in tasks:
+            try:
+                line_number, email, document = task.result()
+            except (ValidationError, ValueError) as e:
+                errors_text = "; ".join(err["msg"] for err in e.errors()) if isinstance(e, ValidationError) else str(e)
+                report(task.line_number, "invalid", errors_text)
+                continue
+            if email in batch:
+                report(line_number, "existing", "Duplicate email in import", email)
+                continue
+            batch[email] = (line_number, document)
+            if len(batch) >= IMPORT_BATCH:
+                await flush()
+
+    try:
+        async for line_number, record, error in iter_records(iter_lines(request.stream()), fmt):
+            if error:
+                report(line_number, "invalid", error)
+                continue
+            task = asyncio.ensure_future(prepare_import_record(line_number, record))
+            task.line_number = line_number
+            pending.add(task)
+            # Keep the hashing pool busy without reading the whole body ahead
+            if len(pending) >= IMPORT_HASH_CONCURRENCY:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                await collect(done)
+        if pending:
+            done, pending = await asyncio.wait(pending)
+            await collect(done)
+        if batch:
+            await flush()
+    except LineTooLong as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.exception("User import failed: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Import failed after {counts['imported']} users: {str(e)}"
+        )
+    finally:
+        for task in pending:
+            task.cancel()
+
+    logger.info("Admin %s imported %d users (%d existing, %d invalid)",
+                admin, counts["imported"], counts["existing"], counts["invalid"])
+    return {**counts, "errors": errors}
+
+@app.get("/admin/users/export")
+async def export_users(domain: Optional[str] = None, page_size: int = 500, admin: str = Depends(require_admin)):
+    """
+    Stream users as NDJSON, optionally only those with the given domain.
+
+    The collection is read page by page with query cursors, so memory use
+    does not depend on how many users there are. Password hashes and API
+    keys are left out.
+    """
+    page_size = max(1, min(page_size, 1000))
+    array_contains = ("domains", domain) if domain else None
+
+    async def stream():
+        cursor = None
+        while True:
+            try:
+                page, cursor = await datastore.run(
+                    datastore.backend.scan, "User", page_size, cursor, array_contains
+                )
+            except Exception as e:
+                # Headers are already sent, so report the failure in-band
+                logger.exception("User export failed: %s", e)
+                yield json.dumps({"error": "Export failed"}) + "\n"
+                return
+            if page:
+                yield "".join(
+                    json.dumps({"email": doc_id, **{key: value for key, value in data.items()
+                                                    if key not in EXPORT_EXCLUDED_FIELDS}}, default=str) + "\n"
+                    for doc_id, data in page
+                )
+            if len(page) < page_size:
+                return
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 @app.get("/health")
 def health_check():
     """Simple endpoint to check if the API is running"""
     return PlainTextResponse("OK")
 
+# Readiness is cached so frequent probes don't each cost two Firestore writes
+READY_CACHE_TTL = float(os.getenv("READY_CACHE_TTL", "30"))
+_readiness = {"checked_at": None, "result": None}
+_readiness_lock = asyncio.Lock()
+
+async def run_readiness_checks():
+    checks = {}
+    if use_memory_backend():
+        checks["datastore"] = {"ok": True, "backend": "memory"}
+    else:
+        started = time.perf_counter()
+        try:
+            await datastore.run(check_firestore_connection)
+            checks["datastore"] = {"ok": True, "backend": "firestore"}
+        except Exception as e:
+            logger.warning("Readiness check failed: %s", e)
+            checks["datastore"] = {"ok": False, "backend": "firestore", "error": str(e)}
+        checks["datastore"]["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return checks
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe: verifies Firestore connectivity, caching the result for READY_CACHE_TTL seconds"""
+    async with _readiness_lock:
+        checked_at = _readiness["checked_at"]
+        if checked_at is None or time.monotonic() - checked_at > READY_CACHE_TTL:
+            _readiness["result"] = await run_readiness_checks()
+            _readiness["checked_at"] = time.monotonic()
+        checks = _readiness["result"]
+        age = time.monotonic() - _readiness["checked_at"]
+    ready = all(check["ok"] for check in checks.values())
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={
+            "ready": ready,
+            "checks": checks,
+            "checked_seconds_ago": round(age, 1),
+            "startup": startup,
+        }
+    )
+
+# /metrics is unauthenticated so Prometheus can scrape it, and it reveals
+# traffic, error and queue figures: expose it only to the scrape network,
+# e.g. by not routing the path through the public proxy
+@app.get("/metrics")
+def metrics():
+    """Request, datastore, bcrypt and SMTP metrics in Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/email_status/{message_id}")
+def email_status(message_id: str):
+    """Delivery status of a queued email"""
+    email = mailer.status(message_id)
+    if email is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown email id"
+        )
+    return email
+
+@app.get("/cache_stats")
+def cache_stats(admin: str = Depends(require_admin)):
+    """Cache, pool, queue and limiter internals of this worker, for admins"""
+    return {
+        "user_cache": user_cache.stats(),
+        "password_pool": password_hasher.stats(),
+        "write_behind": write_behind.stats(),
+        "token_cache": token_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "logging": logging_stats(),
+        "otp_store": otp_store.stats(),
+        "sweeper": sweeper.stats(),
+        "otp_requests": otp_requests.stats(),
+        "admission": admission.stats(),
+        "rate_limits": {f"{policy}_{kind}": limiter.stats() for (policy, kind), limiter in rate_limiters.items()},
+    }
+
 # Landing page routes - these should be called before authentication
 @app.get("/landing/about")
 async def landing_about():
@@ -967,5 +1931,20 @@ async def redirect_to_auth():
     # This endpoint can be called from landing pages to redirect to auth
     return RedirectResponse(url="/auth/login")
 
+def reinit_after_fork():
+    """
+    Prepare a gunicorn worker forked from the preloaded app (see
+    gunicorn.conf.py). Everything else created at import is fork-safe or
+    started lazily inside the worker.
+    """
+    restart_logging_after_fork()
+    embedding_cache.reopen()
+
+startup = {"import_ms": round((time.perf_counter() - _import_started) * 1000, 1), "ready_ms": None}
+
 if __name__ == "__main__":
+    # Development server with auto-reload; in production run `gunicorn main:app`
+    # from this directory, configured by gunicorn.conf.py
+    import uvicorn
+
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+from utils.metrics import REGISTRY
+
+ADMISSION_QUEUE_SECONDS = REGISTRY.histogram(
+    "aria_admission_queue_seconds", "Time requests waited for a concurrency slot", ("pool", "lane")
+)
+ADMISSION_REJECTED = REGISTRY.counter(
+    "aria_admission_rejected_total", "Requests shed with 503", ("pool", "lane", "reason")
+)
+ADMISSION_ACTIVE = REGISTRY.gauge(
+    "aria_admission_active", "Requests holding a concurrency slot", ("pool",)
+)
+
+
+class _Pool:
+    """
+    Concurrency slots of one pool plus its two wait queues.
+
+    Only used from the event loop thread, so it needs no locking. A freed
+    slot is handed straight to the next waiter, priority lane first.
+    """
+
+    def __init__(self, name, limit, queue_size):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiters = {True: deque(), False: deque()}
+        self.admitted = 0
+        self.rejected = 0
+        self._active_gauge = ADMISSION_ACTIVE.labels(name)
+
+    def _take(self):
+        self.active += 1
+        self.admitted += 1
+        self._active_gauge.inc()
+
+    async def acquire(self, priority, timeout):
+        """Wait for a slot; returns None when admitted, else the rejection reason."""
+        if self.active < self.limit and not self.waiters[True] and not self.waiters[False]:
+            self._take()
+            return None
+        queue = self.waiters[priority]
+        if len(queue) >= self.queue_size:
+            return "queue_full"
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        queue.append(waiter)
+        timer = loop.call_later(timeout, self._expire, queue, waiter)
+        try:
+            admitted = await waiter
+        except asyncio.CancelledError:
+            # Client went away; give back a slot that was granted meanwhile
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                self.release()
+            elif waiter in queue:
+                queue.remove(waiter)
+            raise
+        finally:
+            timer.cancel()
+        return None if admitted else "timeout"
+
+    @staticmethod
+    def _expire(queue, waiter):
+        if not waiter.done():
+            queue.remove(waiter)
+            waiter.set_result(False)
+
+    def release(self):
+        for lane in (True, False):
+            queue = self.waiters[lane]
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    # The slot passes to the waiter, so active stays the same
+                    self.admitted += 1
+                    waiter.set_result(True)
+                    return
+        self.active -= 1
+        self._active_gauge.inc(-1)
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": len(self.waiters[True]) + len(self.waiters[False]),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+class AdmissionController:
+    """
+    Per-route concurrency limits with bounded, deadline-limited wait queues.
+
+    A request takes a slot in the pool of its path (route_limits) or in the
+    default pool. When the pool is full it waits in a queue of at most
+    queue_size requests for up to queue_timeout seconds; beyond either it
+    is shed with a 503 and Retry-After, instead of piling up until clients
+    time out. Priority requests have their own queue and are handed freed
+    slots first. Exempt paths are never limited.
+
+    Args:
+        max_concurrency: Slots of the default pool
+        route_limits: Dict of exact path -> slots for paths with their own pool
+        queue_size: Maximum waiting requests per pool and lane
+        queue_timeout: Seconds a request may wait for a slot
+        retry_after: Value of the Retry-After header on 503s
+        exempt: Callable(path) -> True for paths that bypass admission
+        is_priority: Callable(scope) -> True for requests in the priority lane
+    """
+
+    def __init__(self, max_concurrency=256, route_limits=None, queue_size=512, queue_timeout=2.0,
+                 retry_after=1, exempt=None, is_priority=None):
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.exempt = exempt or (lambda path: False)
+        self.is_priority = is_priority or (lambda scope: False)
+        self.default_pool = _Pool("default", max_concurrency, queue_size)
+        self.route_pools = {
+            path: _Pool(path, limit, queue_size) for path, limit in (route_limits or {}).items()
+        }
+
+    def pool_for(self, path):
+        return self.route_pools.get(path, self.default_pool)
+
+    def stats(self):
+        pools = {"default": self.default_pool.stats()}
+        for path, pool in self.route_pools.items():
+            pools[path] = pool.stats()
+        return pools
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware applying an AdmissionController to HTTP requests."""
+
+    def __init__(self, app, controller):
+        self.app = app
+        self.controller = controller
+        self._busy_body = json.dumps({"detail": "Server is busy, please retry shortly"}).encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or self.controller.exempt(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        pool = self.controller.pool_for(scope["path"])
+        priority = self.controller.is_priority(scope)
+        lane = "priority" if priority else "normal"
+        started = time.perf_counter()
+        reason = await pool.acquire(priority, self.controller.queue_timeout)
+        ADMISSION_QUEUE_SECONDS.labels(pool.name, lane).observe(time.perf_counter() - started)
+        if reason is not None:
+            pool.rejected += 1
+            ADMISSION_REJECTED.labels(pool.name, lane, reason).inc()
+            await self._reject(send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            pool.release()
+
+    async def _reject(self, send):
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(self._busy_body)).encode()),
+                (b"retry-after", str(self.controller.retry_after).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": self._busy_body})
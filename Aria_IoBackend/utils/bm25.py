@@ -0,0 +1,195 @@
+import math
+import os
+import re
+import threading
+import time
+from array import array
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"\w+")
+
+# Fraction of deleted documents still referenced by postings that triggers compaction
+COMPACT_DELETED_FRACTION = 0.2
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Incremental inverted index with Okapi BM25 scoring.
+
+    Each term's postings are two parallel typed arrays (chunk ids as int64,
+    term frequencies as uint16), so the index costs about 10 bytes per
+    posting instead of a Python object per entry, and scoring runs over
+    numpy views of them. Document lengths are an array indexed by chunk id.
+
+    Deleted chunks get a length of 0 and are skipped when scoring; their
+    postings are dropped when save() compacts the index.
+
+    Args:
+        path: .npz file the index is persisted to
+        k1: BM25 term-frequency saturation
+        b: BM25 length normalisation
+        load: Load the index from path if it exists, False to start empty
+    """
+
+    def __init__(self, path, k1=1.2, b=0.75, load=True):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._doc_lens = array("I")
+        self._docs = 0
+        self._total_len = 0
+        self._deleted = 0
+        self._dirty = False
+        if load and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with np.load(self.path) as data:
+            terms = data["terms"].tobytes().decode("utf-8").split("\n") if data["terms"].size else []
+            offsets = data["offsets"]
+            ids = data["ids"]
+            tfs = data["tfs"]
+            self._doc_lens = array("I", data["doc_lens"].tobytes())
+        for number, term in enumerate(terms):
+            start, stop = offsets[number], offsets[number + 1]
+            self._postings[term] = (array("q", ids[start:stop].tobytes()), array("H", tfs[start:stop].tobytes()))
+        lens = np.frombuffer(self._doc_lens, dtype=np.uint32)
+        self._docs = int(np.count_nonzero(lens))
+        self._total_len = int(lens.sum(dtype=np.int64))
+
+    def __len__(self):
+        return self._docs
+
+    def add(self, ids, texts):
+        """Index texts under the given chunk ids."""
+        with self._lock:
+            for chunk_id, text in zip(ids, texts):
+                chunk_id = int(chunk_id)
+                counts = {}
+                for token in tokenize(text):
+                    counts[token] = counts.get(token, 0) + 1
+                # Chunks without word tokens still count as documents, so the
+                # index stays in step with the chunk table
+                length = max(sum(counts.values()), 1)
+                if chunk_id >= len(self._doc_lens):
+                    self._doc_lens.extend([0] * (chunk_id + 1 - len(self._doc_lens)))
+                self._doc_lens[chunk_id] = length
+                for term, tf in counts.items():
+                    postings = self._postings.get(term)
+                    if postings is None:
+                        postings = self._postings[term] = (array("q"), array("H"))
+                    postings[0].append(chunk_id)
+                    postings[1].append(min(tf, 65535))
+                self._docs += 1
+                self._total_len += length
+            self._dirty = True
+
+    def delete(self, ids):
+        with self._lock:
+            for chunk_id in ids:
+                chunk_id = int(chunk_id)
+                if chunk_id < len(self._doc_lens) and self._doc_lens[chunk_id]:
+                    self._total_len -= self._doc_lens[chunk_id]
+                    self._doc_lens[chunk_id] = 0
+                    self._docs -= 1
+                    self._deleted += 1
+                    self._dirty = True
+
+    def search(self, query, k=10, deadline=None):
+        """
+        Top-k chunks for a query.
+
+        Terms are scored rarest first. When deadline (a time.monotonic()
+        value) passes, the remaining, most common terms are skipped: they
+        have the longest postings and contribute the least to the score.
+
+        Returns:
+            (hits, truncated): a list of (chunk_id, score) tuples, best
+            first, and whether terms were skipped
+        """
+        with self._lock:
+            if not self._docs:
+                return [], False
+            terms = [t for t in dict.fromkeys(tokenize(query)) if t in self._postings]
+            terms.sort(key=lambda t: len(self._postings[t][0]))
+            doc_lens = np.frombuffer(self._doc_lens, dtype=np.uint32)
+            avgdl = self._total_len / self._docs
+            all_ids, all_scores = [], []
+            truncated = False
+            for term in terms:
+                if deadline is not None and all_ids and time.monotonic() > deadline:
+                    truncated = True
+                    break
+                ids_buf, tfs_buf = self._postings[term]
+                ids = np.frombuffer(ids_buf, dtype=np.int64)
+                tfs = np.frombuffer(tfs_buf, dtype=np.uint16).astype(np.float32)
+                lens = doc_lens[ids]
+                live = lens > 0
+                ids, tfs, lens = ids[live], tfs[live], lens[live]
+                if not len(ids):
+                    continue
+                idf = math.log(1 + (self._docs - len(ids) + 0.5) / (len(ids) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * lens / avgdl)
+                all_ids.append(ids)
+                all_scores.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+            del doc_lens
+        if not all_ids:
+            return [], truncated
+        unique, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(unique[i]), float(scores[i])) for i in top], truncated
+
+    def save(self):
+        """Persist the index if it changed, compacting away deleted postings first."""
+        with self._lock:
+            if not self._dirty:
+                return False
+            doc_lens = np.frombuffer(self._doc_lens, dtype=np.uint32)
+            if self._deleted > COMPACT_DELETED_FRACTION * max(self._docs, 1):
+                self._compact(doc_lens)
+            terms = list(self._postings)
+            sizes = [len(self._postings[t][0]) for t in terms]
+            offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+            np.cumsum(sizes, out=offsets[1:])
+            ids = np.frombuffer(b"".join(self._postings[t][0].tobytes() for t in terms), dtype=np.int64)
+            tfs = np.frombuffer(b"".join(self._postings[t][1].tobytes() for t in terms), dtype=np.uint16)
+            encoded = np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, terms=encoded, offsets=offsets, ids=ids, tfs=tfs, doc_lens=doc_lens.copy())
+            del doc_lens
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+            return True
+
+    def _compact(self, doc_lens):
+        for term in list(self._postings):
+            ids_buf, tfs_buf = self._postings[term]
+            ids = np.frombuffer(ids_buf, dtype=np.int64)
+            live = doc_lens[ids] > 0
+            if live.all():
+                continue
+            if not live.any():
+                del self._postings[term]
+                continue
+            tfs = np.frombuffer(tfs_buf, dtype=np.uint16)
+            self._postings[term] = (array("q", ids[live].tobytes()), array("H", tfs[live].tobytes()))
+        self._deleted = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "documents": self._docs,
+                "terms": len(self._postings),
+                "postings": sum(len(ids) for ids, _ in self._postings.values()),
+                "deleted": self._deleted,
+            }
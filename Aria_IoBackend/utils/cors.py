@@ -0,0 +1,150 @@
+from collections import OrderedDict
+
+
+def _join(values):
+    return ", ".join(values).encode("latin-1")
+
+
+class CORSMiddleware:
+    """
+    Pure ASGI CORS middleware.
+
+    All header names and values are encoded once at startup. Simple
+    requests only get a few header tuples appended to the response start
+    message, and preflight responses are built once per distinct
+    (origin, method, requested headers) and served from a small LRU, so
+    preflights never reach the application.
+
+    Requests without an Origin header pass through untouched.
+
+    Args:
+        app: ASGI application
+        allow_origins: Allowed origins, or ["*"]
+        allow_methods: Methods allowed in preflights, or ["*"]
+        allow_headers: Request headers allowed in preflights, or ["*"]
+        allow_credentials: Send Access-Control-Allow-Credentials. With
+            allow_origins=["*"] the request's origin is echoed back, since
+            browsers reject "*" on credentialed requests
+        expose_headers: Response headers readable by the browser
+        max_age: Seconds browsers may cache a preflight
+        preflight_cache_size: Distinct preflight responses kept
+    """
+
+    def __init__(
+        self,
+        app,
+        allow_origins=("*",),
+        allow_methods=("GET", "POST", "PUT", "DELETE", "OPTIONS"),
+        allow_headers=("*",),
+        allow_credentials=True,
+        expose_headers=(),
+        max_age=86400,
+        preflight_cache_size=256,
+    ):
+        self.app = app
+        self.allow_all_origins = "*" in allow_origins
+        self.allow_origins = frozenset(origin.encode("latin-1") for origin in allow_origins)
+        self.allow_all_methods = "*" in allow_methods
+        self.allow_methods = frozenset(method.upper().encode("latin-1") for method in allow_methods)
+        self.allow_all_headers = "*" in allow_headers
+        self.allow_headers = frozenset(header.lower() for header in allow_headers)
+        self.preflight_cache_size = preflight_cache_size
+        # Origin is only "*" when it doesn't have to be echoed
+        self.echo_origin = not self.allow_all_origins or allow_credentials
+
+        common = []
+        if allow_credentials:
+            common.append((b"access-control-allow-credentials", b"true"))
+        self._simple_headers = list(common)
+        if expose_headers:
+            self._simple_headers.append((b"access-control-expose-headers", _join(expose_headers)))
+        if not self.echo_origin:
+            self._simple_headers.insert(0, (b"access-control-allow-origin", b"*"))
+
+        methods = sorted(self.allow_methods) if not self.allow_all_methods else [
+            b"DELETE", b"GET", b"HEAD", b"OPTIONS", b"PATCH", b"POST", b"PUT"
+        ]
+        self._preflight_headers = common + [
+            (b"access-control-allow-methods", b", ".join(methods)),
+            (b"access-control-max-age", str(max_age).encode()),
+            (b"content-length", b"0"),
+        ]
+        if not self.allow_all_headers:
+            self._preflight_headers.append((b"access-control-allow-headers", _join(allow_headers)))
+        self._preflight_cache = OrderedDict()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        origin = request_method = request_headers = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+            elif name == b"access-control-request-method":
+                request_method = value
+            elif name == b"access-control-request-headers":
+                request_headers = value
+
+        if origin is None:
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] == "OPTIONS" and request_method is not None:
+            await self._preflight(origin, request_method, request_headers or b"", send)
+            return
+        if not self.allow_all_origins and origin not in self.allow_origins:
+            await self.app(scope, receive, send)
+            return
+
+        if self.echo_origin:
+            extra = [(b"access-control-allow-origin", origin), (b"vary", b"Origin"), *self._simple_headers]
+        else:
+            extra = self._simple_headers
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *extra]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+    async def _preflight(self, origin, request_method, request_headers, send):
+        key = (origin if self.echo_origin else b"*", request_method, request_headers)
+        response = self._preflight_cache.get(key)
+        if response is None:
+            response = self._build_preflight(origin, request_method, request_headers)
+            self._preflight_cache[key] = response
+            if len(self._preflight_cache) > self.preflight_cache_size:
+                self._preflight_cache.popitem(last=False)
+        else:
+            self._preflight_cache.move_to_end(key)
+        status, headers, body = response
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    def _build_preflight(self, origin, request_method, request_headers):
+        failures = []
+        if not self.allow_all_origins and origin not in self.allow_origins:
+            failures.append("origin")
+        if not self.allow_all_methods and request_method.upper() not in self.allow_methods:
+            failures.append("method")
+        requested = [h.strip() for h in request_headers.decode("latin-1").lower().split(",") if h.strip()]
+        if not self.allow_all_headers and any(h not in self.allow_headers for h in requested):
+            failures.append("headers")
+        if failures:
+            body = f"Disallowed CORS {', '.join(failures)}".encode()
+            return 400, [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ], body
+
+        headers = list(self._preflight_headers)
+        if self.echo_origin:
+            headers[:0] = [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+        else:
+            headers.insert(0, (b"access-control-allow-origin", b"*"))
+        if self.allow_all_headers and request_headers:
+            # Wildcard header lists are ignored on credentialed requests, so echo them
+            headers.append((b"access-control-allow-headers", request_headers))
+        return 200, headers, b""
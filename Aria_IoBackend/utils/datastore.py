@@ -0,0 +1,528 @@
+import asyncio
+import copy
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from utils.metrics import DATASTORE_ERRORS, DATASTORE_SECONDS
+
+
+class DocumentNotFound(Exception):
+    """Raised when updating a document that does not exist."""
+
+
+ARRAY_UNION = "union"
+ARRAY_REMOVE = "remove"
+# Firestore rejects batched writes with more operations than this
+MAX_BATCH_WRITES = 500
+
+
+class FirestoreBackend:
+    """
+    Document access on top of the synchronous firebase_admin Firestore client.
+
+    Every method performs blocking network I/O, so async code must go through
+    DataStore rather than calling these directly.
+
+    Args:
+        client: Firestore client, or a callable returning one. A callable is
+            only invoked on first use, so the SDK isn't initialised until a
+            document is actually read or written.
+    """
+
+    def __init__(self, client):
+        self._client = None if callable(client) else client
+        self._client_factory = client if callable(client) else None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._client_factory()
+        return self._client
+
+    def get(self, collection, doc_id):
+        doc = self.client.collection(collection).document(doc_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def set(self, collection, doc_id, data, transactional=False):
+        doc_ref = self.client.collection(collection).document(doc_id)
+        if not transactional:
+            doc_ref.set(data)
+            return True
+
+        from firebase_admin import firestore
+
+        @firestore.transactional
+        def set_in_transaction(transaction, doc_ref, data):
+            transaction.set(doc_ref, data)
+            return True
+
+        return set_in_transaction(self.client.transaction(), doc_ref, data)
+
+    def update(self, collection, doc_id, data):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            self.client.collection(collection).document(doc_id).update(data)
+        except NotFound as e:
+            raise DocumentNotFound(f"{collection}/{doc_id}") from e
+        return True
+
+    def update_if(self, collection, doc_id, predicate, data):
+        """
+        Atomically apply data to a document if predicate(document) holds.
+
+        Returns:
+            True if the document existed, matched and was updated
+        """
+        from firebase_admin import firestore
+
+        doc_ref = self.client.collection(collection).document(doc_id)
+
+        @firestore.transactional
+        def update_in_transaction(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists or not predicate(snapshot.to_dict()):
+                return False
+            transaction.update(doc_ref, data)
+            return True
+
+        return update_in_transaction(self.client.transaction())
+
+    def delete(self, collection, doc_id):
+        self.client.collection(collection).document(doc_id).delete()
+        return True
+
+    def batch_update(self, updates):
+        """Apply (collection, doc_id, data) updates in one batched write, skipping missing documents."""
+        from google.api_core.exceptions import NotFound
+
+        batch = self.client.batch()
+        for collection, doc_id, data in updates:
+            batch.update(self.client.collection(collection).document(doc_id), data)
+        try:
+            batch.commit()
+        except NotFound:
+            # A single missing document fails the whole batch
+            for collection, doc_id, data in updates:
+                try:
+                    self.update(collection, doc_id, data)
+                except DocumentNotFound:
+                    pass
+        return True
+
+    @staticmethod
+    def _array_transform(op, values):
+        from firebase_admin import firestore
+
+        return firestore.ArrayUnion(list(values)) if op == ARRAY_UNION else firestore.ArrayRemove(list(values))
+
+    def array_update(self, collection, doc_id, field, op, values):
+        """
+        Atomically add (ARRAY_UNION) or remove (ARRAY_REMOVE) values in an array field.
+
+        Raises:
+            DocumentNotFound: If the document does not exist
+        """
+        return self.update(collection, doc_id, {field: self._array_transform(op, values)})
+
+    def increment(self, collection, doc_id, field, amount=1):
+        """
+        Atomically add amount to a numeric field (a missing field counts as 0).
+
+        Raises:
+            DocumentNotFound: If the document does not exist
+        """
+        from firebase_admin import firestore
+
+        return self.update(collection, doc_id, {field: firestore.Increment(amount)})
+
+    def batch_array_update(self, collection, ops):
+        """
+        Apply (doc_id, field, op, values) array updates in batched writes.
+
+        Returns:
+            Set of doc_ids that do not exist; their updates are skipped
+        """
+        from google.api_core.exceptions import NotFound
+
+        missing = set()
+        for start in range(0, len(ops), MAX_BATCH_WRITES):
+            chunk = ops[start:start + MAX_BATCH_WRITES]
+            batch = self.client.batch()
+            for doc_id, field, op, values in chunk:
+                batch.update(self.client.collection(collection).document(doc_id),
+                             {field: self._array_transform(op, values)})
+            try:
+                batch.commit()
+            except NotFound:
+                # A single missing document fails the whole batch
+                for doc_id, field, op, values in chunk:
+                    try:
+                        self.array_update(collection, doc_id, field, op, values)
+                    except DocumentNotFound:
+                        missing.add(doc_id)
+        return missing
+
+    def batch_create(self, collection, docs):
+        """
+        Create (doc_id, data) documents in batched writes, never overwriting.
+
+        Returns:
+            Set of doc_ids that already existed and were left untouched
+        """
+        from google.api_core.exceptions import Conflict
+
+        existing = set()
+        for start in range(0, len(docs), MAX_BATCH_WRITES):
+            chunk = docs[start:start + MAX_BATCH_WRITES]
+            batch = self.client.batch()
+            for doc_id, data in chunk:
+                batch.create(self.client.collection(collection).document(doc_id), data)
+            try:
+                batch.commit()
+            except Conflict:
+                # A single existing document fails the whole batch
+                for doc_id, data in chunk:
+                    try:
+                        self.client.collection(collection).document(doc_id).create(data)
+                    except Conflict:
+                        existing.add(doc_id)
+        return existing
+
+    def scan(self, collection, limit, cursor=None, array_contains=None):
+        """
+        One page of documents in document id order.
+
+        Args:
+            array_contains: Optional (field, value) the documents must match
+
+        Returns:
+            Tuple ([(doc_id, data)], cursor); pass the cursor back to get the
+            next page. It is None when the page is empty.
+        """
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        query = self.client.collection(collection)
+        if array_contains is not None:
+            field, value = array_contains
+            query = query.where(filter=FieldFilter(field, "array_contains", value))
+        query = query.order_by("__name__").limit(limit)
+        if cursor is not None:
+            query = query.start_after(cursor)
+        snapshots = list(query.stream())
+        page = [(snapshot.id, snapshot.to_dict()) for snapshot in snapshots]
+        return page, (snapshots[-1] if snapshots else None)
+
+    def scan_before(self, collection, field, value, limit, cursor=None):
+        """
+        One page of documents whose field sorts before value, in field order.
+
+        Returns:
+            Tuple (doc_ids, cursor); pass the cursor back to get the next
+            page. It is None when the page is empty.
+        """
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        query = (
+            self.client.collection(collection)
+            .where(filter=FieldFilter(field, "<", value))
+            .order_by(field)
+            .select([field])
+            .limit(limit)
+        )
+        if cursor is not None:
+            query = query.start_after(cursor)
+        snapshots = list(query.stream())
+        return [snapshot.id for snapshot in snapshots], (snapshots[-1] if snapshots else None)
+
+    def batch_delete(self, collection, doc_ids):
+        """Delete documents in one batched write (Firestore allows up to 500)."""
+        batch = self.client.batch()
+        for doc_id in doc_ids:
+            batch.delete(self.client.collection(collection).document(doc_id))
+        batch.commit()
+        return True
+
+
+class MemoryBackend:
+    """
+    In-process stand-in for Firestore, used for offline runs and benchmarks.
+
+    Args:
+        latency: Seconds to sleep on every call, to emulate a network round trip
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, collection, doc_id):
+        self._wait()
+        with self._lock:
+            data = self._collections.get(collection, {}).get(doc_id)
+            return copy.deepcopy(data) if data is not None else None
+
+    def set(self, collection, doc_id, data, transactional=False):
+        self._wait()
+        with self._lock:
+            self._collections.setdefault(collection, {})[doc_id] = copy.deepcopy(data)
+        return True
+
+    def update(self, collection, doc_id, data):
+        self._wait()
+        with self._lock:
+            docs = self._collections.get(collection, {})
+            if doc_id not in docs:
+                raise DocumentNotFound(f"{collection}/{doc_id}")
+            docs[doc_id].update(copy.deepcopy(data))
+        return True
+
+    def update_if(self, collection, doc_id, predicate, data):
+        self._wait()
+        with self._lock:
+            doc = self._collections.get(collection, {}).get(doc_id)
+            if doc is None or not predicate(copy.deepcopy(doc)):
+                return False
+            doc.update(copy.deepcopy(data))
+        return True
+
+    def delete(self, collection, doc_id):
+        self._wait()
+        with self._lock:
+            self._collections.get(collection, {}).pop(doc_id, None)
+        return True
+
+    def batch_update(self, updates):
+        self._wait()
+        with self._lock:
+            for collection, doc_id, data in updates:
+                doc = self._collections.get(collection, {}).get(doc_id)
+                if doc is not None:
+                    doc.update(copy.deepcopy(data))
+        return True
+
+    @staticmethod
+    def _apply_array(doc, field, op, values):
+        current = doc.get(field)
+        current = list(current) if isinstance(current, list) else []
+        if op == ARRAY_UNION:
+            current.extend(value for value in dict.fromkeys(values) if value not in current)
+        else:
+            current = [value for value in current if value not in values]
+        doc[field] = copy.deepcopy(current)
+
+    def array_update(self, collection, doc_id, field, op, values):
+        self._wait()
+        with self._lock:
+            doc = self._collections.get(collection, {}).get(doc_id)
+            if doc is None:
+                raise DocumentNotFound(f"{collection}/{doc_id}")
+            self._apply_array(doc, field, op, values)
+        return True
+
+    def increment(self, collection, doc_id, field, amount=1):
+        self._wait()
+        with self._lock:
+            doc = self._collections.get(collection, {}).get(doc_id)
+            if doc is None:
+                raise DocumentNotFound(f"{collection}/{doc_id}")
+            doc[field] = doc.get(field, 0) + amount
+        return True
+
+    def batch_array_update(self, collection, ops):
+        missing = set()
+        for start in range(0, len(ops), MAX_BATCH_WRITES):
+            self._wait()
+            with self._lock:
+                docs = self._collections.get(collection, {})
+                for doc_id, field, op, values in ops[start:start + MAX_BATCH_WRITES]:
+                    if doc_id in docs:
+                        self._apply_array(docs[doc_id], field, op, values)
+                    else:
+                        missing.add(doc_id)
+        return missing
+
+    def batch_create(self, collection, docs):
+        existing = set()
+        for start in range(0, len(docs), MAX_BATCH_WRITES):
+            self._wait()
+            with self._lock:
+                collection_docs = self._collections.setdefault(collection, {})
+                for doc_id, data in docs[start:start + MAX_BATCH_WRITES]:
+                    if doc_id in collection_docs:
+                        existing.add(doc_id)
+                    else:
+                        collection_docs[doc_id] = copy.deepcopy(data)
+        return existing
+
+    def scan(self, collection, limit, cursor=None, array_contains=None):
+        self._wait()
+        with self._lock:
+            docs = self._collections.get(collection, {})
+            doc_ids = sorted(
+                doc_id for doc_id in docs
+                if (cursor is None or doc_id > cursor)
+                and (array_contains is None or array_contains[1] in (docs[doc_id].get(array_contains[0]) or []))
+            )[:limit]
+            page = [(doc_id, copy.deepcopy(docs[doc_id])) for doc_id in doc_ids]
+        return page, (doc_ids[-1] if doc_ids else None)
+
+    def scan_before(self, collection, field, value, limit, cursor=None):
+        self._wait()
+        with self._lock:
+            # Like Firestore, only values of the same type compare
+            matches = sorted(
+                (doc[field], doc_id)
+                for doc_id, doc in self._collections.get(collection, {}).items()
+                if isinstance(doc.get(field), type(value)) and doc[field] < value
+            )
+        if cursor is not None:
+            matches = [match for match in matches if match > cursor]
+        page = matches[:limit]
+        return [doc_id for _, doc_id in page], (page[-1] if page else None)
+
+    def batch_delete(self, collection, doc_ids):
+        self._wait()
+        with self._lock:
+            docs = self._collections.get(collection, {})
+            for doc_id in doc_ids:
+                docs.pop(doc_id, None)
+        return True
+
+
+class InstrumentedBackend:
+    """
+    Wraps a backend and records the latency of every call in the
+    aria_datastore_call_seconds histogram, labelled by operation
+    (transactional sets count as "transaction") and collection.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _timed(self, op, collection, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        except DocumentNotFound:
+            raise
+        except Exception:
+            DATASTORE_ERRORS.labels(op, collection).inc()
+            raise
+        finally:
+            DATASTORE_SECONDS.labels(op, collection).observe(time.perf_counter() - started)
+
+    def get(self, collection, doc_id):
+        return self._timed("get", collection, self.backend.get, collection, doc_id)
+
+    def set(self, collection, doc_id, data, transactional=False):
+        op = "transaction" if transactional else "set"
+        return self._timed(op, collection, self.backend.set, collection, doc_id, data, transactional)
+
+    def update(self, collection, doc_id, data):
+        return self._timed("update", collection, self.backend.update, collection, doc_id, data)
+
+    def update_if(self, collection, doc_id, predicate, data):
+        return self._timed("transaction", collection, self.backend.update_if, collection, doc_id, predicate, data)
+
+    def delete(self, collection, doc_id):
+        return self._timed("delete", collection, self.backend.delete, collection, doc_id)
+
+    def batch_update(self, updates):
+        return self._timed("batch_update", "*", self.backend.batch_update, updates)
+
+    def array_update(self, collection, doc_id, field, op, values):
+        return self._timed("update", collection, self.backend.array_update, collection, doc_id, field, op, values)
+
+    def increment(self, collection, doc_id, field, amount=1):
+        return self._timed("update", collection, self.backend.increment, collection, doc_id, field, amount)
+
+    def batch_array_update(self, collection, ops):
+        return self._timed("batch_update", collection, self.backend.batch_array_update, collection, ops)
+
+    def batch_create(self, collection, docs):
+        return self._timed("batch_create", collection, self.backend.batch_create, collection, docs)
+
+    def scan(self, collection, limit, cursor=None, array_contains=None):
+        return self._timed("scan", collection, self.backend.scan, collection, limit, cursor, array_contains)
+
+    def scan_before(self, collection, field, value, limit, cursor=None):
+        return self._timed("scan", collection, self.backend.scan_before, collection, field, value, limit, cursor)
+
+    def batch_delete(self, collection, doc_ids):
+        return self._timed("batch_delete", collection, self.backend.batch_delete, collection, doc_ids)
+
+
+class DataStore:
+    """
+    Async facade over a blocking backend.
+
+    Calls are dispatched to a bounded thread pool so that Firestore round trips
+    never run on the event loop thread.
+
+    Args:
+        backend: FirestoreBackend or MemoryBackend
+        max_workers: Maximum number of concurrent backend calls
+    """
+
+    def __init__(self, backend, max_workers=16):
+        self.backend = backend
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="datastore"
+        )
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking callable in the datastore pool and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def get(self, collection, doc_id):
+        return await self.run(self.backend.get, collection, doc_id)
+
+    async def set(self, collection, doc_id, data, transactional=False):
+        return await self.run(self.backend.set, collection, doc_id, data, transactional)
+
+    async def update(self, collection, doc_id, data):
+        return await self.run(self.backend.update, collection, doc_id, data)
+
+    async def delete(self, collection, doc_id):
+        return await self.run(self.backend.delete, collection, doc_id)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def use_memory_backend():
+    """Return True when ARIA_DATASTORE selects the in-memory backend."""
+    return os.getenv("ARIA_DATASTORE", "firestore").lower() == "memory"
+
+
+def create_datastore(client=None):
+    """
+    Build the DataStore selected by the ARIA_DATASTORE environment variable.
+
+    ARIA_DATASTORE=memory selects the in-memory backend (with optional
+    ARIA_MEMORY_LATENCY_MS per call); anything else wraps the given Firestore
+    client or client factory. DATASTORE_MAX_WORKERS bounds the number of
+    concurrent calls.
+    """
+    max_workers = int(os.getenv("DATASTORE_MAX_WORKERS", "16"))
+    if use_memory_backend():
+        latency = float(os.getenv("ARIA_MEMORY_LATENCY_MS", "0")) / 1000
+        return DataStore(InstrumentedBackend(MemoryBackend(latency=latency)), max_workers=max_workers)
+    return DataStore(InstrumentedBackend(FirestoreBackend(client)), max_workers=max_workers)
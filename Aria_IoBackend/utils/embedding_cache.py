@@ -0,0 +1,264 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+from utils.file_lock import file_lock
+
+# Cache keys are SHA-256 digests
+KEY_BYTES = 32
+
+
+def normalize_text(text):
+    """Canonical form of chunk text used for cache keys."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def cache_key(text, model_id):
+    return hashlib.sha256(f"{model_id}\0{normalize_text(text)}".encode()).digest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed on-disk cache of embeddings.
+
+    Vectors live in fixed slots of a float32 memmap (vectors.f32); SQLite
+    (cache.db) maps each key to its slot and last use. When every slot is
+    taken the least recently used entries are overwritten.
+
+    Worker processes share the files. Each slot also records the key whose
+    vector it holds (keys.bin): a writer clears it before overwriting the
+    vector and sets it afterwards, and a reader only accepts a vector whose
+    slot still names the key it looked up, so a slot being reused under it
+    reads as a miss rather than someone else's embedding.
+
+    Args:
+        root: Directory holding cache.db, vectors.f32 and keys.bin
+        dim: Embedding dimension
+        capacity: Maximum number of cached vectors
+    """
+
+    def __init__(self, root, dim, capacity=200000):
+        self.root = root
+        self.dim = dim
+        self.capacity = capacity
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "cache.db"), check_same_thread=False)
+        self._inherited = []
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS entries (
+                key BLOB PRIMARY KEY,
+                slot INTEGER NOT NULL UNIQUE,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        with file_lock(os.path.join(root, "cache.lock")):
+            self._prepare_files()
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, dim))
+        self._keys = np.memmap(self._keys_path, dtype=np.uint8, mode="r+", shape=(capacity, KEY_BYTES))
+        self._size = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.root, "vectors.f32")
+
+    @property
+    def _keys_path(self):
+        return os.path.join(self.root, "keys.bin")
+
+    def _prepare_files(self):
+        """
+        Fit the slot files to dim and capacity: a new dimension empties the
+        cache, a new capacity grows the files or drops the entries past it.
+        """
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        with self._db:
+            if row is None or int(row[0]) != self.dim or not os.path.exists(self._keys_path):
+                self._db.execute("DELETE FROM entries")
+                for path in (self._vectors_path, self._keys_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self.dim),))
+            self._db.execute("DELETE FROM entries WHERE slot >= ?", (self.capacity,))
+        for path, row_bytes in ((self._vectors_path, self.dim * 4), (self._keys_path, KEY_BYTES)):
+            with open(path, "ab") as f:
+                f.truncate(self.capacity * row_bytes)
+
+    def get_many(self, keys):
+        """Return {key: vector} for the keys that are cached, refreshing their LRU position."""
+        found = {}
+        with self._lock:
+            now = time.time()
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, slot FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                used = []
+                for key, slot in rows:
+                    key = bytes(key)
+                    vector = np.array(self._vectors[slot])
+                    # Checked after the copy: a writer clears the slot's key
+                    # before touching its vector
+                    if self._keys[slot].tobytes() == key:
+                        found[key] = vector
+                        used.append((now, key))
+                if used:
+                    self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", used)
+            self._db.commit()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items):
+        """
+        Store (key, vector) pairs, evicting least recently used entries when
+        full. Keys that are already cached, by this or another process, are
+        left as they are.
+        """
+        items = list(dict(items).items())
+        if not items:
+            return
+        with self._lock:
+            now = time.time()
+            # Slots are allocated from the database under SQLite's write lock,
+            # so worker processes sharing the cache never hand out the same one
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                existing = set()
+                for start in range(0, len(items), 500):
+                    batch = [key for key, _ in items[start:start + 500]]
+                    existing.update(bytes(row[0]) for row in self._db.execute(
+                        f"SELECT key FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch
+                    ))
+                items = [(key, vector) for key, vector in items if key not in existing][:self.capacity]
+                next_slot = self._db.execute("SELECT COALESCE(MAX(slot) + 1, 0) FROM entries").fetchone()[0]
+                free = max(0, min(len(items), self.capacity - next_slot))
+                slots = list(range(next_slot, next_slot + free))
+                self._size = max(self._size, next_slot + free)
+                needed = len(items) - free
+                if needed:
+                    victims = self._db.execute(
+                        "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (needed,)
+                    ).fetchall()
+                    self._db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in victims])
+                    slots.extend(slot for _, slot in victims)
+                    self.evictions += len(victims)
+                for (key, vector), slot in zip(items, slots):
+                    self._keys[slot] = 0
+                    self._vectors[slot] = vector
+                    self._keys[slot] = np.frombuffer(key, dtype=np.uint8)
+                self._db.executemany(
+                    "INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+                    [(key, slot, now) for (key, _), slot in zip(items, slots)],
+                )
+                self._vectors.flush()
+                self._keys.flush()
+                self._db.commit()
+            except BaseException:
+                # Overwritten slots now name their new key, so the restored
+                # rows of evicted entries read as misses until evicted again
+                self._db.rollback()
+                raise
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self._size,
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def reopen(self):
+        """
+        Open a fresh SQLite connection, for use in a process forked after
+        the cache was created; connections must not be shared across fork.
+        """
+        with self._lock:
+            # The inherited connection is kept rather than closed: closing it
+            # here could checkpoint or unlock files the parent still uses
+            self._inherited.append(self._db)
+            self._db = sqlite3.connect(os.path.join(self.root, "cache.db"), check_same_thread=False)
+
+    def close(self):
+        with self._lock:
+            self._vectors.flush()
+            self._keys.flush()
+            self._db.close()
+
+
+class CachedEmbedder:
+    """
+    Embedder wrapper that only computes embeddings missing from an EmbeddingCache.
+
+    Args:
+        embedder: Underlying embedder (model_id, dim, embed, embed_query)
+        cache: EmbeddingCache with the same dimension
+    """
+
+    def __init__(self, embedder, cache):
+        self.embedder = embedder
+        self.cache = cache
+        self.model_id = embedder.model_id
+        self.dim = embedder.dim
+
+    def embed(self, texts, run_stats=None):
+        keys = [cache_key(text, self.model_id) for text in texts]
+        cached = self.cache.get_many(list(dict.fromkeys(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            computed = self.embedder.embed(list(missing.values()))
+            new_items = list(zip(missing, computed))
+            self.cache.put_many(new_items)
+            cached.update(new_items)
+        if run_stats is not None:
+            run_stats["hits"] = run_stats.get("hits", 0) + len(texts) - len(missing)
+            run_stats["misses"] = run_stats.get("misses", 0) + len(missing)
+        return np.stack([cached[key] for key in keys]) if keys else np.zeros((0, self.dim), np.float32)
+
+    def embed_query(self, texts):
+        # Queries are rarely repeated verbatim, so they bypass the cache
+        return self.embedder.embed_query(texts)
+
+    def session(self):
+        """Return an embedder that also counts hits and misses for one ingestion run."""
+        return EmbeddingRun(self)
+
+
+class EmbeddingRun:
+    """Per-run view of a CachedEmbedder that tracks its own hit/miss counts."""
+
+    def __init__(self, cached_embedder):
+        self.cached_embedder = cached_embedder
+        self.model_id = cached_embedder.model_id
+        self.dim = cached_embedder.dim
+        self.counts = {"hits": 0, "misses": 0}
+
+    def embed(self, texts):
+        return self.cached_embedder.embed(texts, run_stats=self.counts)
+
+    def embed_query(self, texts):
+        return self.cached_embedder.embed_query(texts)
+
+    def stats(self):
+        total = self.counts["hits"] + self.counts["misses"]
+        return {**self.counts, "hit_rate": self.counts["hits"] / total if total else 0.0}
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import re
+
+import numpy as np
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class GeminiEmbedder:
+    """
+    Embeddings from the Gemini embedding API.
+
+    Args:
+        api_key: Google API key
+        model: Embedding model name
+        batch_size: Texts sent per API call
+    """
+
+    dim = 768
+
+    def __init__(self, api_key, model="models/text-embedding-004", batch_size=100):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self._genai = genai
+        self.model = model
+        self.model_id = model
+        self.batch_size = batch_size
+
+    def embed(self, texts, task_type="retrieval_document"):
+        """Return an (n, dim) float32 array of L2-normalised embeddings."""
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            result = self._genai.embed_content(model=self.model, content=batch, task_type=task_type)
+            vectors.extend(result["embedding"])
+        return _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dim))
+
+    def embed_query(self, texts):
+        return self.embed(texts, task_type="retrieval_query")
+
+
+class HashingEmbedder:
+    """
+    Dependency-free embeddings from hashed word unigrams and bigrams.
+
+    Much weaker than a learned model, but deterministic and offline, which
+    makes it the fallback for development and benchmarks.
+
+    Args:
+        dim: Embedding dimension
+    """
+
+    def __init__(self, dim=384):
+        self.dim = dim
+        self.model_id = f"hashing-{dim}"
+
+    def _features(self, text):
+        words = re.findall(r"\w+", text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                sign = 1.0 if value & 1 else -1.0
+                vectors[row, (value >> 1) % self.dim] += sign
+        return _normalize(vectors)
+
+    def embed_query(self, texts):
+        return self.embed(texts)
+
+
+def create_embedder():
+    """
+    Build the embedder selected by EMBEDDING_BACKEND ("gemini" or "hashing").
+
+    Defaults to Gemini when GEMINI_API_KEY or GOOGLE_API_KEY is set.
+    """
+    api_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+    backend = os.getenv("EMBEDDING_BACKEND", "gemini" if api_key else "hashing").lower()
+    if backend == "gemini":
+        return GeminiEmbedder(api_key, model=os.getenv("EMBEDDING_MODEL", "models/text-embedding-004"))
+    return HashingEmbedder(dim=int(os.getenv("EMBEDDING_DIM", "384")))
@@ -0,0 +1,56 @@
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _thread_lock(path):
+    with _thread_locks_guard:
+        return _thread_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """
+    Hold an advisory lock on path (created if missing) for the duration of
+    the block, excluding other processes such as gunicorn workers sharing
+    the data directory.
+
+    POSIX record locks (lockf) are used rather than flock because they
+    are not inherited by forked children: a process pool forked while the
+    lock is held would otherwise keep it after the block ends. Record
+    locks belong to the whole process, so threads of this process are
+    serialised with a lock of their own, shared or not.
+
+    Args:
+        path: Lock file
+        shared: Take a shared (reader) lock against other processes
+        blocking: Wait for the lock; if False and it is held elsewhere, the
+            block runs without it
+
+    Yields:
+        True when the lock is held, False if blocking is False and it wasn't free
+    """
+    thread_lock = _thread_lock(path)
+    if not thread_lock.acquire(blocking):
+        yield False
+        return
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.lockf(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+            except OSError:
+                if blocking:
+                    raise
+                yield False
+                return
+            yield True
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+    finally:
+        thread_lock.release()
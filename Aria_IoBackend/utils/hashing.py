@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.metrics import BCRYPT_SECONDS
+
+OTP_HMAC_PREFIX = "hmac-sha256$"
+
+_pwd_context = None
+
+
+def _get_context():
+    # Created on first use so each pool worker builds its own context
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _pwd_context
+
+
+def _bcrypt_hash(password):
+    return _get_context().hash(password)
+
+
+def _bcrypt_verify(plain_password, hashed_password):
+    return _get_context().verify(plain_password, hashed_password)
+
+
+class PoolSaturated(Exception):
+    """Raised when the password hashing queue is full."""
+
+    def __init__(self, retry_after):
+        super().__init__("Password hashing pool is saturated")
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a dedicated process pool with a bounded queue.
+
+    At most max_pending hash/verify calls may be queued or running at once;
+    beyond that calls fail fast with PoolSaturated instead of piling up.
+
+    Args:
+        max_workers: Number of worker processes, defaults to the CPU count
+        max_pending: Maximum number of queued plus running calls
+        retry_after: Seconds clients should wait after a rejection
+        start_method: multiprocessing start method, platform default if None
+    """
+
+    def __init__(self, max_workers=None, max_pending=None, retry_after=1, start_method=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 8
+        self.retry_after = retry_after
+        self.start_method = start_method
+        self.rejected = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        # Pools are created lazily so forked server workers each get their own
+        with self._lock:
+            if self._executor is None:
+                mp_context = multiprocessing.get_context(self.start_method) if self.start_method else None
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=mp_context
+                )
+            return self._executor
+
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+
+    def _submit(self, op, func, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise PoolSaturated(self.retry_after)
+            self._pending += 1
+        started = time.perf_counter()
+        try:
+            future = self._get_executor().submit(func, *args)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        histogram = BCRYPT_SECONDS.labels(op)
+        future.add_done_callback(lambda _: histogram.observe(time.perf_counter() - started))
+        return future
+
+    def hash(self, password):
+        return self._submit("hash", _bcrypt_hash, password).result()
+
+    def verify(self, plain_password, hashed_password):
+        return self._submit("verify", _bcrypt_verify, plain_password, hashed_password).result()
+
+    async def hash_async(self, password):
+        return await asyncio.wrap_future(self._submit("hash", _bcrypt_hash, password))
+
+    async def verify_async(self, plain_password, hashed_password):
+        return await asyncio.wrap_future(
+            self._submit("verify", _bcrypt_verify, plain_password, hashed_password)
+        )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+def hash_otp(otp, key):
+    """
+    Hash a short-lived OTP with a keyed HMAC-SHA256.
+
+    OTPs expire after minutes, so a server-side secret plus a random nonce
+    protects them without paying for bcrypt on every request.
+
+    Args:
+        otp: The one-time password
+        key: Server secret used as the HMAC key
+
+    Returns:
+        String of the form "hmac-sha256$<nonce>$<hexdigest>"
+    """
+    nonce = secrets.token_hex(8)
+    digest = hmac.new(key.encode(), f"{nonce}:{otp}".encode(), hashlib.sha256).hexdigest()
+    return f"{OTP_HMAC_PREFIX}{nonce}${digest}"
+
+
+def verify_otp_hash(otp, stored_hash, key):
+    """
+    Check an OTP against a hash produced by hash_otp.
+
+    Returns None when stored_hash is not an HMAC hash (e.g. a bcrypt hash
+    written before HMAC mode was enabled) so the caller can fall back.
+    """
+    if not stored_hash or not stored_hash.startswith(OTP_HMAC_PREFIX):
+        return None
+    nonce, _, digest = stored_hash[len(OTP_HMAC_PREFIX):].partition("$")
+    expected = hmac.new(key.encode(), f"{nonce}:{otp}".encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, digest)
@@ -0,0 +1,420 @@
+import itertools
+import json
+import logging
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+
+from utils.manifest import Manifest, text_hash
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = {".pdf", ".docx", ".txt", ".md"}
+
+# Size of the pseudo-pages DOCX and plain text are split into, since they
+# carry no page information
+TEXT_PAGE_CHARS = 4000
+
+_encodings = {}
+
+
+@dataclass
+class Chunk:
+    source: str
+    page: int
+    index: int
+    text: str
+    tokens: int
+
+
+def _get_encoding(name):
+    # Cached per process; pool workers load the encoding once
+    if name not in _encodings:
+        import tiktoken
+        _encodings[name] = tiktoken.get_encoding(name)
+    return _encodings[name]
+
+
+def split_tokens(text, max_tokens=512, overlap=64, encoding="cl100k_base"):
+    """
+    Split text into windows of at most max_tokens tokens.
+
+    Consecutive windows share overlap tokens so sentences cut at a boundary
+    still appear whole in one of them.
+
+    Returns:
+        List of (text, token_count) tuples
+    """
+    enc = _get_encoding(encoding)
+    tokens = enc.encode(text)
+    if not tokens:
+        return []
+    step = max(1, max_tokens - overlap)
+    windows = []
+    for start in range(0, len(tokens), step):
+        window = tokens[start:start + max_tokens]
+        windows.append((enc.decode(window), len(window)))
+        if start + max_tokens >= len(tokens):
+            break
+    return windows
+
+
+def _split_text_pages(text, page_chars=TEXT_PAGE_CHARS):
+    """Group paragraphs into pseudo-pages of roughly page_chars characters."""
+    pages, current, size = [], [], 0
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and size + len(paragraph) > page_chars:
+            pages.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(paragraph)
+        size += len(paragraph)
+    if current:
+        pages.append("\n\n".join(current))
+    return pages
+
+
+def page_count(path):
+    """Number of pages in a PDF, or None for formats that are read in one pass."""
+    if os.path.splitext(path)[1].lower() != ".pdf":
+        return None
+    try:
+        import pymupdf
+        with pymupdf.open(path) as doc:
+            return doc.page_count
+    except ImportError:
+        from pypdf import PdfReader
+        return len(PdfReader(path).pages)
+
+
+def extract_pages(path, start=0, stop=None):
+    """
+    Extract the text of pages [start, stop) of a document.
+
+    PDFs are read with PyMuPDF (pypdf as a fallback) one page at a time;
+    DOCX and text files are split into pseudo-pages.
+
+    Returns:
+        List of (page_number, text) tuples, page numbers starting at 1
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        try:
+            import pymupdf
+            with pymupdf.open(path) as doc:
+                stop = doc.page_count if stop is None else min(stop, doc.page_count)
+                return [(number + 1, doc.load_page(number).get_text()) for number in range(start, stop)]
+        except ImportError:
+            from pypdf import PdfReader
+            reader = PdfReader(path)
+            stop = len(reader.pages) if stop is None else min(stop, len(reader.pages))
+            return [(number + 1, reader.pages[number].extract_text() or "") for number in range(start, stop)]
+    if ext == ".docx":
+        import docx2txt
+        text = docx2txt.process(path)
+    else:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    pages = _split_text_pages(text)
+    return [(number + 1, page) for number, page in enumerate(pages)][start:stop]
+
+
+def _chunk_pages(path, start, stop, max_tokens, overlap, encoding, known=None):
+    """
+    Pool task: extract a page range and split each page into token windows.
+
+    Pages whose text hash matches known[page] are not tokenised; their
+    windows are returned as None.
+    """
+    known = known or {}
+    results = []
+    for page, text in extract_pages(path, start, stop):
+        page_hash = text_hash(text)
+        if known.get(page) == page_hash:
+            results.append((page, page_hash, None))
+        else:
+            results.append((page, page_hash, split_tokens(text, max_tokens, overlap, encoding)))
+    return results
+
+
+class IngestionEngine:
+    """
+    Parses and chunks documents in a process pool, streaming the results.
+
+    Each file is cut into page ranges that are extracted and tokenised by pool
+    workers. At most max_in_flight ranges are outstanding at a time and results
+    are yielded in page order, so memory stays bounded however large the
+    document is.
+
+    Args:
+        max_workers: Worker processes, defaults to the CPU count
+        pages_per_task: Pages extracted by one pool task
+        max_in_flight: Page ranges submitted ahead of the consumer
+        max_tokens: Maximum tokens per chunk
+        overlap: Tokens shared by consecutive chunks of a page
+        encoding: tiktoken encoding used to count tokens
+    """
+
+    def __init__(self, max_workers=None, pages_per_task=8, max_in_flight=None,
+                 max_tokens=512, overlap=64, encoding="cl100k_base"):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.pages_per_task = pages_per_task
+        self.max_in_flight = max_in_flight or self.max_workers * 2
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.encoding = encoding
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _ranges(self, path):
+        pages = page_count(path)
+        if pages is None:
+            yield 0, None
+            return
+        for start in range(0, pages, self.pages_per_task):
+            yield start, start + self.pages_per_task
+
+    def iter_page_chunks(self, path, known=None):
+        """
+        Yield (page_number, page_hash, windows) for every page of path, in order.
+
+        windows is a list of (text, tokens), or None for pages whose hash
+        matches known[page_number].
+        """
+        known = known or {}
+        executor = self._get_executor()
+        in_flight = deque()
+        try:
+            for start, stop in self._ranges(path):
+                if stop is None:
+                    range_known = known
+                else:
+                    range_known = {p: h for p, h in known.items() if start < p <= stop}
+                in_flight.append(executor.submit(
+                    _chunk_pages, path, start, stop, self.max_tokens, self.overlap, self.encoding,
+                    range_known
+                ))
+                if len(in_flight) >= self.max_in_flight:
+                    yield from in_flight.popleft().result()
+            while in_flight:
+                yield from in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def iter_chunks(self, path, source=None):
+        """Yield the Chunks of a document one at a time."""
+        source = source or os.path.basename(path)
+        for page, _, windows in self.iter_page_chunks(path):
+            for index, (text, tokens) in enumerate(windows):
+                yield Chunk(source=source, page=page, index=index, text=text, tokens=tokens)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+
+class ChunkStore:
+    """
+    Per-tenant store of ingested chunks, one JSON-lines file per source document.
+
+    Args:
+        root: Directory holding the tenant's chunk files
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, source):
+        safe = re.sub(r"[^A-Za-z0-9._-]", "_", source)
+        return os.path.join(self.root, f"{safe}.jsonl")
+
+    def exists(self, source):
+        return os.path.exists(self._path(source))
+
+    def write(self, source, chunks):
+        """
+        Stream chunks into the source's file, replacing any previous version.
+
+        Returns:
+            Dict with the number of pages, chunks and tokens written
+        """
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(source)
+        tmp_path = path + ".tmp"
+        pages, count, tokens = set(), 0, 0
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(json.dumps(asdict(chunk)) + "\n")
+                pages.add(chunk.page)
+                count += 1
+                tokens += chunk.tokens
+        os.replace(tmp_path, path)
+        return {"pages": len(pages), "chunks": count, "tokens": tokens}
+
+    def read(self, source):
+        """Yield the stored Chunks of a source document."""
+        with open(self._path(source), encoding="utf-8") as f:
+            for line in f:
+                yield Chunk(**json.loads(line))
+
+    def delete(self, source):
+        if self.exists(source):
+            os.remove(self._path(source))
+
+
+class _PageReader:
+    """Hands out the stored chunks of a source page by page, in ascending page order."""
+
+    def __init__(self, store, source):
+        chunks = store.read(source) if store.exists(source) else iter(())
+        self._groups = itertools.groupby(chunks, key=lambda chunk: chunk.page)
+        self._current = None
+
+    def take(self, page):
+        while self._current is None or self._current[0] < page:
+            try:
+                self._current = next(self._groups)
+            except StopIteration:
+                return []
+        if self._current[0] == page:
+            chunks = list(self._current[1])
+            self._current = None
+            return chunks
+        return []
+
+
+def _report(progress, event, **data):
+    if progress is not None:
+        progress(event, data)
+
+
+def _ingest_file(engine, store, source, path, manifest, rewrite, index, embedder, batch_size,
+                 progress=None):
+    existed = manifest.get(source) is not None
+    known = {} if rewrite else manifest.page_hashes(source)
+    if index is not None and not known:
+        index.delete_source(source)
+    old_chunks = _PageReader(store, source) if known else None
+    pages = {}
+    diff = {"pages_added": 0, "pages_changed": 0, "pages_unchanged": 0, "pages_removed": 0}
+    pending = []
+    indexed = 0
+    produced = 0
+
+    def flush():
+        nonlocal pending, indexed, produced
+        if not pending:
+            return
+        if index is not None:
+            index.add(pending, embedder.embed([c.text for c in pending]))
+            indexed += len(pending)
+        produced += len(pending)
+        _report(progress, "chunks", file=source, page=pending[-1].page, chunks=len(pending),
+                chunks_done=produced, chunks_indexed=indexed)
+        pending = []
+
+    def merged_chunks():
+        # Unchanged pages are copied from the previous chunk file, the rest re-chunked and indexed
+        for page, page_hash, windows in engine.iter_page_chunks(path, known):
+            pages[page] = page_hash
+            if windows is None:
+                diff["pages_unchanged"] += 1
+                _report(progress, "page", file=source, page=page, status="unchanged", chunks=0)
+                yield from old_chunks.take(page)
+                continue
+            if page in known:
+                diff["pages_changed"] += 1
+                if index is not None:
+                    index.delete_pages(source, [page])
+            else:
+                diff["pages_added"] += 1
+            for number, (text, tokens) in enumerate(windows):
+                chunk = Chunk(source=source, page=page, index=number, text=text, tokens=tokens)
+                pending.append(chunk)
+                if len(pending) >= batch_size:
+                    flush()
+                yield chunk
+            _report(progress, "page", file=source, page=page,
+                    status="changed" if page in known else "added", chunks=len(windows))
+        flush()
+
+    stats = store.write(source, merged_chunks())
+    removed = sorted(set(known) - set(pages))
+    if removed and index is not None:
+        index.delete_pages(source, removed)
+    diff["pages_removed"] = len(removed)
+    manifest.record(source, path, pages)
+    status = "changed" if existed else "new"
+    return {"file": source, "status": status, **stats, **diff, "chunks_indexed": indexed}
+
+
+def ingest_files(engine, store, files, rewrite=False, index=None, embedder=None, batch_size=64,
+                 manifest=None, prune=False, progress=None):
+    """
+    Incrementally parse, chunk and store a list of documents.
+
+    Files whose fingerprint matches the manifest are skipped. For the others
+    only new or changed pages are re-chunked and re-indexed, and pages that
+    disappeared are removed from the index.
+
+    Args:
+        engine: IngestionEngine used to parse and chunk
+        store: ChunkStore receiving the chunks
+        files: List of (source_name, path) tuples
+        rewrite: Reprocess every page, ignoring the manifest
+        index: Optional VectorStore the chunks are also embedded into
+        embedder: Embedder used when index is given
+        batch_size: Chunks embedded per call
+        manifest: Manifest of previous runs, an empty in-memory one if None
+        prune: Remove sources recorded in the manifest but missing from files
+        progress: Optional callable(event, data) receiving "file_started",
+            "chunks" (after every batch_size chunks), "page" and "file_done"
+            events
+
+    Returns:
+        List of per-file result dicts describing what changed
+    """
+    manifest = manifest if manifest is not None else Manifest()
+    results = []
+    for source, path in files:
+        _report(progress, "file_started", file=source)
+        try:
+            if not rewrite and manifest.is_unchanged(source, path):
+                pages = len(manifest.page_hashes(source))
+                results.append({"file": source, "status": "unchanged", "pages_unchanged": pages})
+            else:
+                results.append(_ingest_file(
+                    engine, store, source, path, manifest, rewrite, index, embedder, batch_size,
+                    progress
+                ))
+        except Exception as e:
+            logger.exception("Failed to ingest %s: %s", source, e)
+            results.append({"file": source, "status": "failed", "error": str(e)})
+        manifest.save()
+        _report(progress, "file_done", **results[-1])
+
+    if prune:
+        listed = {source for source, _ in files}
+        for source in sorted(manifest.sources() - listed):
+            removed = len(manifest.page_hashes(source))
+            if index is not None:
+                index.delete_source(source)
+            store.delete(source)
+            manifest.remove(source)
+            results.append({"file": source, "status": "removed", "pages_removed": removed})
+            _report(progress, "file_done", **results[-1])
+        manifest.save()
+
+    if index is not None:
+        index.save()
+    return results
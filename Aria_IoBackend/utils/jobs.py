@@ -0,0 +1,329 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.file_lock import file_lock
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    A background job and its append-only event log.
+
+    Events are numbered from 0; a client that has seen events up to n
+    resumes from cursor n + 1. With a store_dir the state and events are
+    also written to <id>.json and <id>.events.jsonl there, so other worker
+    processes can serve them (see StoredJob).
+    """
+
+    def __init__(self, owner, key=None, store_dir=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.pid = os.getpid()
+        self.key = key
+        self.state = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.events = []
+        self._lock = threading.Lock()
+        self._state_path = self._events_path = None
+        if store_dir:
+            self._state_path = os.path.join(store_dir, f"{self.id}.json")
+            self._events_path = os.path.join(store_dir, f"{self.id}.events.jsonl")
+
+    def emit(self, event, data=None):
+        with self._lock:
+            entry = {
+                "id": len(self.events),
+                "event": event,
+                "data": data or {},
+                "time": time.time(),
+            }
+            self.events.append(entry)
+            if self._events_path:
+                with open(self._events_path, "a") as f:
+                    f.write(json.dumps(entry, default=str) + "\n")
+
+    def events_since(self, cursor):
+        with self._lock:
+            return self.events[cursor:]
+
+    @property
+    def finished(self):
+        return self.state in ("done", "failed")
+
+    def summary(self):
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "events": len(self.events),
+            "result": self.result,
+            "error": self.error,
+        }
+
+    def persist(self):
+        """
+        Write the current state for other processes; call after emitting the
+        matching event. The write time doubles as the job's heartbeat.
+        """
+        if not self._state_path:
+            return
+        with self._lock:
+            tmp_path = f"{self._state_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({**self.summary(), "owner": self.owner, "pid": self.pid, "heartbeat": time.time()},
+                          f, default=str)
+            os.replace(tmp_path, self._state_path)
+
+
+class StoredJob:
+    """
+    Read-only view of a job run by another worker process, following its
+    files as the job progresses. Events are read incrementally and the
+    state only when its file changed.
+
+    The running worker refreshes the state file as a heartbeat. A job whose
+    heartbeat is older than stale_after seconds lost its worker; the first
+    reader to notice records it as failed, so streams end and clients see
+    why.
+    """
+
+    def __init__(self, state_path, events_path, stale_after=60):
+        self._state_path = state_path
+        self._events_path = events_path
+        self.stale_after = stale_after
+        self.id = os.path.basename(state_path)[:-len(".json")]
+        self._state_cache = None
+        self._state_mtime = None
+        self._events = []
+        self._offset = 0
+        self.owner = self._state()["owner"]
+
+    def _read_state(self):
+        mtime = os.stat(self._state_path).st_mtime_ns
+        if mtime != self._state_mtime:
+            with open(self._state_path) as f:
+                self._state_cache = json.load(f)
+            self._state_mtime = mtime
+        return self._state_cache
+
+    def _is_stale(self, state):
+        return (state["state"] not in ("done", "failed")
+                and time.time() - state.get("heartbeat", state["created_at"]) > self.stale_after)
+
+    def _state(self):
+        state = self._read_state()
+        if self._is_stale(state):
+            state = self._mark_failed()
+        return state
+
+    def _read_events(self):
+        try:
+            with open(self._events_path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return self._events
+        # A line still being written has no newline yet
+        complete = data[:data.rfind(b"\n") + 1]
+        self._offset += len(complete)
+        for line in complete.splitlines():
+            try:
+                self._events.append(json.loads(line))
+            except ValueError:
+                # Cut short by a crash, then terminated by _mark_failed()
+                continue
+        return self._events
+
+    def _mark_failed(self):
+        with file_lock(f"{self._state_path}.lock"):
+            self._state_mtime = None
+            state = self._read_state()
+            if not self._is_stale(state):
+                return state
+            error = f"Worker {state.get('pid')} running the job stopped"
+            entry = {"id": len(self._read_events()), "event": "failed", "data": {"error": error}, "time": time.time()}
+            with open(self._events_path, "ab+") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    ended = f.read(1) == b"\n"
+                    f.seek(0, os.SEEK_END)
+                    if not ended:
+                        f.write(b"\n")
+                f.write((json.dumps(entry) + "\n").encode())
+            state = {**state, "state": "failed", "error": error, "finished_at": time.time()}
+            tmp_path = f"{self._state_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, default=str)
+            os.replace(tmp_path, self._state_path)
+            logger.warning("Job %s lost its worker, marked failed", self.id)
+            self._state_mtime = None
+            return self._read_state()
+
+    @property
+    def finished(self):
+        return self._state()["state"] in ("done", "failed")
+
+    def events_since(self, cursor):
+        return self._read_events()[cursor:]
+
+    def summary(self):
+        state = dict(self._state())
+        for field in ("owner", "pid", "heartbeat"):
+            state.pop(field, None)
+        state["events"] = len(self._read_events())
+        return state
+
+
+class JobManager:
+    """
+    Runs jobs on a small thread pool and keeps them around for status queries.
+
+    Jobs submitted with the same key run one after another, in submission
+    order, so they never touch the same data at once. With a store_dir
+    shared by the worker processes, any worker can report on a job,
+    whichever one runs it.
+
+    Args:
+        max_workers: Jobs run concurrently
+        retention: Seconds a finished job is kept before being forgotten
+        store_dir: Directory for job state and events, None to keep them in memory only
+        heartbeat: Seconds between refreshes of the stored state of unfinished jobs
+        stale_after: Seconds without a refresh after which another process
+            considers a stored job's worker gone
+    """
+
+    def __init__(self, max_workers=2, retention=3600, store_dir=None, heartbeat=10, stale_after=60):
+        self.retention = retention
+        self.store_dir = store_dir
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self._heartbeat_thread = None
+        self._stopped = threading.Event()
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        # key -> jobs waiting behind the running one with that key
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def submit(self, owner, func, *args, key=None, **kwargs):
+        """
+        Queue func(job, *args, **kwargs). Its return value becomes the job result
+        and is also sent as the final "done" event.
+        """
+        job = Job(owner, key=key, store_dir=self.store_dir)
+        job.emit("queued")
+        job.persist()
+        with self._lock:
+            if self.store_dir and self._heartbeat_thread is None:
+                # Started on first use, in the worker process that runs jobs
+                self._heartbeat_thread = threading.Thread(target=self._beat, name="job-heartbeat", daemon=True)
+                self._heartbeat_thread.start()
+            self._forget_expired()
+            self._jobs[job.id] = job
+            if key is not None:
+                if key in self._waiting:
+                    self._waiting[key].append((job, func, args, kwargs))
+                    return job
+                self._waiting[key] = deque()
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        try:
+            job.state = "running"
+            job.emit("started")
+            job.persist()
+            try:
+                job.result = func(job, *args, **kwargs)
+                job.state = "done"
+                job.finished_at = time.time()
+                job.emit("done", job.result)
+            except Exception as e:
+                logger.exception("Job %s failed", job.id)
+                job.error = str(e)
+                job.state = "failed"
+                job.finished_at = time.time()
+                job.emit("failed", {"error": job.error})
+            job.persist()
+        finally:
+            if job.key is not None:
+                self._start_next(job.key)
+
+    def _beat(self):
+        while not self._stopped.wait(self.heartbeat):
+            with self._lock:
+                jobs = [job for job in self._jobs.values() if not job.finished]
+            for job in jobs:
+                try:
+                    job.persist()
+                except OSError as e:
+                    logger.warning("Job %s heartbeat failed: %s", job.id, e)
+
+    def _start_next(self, key):
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if not waiting:
+                self._waiting.pop(key, None)
+                return
+            following = waiting.popleft()
+        try:
+            self._executor.submit(self._run, *following)
+        except RuntimeError:
+            # Shutting down; the queued job is dropped like cancelled futures
+            pass
+
+    def _forget_expired(self):
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+        if not self.store_dir:
+            return
+        # Files are swept by age, including those of jobs other processes
+        # ran; a job's files go together once neither changed for retention
+        files_by_job = {}
+        for name in os.listdir(self.store_dir):
+            try:
+                mtime = os.path.getmtime(os.path.join(self.store_dir, name))
+            except FileNotFoundError:
+                continue
+            job_id = name.split(".", 1)[0]
+            files_by_job.setdefault(job_id, []).append((name, mtime))
+        for files in files_by_job.values():
+            if max(mtime for _, mtime in files) < cutoff:
+                for name, _ in files:
+                    try:
+                        os.remove(os.path.join(self.store_dir, name))
+                    except FileNotFoundError:
+                        pass
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None or not self.store_dir or not job_id.isalnum():
+            return job
+        try:
+            return StoredJob(
+                os.path.join(self.store_dir, f"{job_id}.json"),
+                os.path.join(self.store_dir, f"{job_id}.events.jsonl"),
+                stale_after=self.stale_after,
+            )
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def shutdown(self, wait=True):
+        self._stopped.set()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
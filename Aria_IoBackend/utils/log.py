@@ -0,0 +1,253 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+REDACTED = "[REDACTED]"
+
+# Extra fields whose values are never written out
+SENSITIVE_KEYS = {"otp", "debug_otp", "password", "hashed_password", "token", "access_token",
+                  "authorization", "secret", "secret_key"}
+
+_PATTERNS = [
+    # JWTs
+    (re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]+"), REDACTED),
+    (re.compile(r"(?i)(bearer\s+)[\w.~+/=-]+"), r"\1" + REDACTED),
+    # Stored OTP and password hashes
+    (re.compile(r"hmac-sha256\$[0-9a-f]+\$[0-9a-f]+"), REDACTED),
+    (re.compile(r"\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}"), REDACTED),
+    # key=value / "key": "value" pairs
+    (re.compile(r"(?i)(\b(?:otp|password|token|secret)\b[\"']?\s*[:=]\s*[\"']?)[^\s\"',}]+"), r"\1" + REDACTED),
+    # SMTP AUTH exchanges from smtplib's debug output
+    (re.compile(r"(?i)(auth\s+(?:plain|login)\s+)\S+"), r"\1" + REDACTED),
+]
+_OTP_DIGITS = re.compile(r"\b\d{4,8}\b")
+
+_redactors = []
+
+
+def add_redactor(func):
+    """Register an extra callable(text) -> text applied to every log message."""
+    _redactors.append(func)
+
+
+def redact(text):
+    """Strip tokens, hashes, passwords and OTPs from a log message."""
+    for pattern, replacement in _PATTERNS:
+        text = pattern.sub(replacement, text)
+    # Bare numeric codes are only treated as OTPs in messages about OTPs
+    if "otp" in text.lower():
+        text = _OTP_DIGITS.sub(REDACTED, text)
+    for func in _redactors:
+        text = func(text)
+    return text
+
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; extra= fields become top-level keys."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = REDACTED if key.lower() in SENSITIVE_KEYS else value
+        if record.exc_text:
+            entry["exc"] = redact(record.exc_text)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines for local development, with the same redaction."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        # Redact the message and traceback only, not the timestamp and logger name
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg, record.args = redact(record.getMessage()), None
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        return super().format(record)
+
+    def formatException(self, ei):
+        return redact(super().formatException(ei))
+
+
+class DebugSampler(logging.Filter):
+    """
+    Bounds the cost of DEBUG records.
+
+    Each call site (logger and line) may emit up to rate DEBUG records per
+    second, and only a sample fraction of those are kept. INFO and above
+    always pass.
+
+    Args:
+        rate: Records per second allowed per call site, 0 for unlimited
+        sample: Fraction of records kept, between 0 and 1
+    """
+
+    def __init__(self, rate=0, sample=1.0):
+        super().__init__()
+        self.rate = rate
+        self.sample = sample
+        self.suppressed = 0
+        self._buckets = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        if self.sample < 1.0 and random.random() >= self.sample:
+            self.suppressed += 1
+            return False
+        if self.rate:
+            key = (record.name, record.lineno)
+            now = time.monotonic()
+            tokens, last = self._buckets.get(key, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self.suppressed += 1
+                return False
+            self._buckets[key] = (tokens - 1, now)
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks the caller.
+
+    The message is merged with its arguments and any traceback is rendered
+    here; redaction and formatting happen on the writer thread. When the
+    queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.enqueued = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+_state = {}
+_state_lock = threading.Lock()
+
+
+def _parse_levels(spec):
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """
+    Route all logging through a bounded queue to a background writer.
+
+    Environment:
+        LOG_LEVEL: Root level (default INFO)
+        LOG_LEVELS: Per-logger levels, e.g. "utils.mailer=DEBUG,main=WARNING"
+        LOG_FORMAT: "json" (default) or "text"
+        LOG_QUEUE_SIZE: Records buffered before new ones are dropped
+        LOG_DEBUG_RATE: DEBUG records per second per call site, 0 = unlimited
+        LOG_DEBUG_SAMPLE: Fraction of DEBUG records kept
+
+    Safe to call more than once; only the first call has an effect.
+    """
+    with _state_lock:
+        if _state:
+            return
+        log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+        handler = NonBlockingQueueHandler(log_queue)
+        sampler = DebugSampler(
+            rate=float(os.getenv("LOG_DEBUG_RATE", "20")),
+            sample=float(os.getenv("LOG_DEBUG_SAMPLE", "1.0")),
+        )
+        handler.addFilter(sampler)
+
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(TextFormatter() if os.getenv("LOG_FORMAT", "json").lower() == "text" else JsonFormatter())
+        listener = QueueListener(log_queue, output, respect_handler_level=False)
+        listener.start()
+
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        for name, level in _parse_levels(os.getenv("LOG_LEVELS", "")).items():
+            logging.getLogger(name).setLevel(level)
+
+        _state.update(handler=handler, sampler=sampler, listener=listener)
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out everything still queued and stop the writer thread."""
+    with _state_lock:
+        listener = _state.pop("listener", None)
+    if listener is not None:
+        listener.stop()
+
+
+def restart_logging_after_fork():
+    """
+    Give a forked child its own queue and writer thread.
+
+    Threads don't survive fork, so without this a child inheriting
+    configured logging would fill the parent's queue with nobody to write
+    it out. Records still queued at fork time stay with the parent.
+    """
+    with _state_lock:
+        listener = _state.get("listener")
+        if listener is None:
+            return
+        log_queue = queue.Queue(maxsize=listener.queue.maxsize)
+        restarted = QueueListener(log_queue, *listener.handlers, respect_handler_level=False)
+        restarted.start()
+        _state["handler"].queue = log_queue
+        _state["listener"] = restarted
+
+
+def logging_stats():
+    if "handler" not in _state:
+        return {}
+    handler = _state["handler"]
+    return {
+        "enqueued": handler.enqueued,
+        "queued": handler.queue.qsize(),
+        "dropped": handler.dropped,
+        "debug_suppressed": _state["sampler"].suppressed,
+    }
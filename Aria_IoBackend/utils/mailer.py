@@ -0,0 +1,309 @@
+import logging
+import queue
+import smtplib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from utils.metrics import SMTP_ERRORS, SMTP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Errors after which a pooled connection can't be trusted any more.
+# SMTPException is itself an OSError, so handlers must catch these and
+# SMTPException before falling back to OSError.
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)
+
+
+def is_permanent(error):
+    """
+    Whether an SMTP error would recur on retry: 5xx replies, and errors
+    carrying no reply code. 4xx replies are temporary.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return True
+
+
+class SMTPConnectionPool:
+    """
+    Pool of persistent, authenticated SMTP connections.
+
+    Connections that sat idle are probed with NOOP before reuse and are
+    transparently reconnected and re-authenticated when the server has
+    dropped them.
+
+    Args:
+        host: SMTP server host
+        port: SMTP server port
+        username: Login user, or None to skip authentication
+        password: Login password
+        starttls: Whether to upgrade the connection with STARTTLS
+        size: Maximum number of idle connections kept open
+        timeout: Socket timeout in seconds
+        probe_after: Idle seconds after which a connection is probed with NOOP
+        debug: smtplib debug level; the protocol trace is logged at DEBUG
+            on the utils.mailer logger instead of going to stderr
+    """
+
+    def __init__(self, host, port, username=None, password=None, starttls=True,
+                 size=2, timeout=30, probe_after=30, debug=0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.size = size
+        self.timeout = timeout
+        self.probe_after = probe_after
+        self.debug = debug
+        self._idle = []
+        self._lock = threading.Lock()
+        self.connects = 0
+
+    def _connect(self):
+        started = time.perf_counter()
+        try:
+            conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        except Exception:
+            SMTP_ERRORS.labels("connect").inc()
+            raise
+        try:
+            if self.debug:
+                conn.set_debuglevel(self.debug)
+                conn._print_debug = lambda *args: logger.debug("smtp %s", " ".join(map(str, args)))
+            conn.ehlo()
+            if self.starttls:
+                conn.starttls()
+                conn.ehlo()
+            # Local sinks such as aiosmtpd don't advertise AUTH
+            if self.username and conn.has_extn("auth"):
+                conn.login(self.username, self.password)
+        except Exception:
+            SMTP_ERRORS.labels("connect").inc()
+            self._close(conn)
+            raise
+        SMTP_SECONDS.labels("connect").observe(time.perf_counter() - started)
+        self.connects += 1
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def acquire(self):
+        """Return an open, authenticated connection."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, idle_since = self._idle.pop()
+            if time.monotonic() - idle_since < self.probe_after:
+                return conn
+            try:
+                if conn.noop()[0] == 250:
+                    return conn
+            except OSError:
+                pass
+            self._close(conn)
+        return self._connect()
+
+    def release(self, conn, broken=False):
+        """Return a connection to the pool, closing it if broken or surplus."""
+        if not broken:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((conn, time.monotonic()))
+                    return
+        self._close(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+
+class Mailer:
+    """
+    In-process delivery queue drained by background worker threads.
+
+    Each worker takes up to batch_size queued messages and sends them over a
+    single pooled connection. Failed messages are retried with exponential
+    backoff, and the delivery state of every message can be queried by id.
+
+    Args:
+        pool: SMTPConnectionPool used for delivery
+        workers: Number of background worker threads
+        batch_size: Maximum messages sent per connection checkout
+        max_attempts: Delivery attempts before a message is marked failed
+        backoff: Base delay in seconds between attempts, doubled each retry
+        max_status: Number of delivery statuses remembered
+    """
+
+    def __init__(self, pool, workers=2, batch_size=20, max_attempts=4, backoff=2.0,
+                 max_status=10000):
+        self.pool = pool
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_status = max_status
+        self._queue = queue.Queue()
+        self._statuses = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._timers = {}
+        self._stopping = False
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"mailer-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, message):
+        """
+        Queue an email.message.Message for delivery.
+
+        Returns:
+            Message id that can be passed to status()
+        """
+        self.start()
+        message_id = uuid.uuid4().hex
+        self._set_status(message_id, state="queued", attempts=0, error=None,
+                         queued_at=time.time(), sent_at=None)
+        self._queue.put((message_id, message, 0))
+        return message_id
+
+    def status(self, message_id):
+        """Return the delivery status dict for a message id, or None if unknown."""
+        with self._lock:
+            status = self._statuses.get(message_id)
+            return dict(status) if status else None
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _set_status(self, message_id, **fields):
+        with self._lock:
+            status = self._statuses.get(message_id)
+            if status is None:
+                status = self._statuses[message_id] = {"id": message_id}
+                while len(self._statuses) > self.max_status:
+                    self._statuses.popitem(last=False)
+            status.update(fields)
+
+    def _take_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop sentinel back for after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        try:
+            conn = self.pool.acquire()
+        except Exception as e:
+            for item in batch:
+                self._failed(item, e)
+            return
+
+        broken = False
+        for index, item in enumerate(batch):
+            message_id, message, attempts = item
+            self._set_status(message_id, state="sending", attempts=attempts + 1)
+            started = time.perf_counter()
+            try:
+                conn.send_message(message)
+                SMTP_SECONDS.labels("send").observe(time.perf_counter() - started)
+            except CONNECTION_ERRORS as e:
+                SMTP_ERRORS.labels("send").inc()
+                broken = True
+                self._retry_rest(batch[index:], e)
+                break
+            except smtplib.SMTPException as e:
+                # Refused recipients, rejected data and the like only fail
+                # this message; the connection stays usable. Only temporary
+                # (4xx) rejections are worth retrying.
+                SMTP_ERRORS.labels("send").inc()
+                self._failed(item, e, permanent=is_permanent(e))
+            except OSError as e:
+                SMTP_ERRORS.labels("send").inc()
+                broken = True
+                self._retry_rest(batch[index:], e)
+                break
+            else:
+                self._set_status(message_id, state="sent", sent_at=time.time(), error=None)
+        self.pool.release(conn, broken=broken)
+
+    def _retry_rest(self, items, error):
+        # The connection is gone; everything not yet sent goes back for retry
+        for item in items:
+            self._failed(item, error)
+
+    def _failed(self, item, error, permanent=False):
+        message_id, message, attempts = item
+        attempts += 1
+        if permanent or attempts >= self.max_attempts or self._stopping:
+            self._set_status(message_id, state="failed", attempts=attempts, error=str(error))
+            logger.error("Giving up on email %s after %d attempts: %s", message_id, attempts, error)
+            return
+        delay = self.backoff * (2 ** (attempts - 1))
+        self._set_status(message_id, state="retrying", attempts=attempts, error=str(error))
+        timer = threading.Timer(delay, self._requeue, args=((message_id, message, attempts),))
+        timer.daemon = True
+        with self._lock:
+            self._timers[timer] = message_id
+        timer.start()
+
+    def _requeue(self, item):
+        with self._lock:
+            self._timers.pop(threading.current_thread(), None)
+        self._queue.put(item)
+
+    def stop(self, timeout=10):
+        """Deliver what is already queued, then stop the workers and close connections."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+            timers, self._timers = self._timers, {}
+            self._stopping = True
+        for timer, message_id in timers.items():
+            timer.cancel()
+            self._set_status(message_id, state="failed", error="Mailer stopped before retry")
+        for _ in threads:
+            self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.pool.close()
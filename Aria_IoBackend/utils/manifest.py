@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def file_fingerprint(path):
+    """Return (size, mtime_ns) of a file, used to skip hashing unmodified files."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8", errors="replace")).hexdigest()[:32]
+
+
+class Manifest:
+    """
+    Record of what has been ingested for one tenant.
+
+    For every source document it keeps the file's size, mtime and SHA-256
+    plus a hash of each page's text, so a re-ingestion can tell new, changed,
+    unchanged and removed pages apart.
+
+    Args:
+        path: JSON file the manifest is stored in, or None to keep it in memory
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.files = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f).get("files", {})
+
+    def get(self, source):
+        with self._lock:
+            entry = self.files.get(source)
+            return dict(entry) if entry else None
+
+    def sources(self):
+        with self._lock:
+            return set(self.files)
+
+    def page_hashes(self, source):
+        """Return {page_number: hash} recorded for a source."""
+        entry = self.get(source)
+        return {int(page): h for page, h in entry["pages"].items()} if entry else {}
+
+    def is_unchanged(self, source, path):
+        """
+        True if path still matches what was recorded for source.
+
+        Size and mtime are checked first; the file is only hashed when they
+        differ, so an untouched library costs one stat() per file.
+        """
+        entry = self.get(source)
+        if entry is None:
+            return False
+        size, mtime_ns = file_fingerprint(path)
+        if entry["size"] == size and entry["mtime_ns"] == mtime_ns:
+            return True
+        if entry["size"] != size:
+            return False
+        if file_sha256(path) != entry["sha256"]:
+            return False
+        # Content is identical, only the mtime moved
+        with self._lock:
+            self.files[source]["mtime_ns"] = mtime_ns
+        return True
+
+    def record(self, source, path, pages):
+        size, mtime_ns = file_fingerprint(path)
+        with self._lock:
+            self.files[source] = {
+                "size": size,
+                "mtime_ns": mtime_ns,
+                "sha256": file_sha256(path),
+                "pages": {str(page): h for page, h in sorted(pages.items())},
+            }
+
+    def remove(self, source):
+        with self._lock:
+            self.files.pop(source, None)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps({"files": self.files})
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,314 @@
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow SMTP sends
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Shard:
+    """A thread's slot list; dropped with the thread's local storage when it exits."""
+
+    def __init__(self, values):
+        self.values = values
+
+
+class _Shards:
+    """
+    Per-thread value slots summed at scrape time.
+
+    Each thread only ever writes its own list, so recording needs no lock;
+    the lock is taken once per thread, when its slot list is registered,
+    and by readers. When a thread exits its values are folded into a
+    retired total and its list is dropped, so short-lived threads (idle
+    threadpool workers, timers) don't accumulate.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._live = {}
+        self._retired = [0] * size
+        # Reentrant: a finalizer may run from garbage collection in a
+        # thread that is already holding it
+        self._lock = threading.RLock()
+
+    def local(self):
+        try:
+            return self._local.shard.values
+        except AttributeError:
+            values = [0] * self.size
+            shard = self._local.shard = _Shard(values)
+            with self._lock:
+                self._live[id(values)] = values
+            weakref.finalize(shard, self._retire, values)
+            return values
+
+    def _retire(self, values):
+        with self._lock:
+            if self._live.pop(id(values), None) is not None:
+                for i, value in enumerate(values):
+                    self._retired[i] += value
+
+    def totals(self):
+        with self._lock:
+            shards = list(self._live.values())
+            totals = list(self._retired)
+        for values in shards:
+            for i, value in enumerate(values):
+                totals[i] += value
+        return totals
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Child metric for one combination of label values."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self._shards.local()[0] += amount
+
+    def value(self):
+        return self._shards.totals()[0]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_text(values)} {child.value()}"]
+
+
+class Gauge(_Metric):
+    """A gauge made of per-thread deltas, for values moved with inc()/dec() such as in-flight counts."""
+
+    kind = "gauge"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().inc(-amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_text(values)} {child.value()}"]
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One slot per bucket, one for +Inf, then the sum
+        self._shards = _Shards(len(buckets) + 2)
+
+    def observe(self, value):
+        values = self._shards.local()
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        totals = child._shards.totals()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), totals):
+            cumulative += count
+            le = bound if bound == "+Inf" else repr(float(bound))
+            lines.append(f"{self.name}_bucket{self._label_text(values, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {totals[-1]}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Prometheus text exposition format (0.0.4) of every metric."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Dependency timings recorded by the datastore, password hasher and mailer
+DATASTORE_SECONDS = REGISTRY.histogram(
+    "aria_datastore_call_seconds", "Datastore call latency", ("op", "collection")
+)
+DATASTORE_ERRORS = REGISTRY.counter(
+    "aria_datastore_errors_total", "Datastore calls that raised", ("op", "collection")
+)
+BCRYPT_SECONDS = REGISTRY.histogram(
+    "aria_bcrypt_seconds", "bcrypt hash/verify latency including queueing", ("op",)
+)
+SMTP_SECONDS = REGISTRY.histogram(
+    "aria_smtp_seconds", "SMTP connect and send latency", ("op",)
+)
+SMTP_ERRORS = REGISTRY.counter(
+    "aria_smtp_errors_total", "Failed SMTP operations", ("op",)
+)
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording per-route request latency, status counts
+    and in-flight requests.
+
+    Requests are labelled with the matched route's path template (e.g.
+    /process/{job_id}), so label cardinality stays bounded; paths that
+    match no route are grouped as "<unmatched>".
+
+    Args:
+        app: ASGI application
+        registry: Registry the metrics are created in
+        route_cache_size: Distinct (method, path) route lookups remembered
+    """
+
+    def __init__(self, app, registry=REGISTRY, route_cache_size=2048):
+        self.app = app
+        self.route_cache_size = route_cache_size
+        self._routes = {}
+        self.duration = registry.histogram(
+            "aria_http_request_seconds", "HTTP request latency", ("method", "route")
+        )
+        self.requests = registry.counter(
+            "aria_http_requests_total", "HTTP requests", ("method", "route", "status")
+        )
+        self.in_flight = registry.gauge(
+            "aria_http_requests_in_flight", "HTTP requests being served", ("method", "route")
+        )
+
+    def _route(self, scope):
+        key = (scope["method"], scope["path"])
+        route = self._routes.get(key)
+        if route is None:
+            from starlette.routing import Match
+
+            route = "<unmatched>"
+            router = scope["app"].router
+            for candidate in router.routes:
+                match, _ = candidate.matches(scope)
+                if match != Match.NONE:
+                    route = getattr(candidate, "path", route)
+                    if match == Match.FULL:
+                        break
+            if len(self._routes) >= self.route_cache_size:
+                self._routes.clear()
+            self._routes[key] = route
+        return route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        labels = (scope["method"], self._route(scope))
+        in_flight = self.in_flight.labels(*labels)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.duration.labels(*labels).observe(time.perf_counter() - started)
+            self.requests.labels(*labels, str(status_code)).inc()
+            in_flight.inc(-1)
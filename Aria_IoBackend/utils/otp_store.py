@@ -0,0 +1,350 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+OTP_STORE_SECONDS = REGISTRY.histogram(
+    "aria_otp_store_seconds", "OTP store operation latency", ("op", "backend")
+)
+
+# Outcomes of OtpStore.verify_and_consume
+OTP_OK = "ok"
+OTP_MISSING = "missing"
+OTP_USED = "used"
+OTP_INVALID = "invalid"
+
+
+class OtpStore:
+    """
+    Keyed storage for pending one-time passwords, one record per email.
+
+    A record is a dict with the hashed "otp", its "purpose", a "verified"
+    flag and "expires_at" (epoch seconds). Expired records read as missing.
+    Verifying consumes the OTP: the hash is removed and the record becomes a
+    verified marker (which /signup checks) with a fresh TTL, so each code
+    can be used once even under concurrent attempts.
+
+    Subclasses implement _put, _get, _delete and _consume.
+    """
+
+    name = None
+
+    def _timed(self, op, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            OTP_STORE_SECONDS.labels(op, self.name).observe(time.perf_counter() - started)
+
+    def put(self, email, otp_hash, purpose, ttl):
+        """Store a new OTP for email, replacing any previous one."""
+        record = {
+            "otp": otp_hash,
+            "purpose": purpose,
+            "verified": False,
+            "expires_at": time.time() + ttl,
+        }
+        return self._timed("put", self._put, email, record, ttl)
+
+    def get(self, email):
+        """Return the live record for email, or None if there is none or it expired."""
+        return self._timed("get", self._get, email)
+
+    def delete(self, email):
+        return self._timed("delete", self._delete, email)
+
+    def verify_and_consume(self, email, check, verified_ttl):
+        """
+        Check an OTP and consume it atomically.
+
+        The hash comparison (possibly a slow bcrypt verify) runs outside any
+        lock; the consume step is a compare-and-set on the stored hash, so
+        of several concurrent correct attempts exactly one succeeds.
+
+        Args:
+            email: Address the OTP was issued for
+            check: Callable taking the stored hash, True if the user's OTP matches
+            verified_ttl: Seconds the verified marker stays valid
+
+        Returns:
+            Tuple (outcome, record), outcome being one of OTP_OK, OTP_MISSING,
+            OTP_USED or OTP_INVALID
+        """
+        record = self.get(email)
+        if record is None:
+            return OTP_MISSING, None
+        stored_hash = record.get("otp")
+        if record.get("verified") or not stored_hash:
+            return OTP_USED, record
+        if not check(stored_hash):
+            return OTP_INVALID, record
+        if not self._timed("consume", self._consume, email, stored_hash, verified_ttl):
+            return OTP_USED, record
+        return OTP_OK, record
+
+    def stats(self):
+        return {"backend": self.name}
+
+    def close(self):
+        pass
+
+
+class MemoryOtpStore(OtpStore):
+    """
+    In-process OTP store with a hashed timing wheel for expiry.
+
+    Each key is filed in the wheel slot of its expiry second. Every call
+    advances the wheel to the current time and drops the keys in the slots
+    it passed, so expired OTPs are removed in amortised O(1) without a
+    background thread. Keys due more than one revolution ahead are left in
+    place until their own turn comes round.
+
+    Only suitable for a single worker process: OTPs issued by one worker
+    are invisible to the others.
+
+    Args:
+        resolution: Seconds covered by one wheel slot
+        slots: Number of slots in the wheel
+    """
+
+    name = "memory"
+
+    def __init__(self, resolution=1.0, slots=512):
+        self.resolution = resolution
+        self.slots = slots
+        self._records = {}
+        self._wheel = [set() for _ in range(slots)]
+        self._tick = int(time.time() / resolution)
+        self._lock = threading.Lock()
+        self.expired = 0
+
+    def _slot(self, expires_at):
+        return self._wheel[int(expires_at / self.resolution) % self.slots]
+
+    def _advance(self, now):
+        # Called with the lock held
+        tick = int(now / self.resolution)
+        if tick <= self._tick:
+            return
+        # After a long idle spell one pass over the whole wheel is enough
+        first = max(self._tick + 1, tick - self.slots + 1)
+        for current in range(first, tick + 1):
+            slot = self._wheel[current % self.slots]
+            for email in [e for e in slot if self._records[e]["expires_at"] <= now]:
+                slot.discard(email)
+                del self._records[email]
+                self.expired += 1
+        self._tick = tick
+
+    def _file(self, email, record):
+        # Called with the lock held
+        previous = self._records.get(email)
+        if previous is not None:
+            self._slot(previous["expires_at"]).discard(email)
+        self._records[email] = record
+        self._slot(record["expires_at"]).add(email)
+
+    def _put(self, email, record, ttl):
+        with self._lock:
+            now = time.time()
+            self._advance(now)
+            self._file(email, record)
+        return True
+
+    def _get(self, email):
+        with self._lock:
+            now = time.time()
+            self._advance(now)
+            record = self._records.get(email)
+            if record is None or record["expires_at"] <= now:
+                return None
+            return dict(record)
+
+    def _delete(self, email):
+        with self._lock:
+            record = self._records.pop(email, None)
+            if record is not None:
+                self._slot(record["expires_at"]).discard(email)
+        return True
+
+    def _consume(self, email, otp_hash, verified_ttl):
+        with self._lock:
+            now = time.time()
+            self._advance(now)
+            record = self._records.get(email)
+            if record is None or record["expires_at"] <= now or record.get("otp") != otp_hash:
+                return False
+            self._file(email, dict(record, otp=None, verified=True, expires_at=now + verified_ttl))
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"backend": self.name, "size": len(self._records), "expired": self.expired}
+
+
+class RedisOtpStore(OtpStore):
+    """
+    OTP store on any Redis-protocol server, with expiry left to the server.
+
+    Each OTP is a hash at "<prefix><email>" with a key TTL; consuming runs a
+    Lua script so the compare-and-set happens in one server-side step and
+    is shared correctly by every worker process. Requires the redis package.
+
+    Args:
+        url: Server URL, e.g. redis://127.0.0.1:6379/0
+        prefix: Key prefix for OTP records
+    """
+
+    name = "redis"
+
+    _CONSUME_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'otp') ~= ARGV[1] then
+    return 0
+end
+redis.call('HDEL', KEYS[1], 'otp')
+redis.call('HSET', KEYS[1], 'verified', '1', 'expires_at', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+    def __init__(self, url, prefix="otp:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("OTP_STORE=redis needs the redis package (pip install redis)") from e
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._consume_script = self.client.register_script(self._CONSUME_SCRIPT)
+
+    def _put(self, email, record, ttl):
+        key = self.prefix + email
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hset(key, mapping={
+            "otp": record["otp"],
+            "purpose": record["purpose"],
+            "verified": "0",
+            "expires_at": repr(record["expires_at"]),
+        })
+        pipe.expire(key, max(1, int(ttl)))
+        pipe.execute()
+        return True
+
+    def _get(self, email):
+        data = self.client.hgetall(self.prefix + email)
+        if not data:
+            return None
+        return {
+            "otp": data.get("otp"),
+            "purpose": data.get("purpose", "login"),
+            "verified": data.get("verified") == "1",
+            "expires_at": float(data.get("expires_at", 0)),
+        }
+
+    def _delete(self, email):
+        self.client.delete(self.prefix + email)
+        return True
+
+    def _consume(self, email, otp_hash, verified_ttl):
+        expires_at = time.time() + verified_ttl
+        args = [otp_hash, max(1, int(verified_ttl)), repr(expires_at)]
+        return bool(self._consume_script(keys=[self.prefix + email], args=args))
+
+    def close(self):
+        self.client.close()
+
+
+class FirestoreOtpStore(OtpStore):
+    """
+    OTP records as documents in the "OTP DB" collection, as before.
+
+    Kept for deployments that share OTPs through Firestore. expires_at is
+    written as a timestamp so a Firestore TTL policy can delete expired
+    documents; the legacy string "timestamp" is still written and is used
+    to derive the expiry of documents from older versions.
+
+    Args:
+        backend: Datastore backend (see utils.datastore)
+        legacy_ttl: Lifetime assumed for documents without expires_at
+    """
+
+    name = "firestore"
+    collection = "OTP DB"
+
+    def __init__(self, backend, legacy_ttl=300):
+        self.backend = backend
+        self.legacy_ttl = legacy_ttl
+
+    def _expires_at(self, data):
+        expires_at = data.get("expires_at")
+        if isinstance(expires_at, datetime):
+            return expires_at.timestamp()
+        timestamp = data.get("timestamp")
+        if not timestamp:
+            return 0.0
+        issued = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+        return (issued + timedelta(seconds=self.legacy_ttl)).timestamp()
+
+    def _put(self, email, record, ttl):
+        data = {
+            "otp": record["otp"],
+            "purpose": record["purpose"],
+            "verified": False,
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "expires_at": datetime.fromtimestamp(record["expires_at"], timezone.utc),
+        }
+        return self.backend.set(self.collection, email, data)
+
+    def _get(self, email):
+        data = self.backend.get(self.collection, email)
+        if data is None:
+            return None
+        expires_at = self._expires_at(data)
+        if expires_at <= time.time():
+            return None
+        return {
+            "otp": data.get("otp"),
+            "purpose": data.get("purpose", "login"),
+            "verified": bool(data.get("verified", False)),
+            "expires_at": expires_at,
+        }
+
+    def _delete(self, email):
+        return self.backend.delete(self.collection, email)
+
+    def _consume(self, email, otp_hash, verified_ttl):
+        def still_pending(data):
+            return data.get("otp") == otp_hash and self._expires_at(data) > time.time()
+
+        expires_at = datetime.fromtimestamp(time.time() + verified_ttl, timezone.utc)
+        return self.backend.update_if(
+            self.collection, email, still_pending,
+            {"otp": None, "verified": True, "expires_at": expires_at},
+        )
+
+
+def create_otp_store(backend):
+    """
+    Build the OtpStore selected by the OTP_STORE environment variable.
+
+    OTP_STORE=memory (the default) keeps OTPs in process, redis uses the
+    server at OTP_REDIS_URL and firestore keeps them in the "OTP DB"
+    collection of the given datastore backend. Run more than one worker
+    only with redis or firestore.
+    """
+    kind = os.getenv("OTP_STORE", "memory").lower()
+    if kind == "redis":
+        url = os.getenv("OTP_REDIS_URL", "redis://127.0.0.1:6379/0")
+        logger.info("OTP store: redis at %s", url)
+        return RedisOtpStore(url, prefix=os.getenv("OTP_REDIS_PREFIX", "otp:"))
+    if kind == "firestore":
+        logger.info("OTP store: firestore")
+        return FirestoreOtpStore(backend, legacy_ttl=int(os.getenv("OTP_TTL", "300")))
+    if kind != "memory":
+        raise ValueError(f"Unknown OTP_STORE {kind!r}, expected memory, redis or firestore")
+    return MemoryOtpStore()
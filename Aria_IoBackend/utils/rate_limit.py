@@ -0,0 +1,194 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED = REGISTRY.counter(
+    "aria_rate_limited_total", "Requests rejected by a rate limiter", ("limiter",)
+)
+
+
+class RateLimitResult:
+    """Outcome of one rate limit check, with the values for the RateLimit-* headers."""
+
+    __slots__ = ("allowed", "limit", "remaining", "reset", "retry_after")
+
+    def __init__(self, allowed, limit, remaining, reset, retry_after):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_tokens(cls, allowed, tokens, capacity, rate, cost):
+        return cls(
+            allowed=allowed,
+            limit=capacity,
+            remaining=max(0, int(tokens)),
+            # Seconds until the bucket is full again
+            reset=math.ceil((capacity - tokens) / rate),
+            retry_after=0 if allowed else math.ceil((cost - tokens) / rate),
+        )
+
+    def headers(self):
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(self.reset),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, self.retry_after))
+        return headers
+
+
+def parse_rate(spec):
+    """Parse "<requests>/<seconds>" into (capacity, tokens per second)."""
+    requests, _, seconds = spec.partition("/")
+    capacity = int(requests)
+    period = float(seconds or 1)
+    if capacity <= 0 or period <= 0:
+        raise ValueError(f"Invalid rate {spec!r}, expected <requests>/<seconds>")
+    return capacity, capacity / period
+
+
+class TokenBucketLimiter:
+    """
+    In-process token buckets, one per key, held in a bounded LRU.
+
+    A bucket holds up to capacity tokens and refills at rate tokens per
+    second; each request takes one. Only two floats are kept per key, and
+    when maxsize keys are tracked the least recently used bucket is
+    dropped, which at worst lets that key start again with a full bucket.
+    Limits are per worker process; use RedisTokenBucketLimiter to share
+    them between workers.
+
+    Args:
+        name: Label for logs and the aria_rate_limited_total metric
+        capacity: Burst size, in requests
+        rate: Refill rate, in requests per second
+        maxsize: Maximum number of keys tracked
+    """
+
+    # hit() never waits on I/O, so the event loop may call it directly
+    blocking = False
+
+    def __init__(self, name, capacity, rate, maxsize=100000):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = self.capacity
+                if len(self._buckets) >= self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+                self._buckets.move_to_end(key)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+        if not allowed:
+            RATE_LIMITED.labels(self.name).inc()
+        return RateLimitResult.from_tokens(allowed, tokens, self.capacity, self.rate, cost)
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "keys": len(self._buckets)}
+
+
+class RedisTokenBucketLimiter:
+    """
+    Token buckets kept on a Redis-protocol server, shared by all workers.
+
+    The refill-and-take step runs as one Lua script using the server's
+    clock, and idle buckets expire once they would be full again. If the
+    server can't be reached requests are allowed, so an outage of the
+    limiter never locks users out. Requires the redis package.
+
+    Args:
+        name: Label for logs, metrics and the key prefix
+        capacity: Burst size, in requests
+        rate: Refill rate, in requests per second
+        url: Server URL, e.g. redis://127.0.0.1:6379/0
+    """
+
+    # hit() makes a network round trip; async code must call it from a thread
+    blocking = True
+
+    _HIT_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+    def __init__(self, name, capacity, rate, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the redis package (pip install redis)") from e
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+        self.prefix = f"ratelimit:{name}:"
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._hit_script = self.client.register_script(self._HIT_SCRIPT)
+        self.errors = 0
+
+    def hit(self, key, cost=1):
+        try:
+            allowed, tokens = self._hit_script(
+                keys=[self.prefix + key], args=[self.capacity, self.rate, cost]
+            )
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Rate limiter %s unavailable, allowing request: %s", self.name, e)
+            return RateLimitResult.from_tokens(True, self.capacity, self.capacity, self.rate, cost)
+        allowed = bool(allowed)
+        if not allowed:
+            RATE_LIMITED.labels(self.name).inc()
+        return RateLimitResult.from_tokens(allowed, float(tokens), self.capacity, self.rate, cost)
+
+    def stats(self):
+        return {"backend": "redis", "errors": self.errors}
+
+
+def create_rate_limiter(name, spec, maxsize=100000):
+    """
+    Build a limiter for "<requests>/<seconds>" on the backend selected by
+    RATE_LIMIT_BACKEND: memory (the default, per worker) or redis, at
+    RATE_LIMIT_REDIS_URL.
+    """
+    capacity, rate = parse_rate(spec)
+    if os.getenv("RATE_LIMIT_BACKEND", "memory").lower() == "redis":
+        url = os.getenv("RATE_LIMIT_REDIS_URL", "redis://127.0.0.1:6379/0")
+        return RedisTokenBucketLimiter(name, capacity, rate, url)
+    return TokenBucketLimiter(name, capacity, rate, maxsize=maxsize)
@@ -0,0 +1,99 @@
+import time
+
+SEARCH_MODES = ("hybrid", "lexical", "vector")
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuse ranked lists of ids: each id scores sum(1 / (k + rank)) over the
+    lists it appears in, with ranks starting at 1.
+
+    Returns:
+        List of (id, score) tuples, best first
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def _vector_params(budget_ms, k):
+    """Candidate depth and ANN settings for a latency budget; tighter budgets probe less."""
+    if budget_ms is None:
+        return max(3 * k, 30), {}
+    if budget_ms < 20:
+        return k, {"ef_search": max(k, 16), "nprobe": 1}
+    if budget_ms < 100:
+        return 2 * k, {"ef_search": max(2 * k, 48), "nprobe": 4}
+    return max(3 * k, 30), {"ef_search": max(3 * k, 128), "nprobe": 16}
+
+
+def hybrid_search(store, embedder, queries, k=10, mode="hybrid", budget_ms=None, rrf_k=60):
+    """
+    Run a batch of queries against a tenant's chunks.
+
+    BM25 and vector candidates are fused with reciprocal rank fusion. All
+    queries are embedded in one call and searched as one FAISS batch.
+
+    Args:
+        store: VectorStore of the tenant
+        embedder: Embedder with embed_query
+        queries: List of query strings
+        k: Results per query
+        mode: "hybrid", "lexical" or "vector"
+        budget_ms: Optional latency budget. Lower budgets shrink the
+            candidate depth and ANN search effort and let BM25 skip the
+            most common query terms once the budget is spent, trading
+            recall for speed.
+        rrf_k: Reciprocal rank fusion constant
+
+    Returns:
+        Dict with one result list per query, "truncated" and "took_ms"
+    """
+    started = time.monotonic()
+    deadline = started + budget_ms / 1000 if budget_ms is not None else None
+    depth, params = _vector_params(budget_ms, k)
+
+    query_vectors = embedder.embed_query(queries) if mode in ("hybrid", "vector") else None
+
+    vector_hits = [[] for _ in queries]
+    lexical_hits = [[] for _ in queries]
+    truncated = False
+    # Both rankings come from one index generation, so the fused ids match
+    # the chunk table even while another worker saves
+    with store.consistent():
+        if query_vectors is not None:
+            vector_hits = store.search(query_vectors, depth, **params)
+        if mode in ("hybrid", "lexical"):
+            for number, query in enumerate(queries):
+                lexical_hits[number], skipped = store.lexical_search(query, depth, deadline)
+                truncated = truncated or skipped
+
+    ranked = []
+    for lexical, vector in zip(lexical_hits, vector_hits):
+        lexical_ranks = {doc_id: rank for rank, (doc_id, _) in enumerate(lexical, start=1)}
+        vector_ranks = {doc_id: rank for rank, (doc_id, _) in enumerate(vector, start=1)}
+        fused = reciprocal_rank_fusion([list(lexical_ranks), list(vector_ranks)], k=rrf_k)[:k]
+        ranked.append([(doc_id, score, lexical_ranks.get(doc_id), vector_ranks.get(doc_id))
+                       for doc_id, score in fused])
+
+    chunks = store.get_chunks({doc_id for hits in ranked for doc_id, *_ in hits})
+    results = []
+    for hits in ranked:
+        results.append([
+            {
+                "id": doc_id,
+                "score": round(score, 6),
+                "bm25_rank": lexical_rank,
+                "vector_rank": vector_rank,
+                **chunks[doc_id],
+            }
+            for doc_id, score, lexical_rank, vector_rank in hits
+            if doc_id in chunks
+        ])
+    return {
+        "results": results,
+        "truncated": truncated,
+        "took_ms": round((time.monotonic() - started) * 1000, 3),
+    }
@@ -0,0 +1,44 @@
+import importlib.util
+import logging
+import os
+
+try:
+    from uvicorn_worker import UvicornWorker
+except ImportError:
+    # Older uvicorn releases ship the worker themselves
+    from uvicorn.workers import UvicornWorker
+
+logger = logging.getLogger(__name__)
+
+
+def _installed(module):
+    return importlib.util.find_spec(module) is not None
+
+
+class AriaUvicornWorker(UvicornWorker):
+    """
+    Gunicorn worker running the app on uvicorn.
+
+    Uses uvloop and httptools when they are installed (uvicorn[standard],
+    which fastapi[all] pulls in) and falls back to asyncio and h11. On
+    shutdown open connections get graceful_timeout minus
+    SHUTDOWN_FLUSH_SECONDS to finish; the rest of graceful_timeout is left
+    for the lifespan shutdown to deliver queued emails and flush pending
+    write-behind updates before gunicorn kills the worker.
+    """
+
+    CONFIG_KWARGS = {"loop": "auto", "http": "auto", "lifespan": "on"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        flush_reserve = int(os.getenv("SHUTDOWN_FLUSH_SECONDS", "20"))
+        self.config.timeout_graceful_shutdown = max(1, self.cfg.graceful_timeout - flush_reserve)
+
+    def init_process(self):
+        logger.info(
+            "Worker %d starting (loop=%s, http=%s)",
+            os.getpid(),
+            "uvloop" if _installed("uvloop") else "asyncio",
+            "httptools" if _installed("httptools") else "h11",
+        )
+        super().init_process()
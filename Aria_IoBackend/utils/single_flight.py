@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from utils.metrics import REGISTRY
+
+SINGLE_FLIGHT_CALLS = REGISTRY.counter(
+    "aria_single_flight_calls_total",
+    "Calls through a single-flight group, by whether they executed or were collapsed",
+    ("group", "outcome"),
+)
+
+
+class SingleFlight:
+    """
+    Collapses duplicate calls for the same key into one execution.
+
+    While a call for a key is running, further calls for that key wait for
+    it and get its result (or exception) instead of running again. A
+    successful result is also handed out to calls arriving within window
+    seconds after it completed; failures are not remembered, so the next
+    call retries. Works for both threads (do) and coroutines (do_async),
+    which share in-flight calls with each other.
+
+    Args:
+        name: Group label for the aria_single_flight_calls_total metric
+        window: Seconds a completed result keeps being reused, 0 to only
+            collapse calls that overlap
+        maxsize: Maximum number of completed results remembered
+    """
+
+    def __init__(self, name, window=10.0, maxsize=10000):
+        self.name = name
+        self.window = window
+        self.maxsize = maxsize
+        # key -> (future, completed_at); completed_at is None while in flight
+        self._calls = OrderedDict()
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.collapsed = 0
+        self.reused = 0
+
+    def _claim(self, key):
+        """Return (future, leader); the leader must complete the future via _finish()."""
+        now = time.monotonic()
+        with self._lock:
+            # Entries move to the end when they complete, so expired ones
+            # collect at the front; an in-flight entry there ends the purge
+            while self._calls:
+                oldest, (_, completed_at) = next(iter(self._calls.items()))
+                if completed_at is None or (now - completed_at < self.window and len(self._calls) <= self.maxsize):
+                    break
+                del self._calls[oldest]
+            entry = self._calls.get(key)
+            if entry is not None:
+                future, completed_at = entry
+                if completed_at is None:
+                    self.collapsed += 1
+                    SINGLE_FLIGHT_CALLS.labels(self.name, "collapsed").inc()
+                    return future, False
+                if now - completed_at < self.window:
+                    self.reused += 1
+                    SINGLE_FLIGHT_CALLS.labels(self.name, "reused").inc()
+                    return future, False
+            future = Future()
+            self._calls[key] = (future, None)
+            self.executed += 1
+            SINGLE_FLIGHT_CALLS.labels(self.name, "executed").inc()
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key, (None,))[0] is future:
+                if error is None and self.window > 0:
+                    self._calls[key] = (future, time.monotonic())
+                    self._calls.move_to_end(key)
+                else:
+                    del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs) unless a call for key is in flight or recent."""
+        future, leader = self._claim(key)
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    async def do_async(self, key, func, *args, **kwargs):
+        """Await func(*args, **kwargs) unless a call for key is in flight or recent."""
+        future, leader = self._claim(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    def forget(self, key):
+        """Drop a remembered result so the next call for key runs again."""
+        with self._lock:
+            entry = self._calls.get(key)
+            if entry is not None and entry[1] is not None:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            size = len(self._calls)
+        return {
+            "entries": size,
+            "executed": self.executed,
+            "collapsed": self.collapsed,
+            "reused": self.reused,
+        }
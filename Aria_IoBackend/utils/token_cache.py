@@ -0,0 +1,90 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of verified JWT claims, keyed by the SHA-256 of the token.
+
+    Entries are kept until the token's "exp" claim. Each entry records the
+    global and per-subject generation it was verified under; bumping either
+    with revoke_all()/revoke_subject() makes those entries miss so the token
+    goes through full verification again. This only drops cached claims:
+    rejecting revoked tokens is up to the caller, which in main compares
+    the token's "gen" claim with the user's stored token generation.
+
+    Args:
+        maxsize: Maximum number of cached tokens
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._subject_generations = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        """Return the cached claims for token, or None if it needs verifying."""
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                claims, expires_at, generation, subject_generation = entry
+                if (expires_at > time.time()
+                        and generation == self.generation
+                        and subject_generation == self._subject_generations.get(claims.get("sub"), 0)):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(claims)
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, claims):
+        """Cache claims that were just verified. Tokens without exp are not cached."""
+        expires_at = claims.get("exp")
+        if not isinstance(expires_at, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (
+                dict(claims),
+                expires_at,
+                self.generation,
+                self._subject_generations.get(claims.get("sub"), 0),
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def revoke_subject(self, subject):
+        """Force re-verification of every cached token for one subject."""
+        with self._lock:
+            self._subject_generations[subject] = self._subject_generations.get(subject, 0) + 1
+
+    def revoke_all(self):
+        """Force re-verification of every cached token, e.g. after the signing key changed."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "generation": self.generation,
+            }
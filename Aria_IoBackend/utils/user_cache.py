@@ -0,0 +1,107 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """
+    Process-local LRU cache of User documents with a time-to-live.
+
+    Missing documents are cached as None with a shorter TTL so repeated
+    existence checks for unknown emails don't all go to Firestore. Values are
+    deep-copied in and out so callers can mutate what they get back.
+
+    Args:
+        maxsize: Maximum number of cached documents
+        ttl: Seconds a found document stays valid
+        negative_ttl: Seconds a missing document stays cached
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, negative_ttl=5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at <= now:
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _store(self, key, value, now):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self._entries[key] = (now + ttl, copy.deepcopy(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Return the cached document for key, calling loader(key) on a miss.
+
+        Concurrent misses on the same key wait for the first loader instead
+        of issuing duplicate reads.
+        """
+        while True:
+            with self._lock:
+                found, value = self._lookup(key, time.monotonic())
+                if found:
+                    self.hits += 1
+                    return copy.deepcopy(value)
+                pending = self._loading.get(key)
+                if pending is None:
+                    self.misses += 1
+                    pending = self._loading[key] = threading.Event()
+                    break
+            pending.wait()
+
+        try:
+            value = loader(key)
+            with self._lock:
+                # Don't cache a value that was invalidated while loading
+                if self._loading.get(key) is pending:
+                    self._store(key, value, time.monotonic())
+            return copy.deepcopy(value)
+        finally:
+            with self._lock:
+                if self._loading.get(key) is pending:
+                    del self._loading[key]
+            pending.set()
+
+    def invalidate(self, key):
+        """Drop a cached document after it has been written."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._loading.pop(key, None)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,74 @@
+import csv
+import json
+
+IMPORT_FORMATS = ("csv", "ndjson")
+
+
+class LineTooLong(ValueError):
+    """Raised when an import line exceeds the maximum length."""
+
+
+async def iter_lines(chunks, max_line=65536):
+    """
+    Split an async iterable of byte chunks into lines, as bytes.
+
+    Only the current partial line is buffered, so memory stays bounded by
+    max_line however large the upload is. Lines are decoded by
+    iter_records, which reports undecodable ones like any invalid line.
+    """
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+        if len(buffer) > max_line:
+            raise LineTooLong(f"Line longer than {max_line} bytes")
+    if buffer:
+        yield buffer.rstrip(b"\r")
+
+
+async def iter_records(lines, fmt):
+    """
+    Parse user records from UTF-8 CSV (with a header row) or NDJSON lines.
+
+    CSV rows may not contain quoted newlines. A "domains" column holds
+    semicolon-separated domains; in NDJSON it is a list.
+
+    Yields:
+        Tuples (line_number, record, error); record is None when the line
+        could not be parsed and error says why
+    """
+    header = None
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        try:
+            line = line.decode("utf-8")
+        except UnicodeDecodeError as e:
+            yield line_number, None, f"Invalid UTF-8: {e}"
+            continue
+        if not line.strip():
+            continue
+        if fmt == "csv":
+            row = next(csv.reader([line]))
+            if header is None:
+                header = [name.strip().lower() for name in row]
+                continue
+            if len(row) != len(header):
+                yield line_number, None, f"Expected {len(header)} columns, got {len(row)}"
+                continue
+            record = dict(zip(header, row))
+            if "domains" in record:
+                record["domains"] = [d.strip() for d in record["domains"].split(";") if d.strip()]
+            yield line_number, record, None
+        else:
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(record, dict):
+                yield line_number, None, "Expected a JSON object"
+                continue
+            yield line_number, record, None
@@ -0,0 +1,450 @@
+import math
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils.bm25 import BM25Index
+from utils.file_lock import file_lock
+
+# Corpus sizes at which the index type changes: exact search up to
+# FLAT_MAX vectors, HNSW up to HNSW_MAX, IVF beyond that
+FLAT_MAX = int(os.getenv("VECTOR_FLAT_MAX", "20000"))
+HNSW_MAX = int(os.getenv("VECTOR_HNSW_MAX", "500000"))
+
+# Fraction of deleted-but-still-indexed vectors that triggers a rebuild
+REBUILD_STALE_FRACTION = 0.2
+
+
+def choose_index_kind(count):
+    if count <= FLAT_MAX:
+        return "flat"
+    if count <= HNSW_MAX:
+        return "hnsw"
+    return "ivf"
+
+
+def build_index(kind, dim, vectors=None):
+    """
+    Create an empty IndexIDMap2 of the given kind for inner-product search.
+
+    IVF indexes need training vectors to place their centroids.
+    """
+    import faiss
+
+    if kind == "hnsw":
+        inner = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        inner.hnsw.efConstruction = 80
+    elif kind == "ivf":
+        nlist = max(1, int(4 * math.sqrt(len(vectors))))
+        inner = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        sample = vectors[np.random.default_rng(0).choice(len(vectors), min(len(vectors), nlist * 64), replace=False)]
+        inner.train(sample)
+    else:
+        inner = faiss.IndexFlatIP(dim)
+    return faiss.IndexIDMap2(inner)
+
+
+class VectorStore:
+    """
+    Persistent per-tenant vector index over document chunks.
+
+    SQLite (chunks.db) is the source of truth for chunk text, metadata and
+    raw vectors. The FAISS index (index.faiss) is derived from it and is
+    loaded memory-mapped and read-only, so reloads take milliseconds and
+    server workers share the index pages. The first mutation after a load
+    switches to a private in-memory copy; save() writes it back atomically.
+
+    Deleted chunks disappear from SQLite immediately and are filtered out of
+    search results; the index itself is rebuilt once enough of it is stale
+    or the corpus outgrows its index kind.
+
+    A BM25 inverted index over the same chunk ids (bm25.npz, available as
+    .lexical) is updated alongside every add and delete.
+
+    Several processes may open the same store. Each save() bumps a
+    generation number in chunks.db under an exclusive lock on index.lock;
+    other processes see the new generation on their next call and reload
+    the files. A process that has unsaved changes of its own when that
+    happens rebuilds both indexes from chunks.db instead, which holds the
+    chunks of every process.
+
+    Args:
+        root: Directory holding chunks.db and index.faiss
+        dim: Embedding dimension
+        model_id: Embedding model the vectors come from
+    """
+
+    def __init__(self, root, dim, model_id):
+        self.root = root
+        self.dim = dim
+        self.model_id = model_id
+        self.index_path = os.path.join(root, "index.faiss")
+        self.lock_path = os.path.join(root, "index.lock")
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(root, "chunks.db"), check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                idx INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                vector BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chunks_source ON chunks(source, page);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self._check_model()
+        self._index = None
+        self._kind = None
+        self._writable = False
+        self._stale = 0
+        self._dirty = False
+        with file_lock(self.lock_path, shared=True):
+            self._generation = self._read_generation()
+            self._load()
+            self.lexical = BM25Index(os.path.join(root, "bm25.npz"))
+        if len(self.lexical) != self.count():
+            self._rebuild_lexical()
+            self.save()
+
+    def _check_model(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'model_id'").fetchone()
+        if row is None:
+            with self._db:
+                self._db.execute("INSERT INTO meta VALUES ('model_id', ?)", (self.model_id,))
+                self._db.execute("INSERT INTO meta VALUES ('dim', ?)", (str(self.dim),))
+        elif row[0] != self.model_id:
+            raise ValueError(
+                f"Index at {self.root} was built with {row[0]}, not {self.model_id}; rebuild it"
+            )
+
+    def _read_generation(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _refresh(self, locked=False):
+        """
+        Catch up with a save() made by another process since this one last
+        loaded or saved the indexes.
+
+        Args:
+            locked: The caller already holds the exclusive lock on lock_path
+        """
+        generation = self._read_generation()
+        if generation == self._generation:
+            return
+        if self._dirty:
+            # Both sides have changes; chunks.db has all of them
+            self._rebuild()
+            self._rebuild_lexical()
+        elif locked:
+            self._load()
+            self.lexical = BM25Index(self.lexical.path)
+        else:
+            with file_lock(self.lock_path, shared=True):
+                generation = self._read_generation()
+                self._load()
+                self.lexical = BM25Index(self.lexical.path)
+        self._generation = generation
+
+    def _load(self):
+        import faiss
+
+        if not os.path.exists(self.index_path):
+            self._rebuild()
+            return
+        try:
+            self._index = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            self._writable = False
+        except RuntimeError:
+            self._index = faiss.read_index(self.index_path)
+            self._writable = True
+        self._kind = self._detect_kind()
+        self._stale = max(0, self._index.ntotal - self.count())
+
+    def _detect_kind(self):
+        import faiss
+
+        inner = faiss.downcast_index(self._index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            return "hnsw"
+        if isinstance(inner, faiss.IndexIVF):
+            return "ivf"
+        return "flat"
+
+    def _make_writable(self):
+        import faiss
+
+        if not self._writable:
+            self._index = faiss.read_index(self.index_path)
+            self._writable = True
+
+    def _all_vectors(self):
+        rows = self._db.execute("SELECT id, vector FROM chunks ORDER BY id").fetchall()
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), self.dim)
+        return ids, vectors
+
+    def _rebuild(self):
+        ids, vectors = self._all_vectors()
+        self._kind = choose_index_kind(len(ids))
+        self._index = build_index(self._kind, self.dim, vectors)
+        if len(ids):
+            self._index.add_with_ids(vectors, ids)
+        self._writable = True
+        self._stale = 0
+        self._dirty = True
+
+    def _rebuild_lexical(self):
+        self.lexical = BM25Index(self.lexical.path, load=False)
+        cursor = self._db.execute("SELECT id, text FROM chunks ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            self.lexical.add([row[0] for row in rows], [row[1] for row in rows])
+
+    def count(self):
+        return self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def add(self, chunks, vectors):
+        """
+        Add chunks with their embeddings.
+
+        Args:
+            chunks: Sequence of ingestion.Chunk
+            vectors: (len(chunks), dim) float32 array
+
+        Returns:
+            Array of the ids assigned to the chunks
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            self._refresh()
+            with self._db:
+                # Take the write lock up front so processes adding at once
+                # wait for each other instead of reading the same next_id
+                self._db.execute("BEGIN IMMEDIATE")
+                # Ids are never reused: deleted HNSW vectors keep theirs until a rebuild
+                row = self._db.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+                start = int(row[0]) if row else 1
+                ids = np.arange(start, start + len(chunks), dtype=np.int64)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('next_id', ?)", (str(start + len(chunks)),)
+                )
+                self._db.executemany(
+                    "INSERT INTO chunks (id, source, page, idx, text, vector) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(int(i), c.source, c.page, c.index, c.text, v.tobytes())
+                     for i, c, v in zip(ids, chunks, vectors)],
+                )
+            self._make_writable()
+            self._index.add_with_ids(vectors, ids)
+            self.lexical.add(ids, [c.text for c in chunks])
+            self._dirty = True
+            return ids
+
+    def delete(self, ids):
+        """Delete chunks by id. Returns how many existed."""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return 0
+        with self._lock:
+            self._refresh()
+            with self._db:
+                deleted = 0
+                for start in range(0, len(ids), 500):
+                    batch = ids[start:start + 500]
+                    deleted += self._db.execute(
+                        f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch
+                    ).rowcount
+            if self._kind == "hnsw":
+                # HNSW can't remove vectors; they are filtered at search time
+                self._stale += deleted
+            else:
+                self._make_writable()
+                self._index.remove_ids(np.asarray(ids, dtype=np.int64))
+            self.lexical.delete(ids)
+            self._dirty = True
+            return deleted
+
+    def delete_source(self, source):
+        """Delete every chunk of one source document. Returns how many were deleted."""
+        with self._lock:
+            ids = [row[0] for row in self._db.execute("SELECT id FROM chunks WHERE source = ?", (source,))]
+            return self.delete(ids)
+
+    def delete_pages(self, source, pages):
+        """Delete the chunks of some pages of a source document. Returns how many were deleted."""
+        pages = [int(page) for page in pages]
+        with self._lock:
+            ids = []
+            for start in range(0, len(pages), 500):
+                batch = pages[start:start + 500]
+                ids.extend(row[0] for row in self._db.execute(
+                    f"SELECT id FROM chunks WHERE source = ? AND page IN ({','.join('?' * len(batch))})",
+                    [source, *batch],
+                ))
+            return self.delete(ids)
+
+    def search(self, vectors, k=10, nprobe=None, ef_search=None):
+        """
+        Batched top-k inner-product search.
+
+        Args:
+            vectors: (n, dim) float32 array of query embeddings
+            k: Results per query
+            nprobe: IVF lists probed per query (IVF indexes only)
+            ef_search: HNSW candidate list size (HNSW indexes only)
+
+        Returns:
+            One list of (chunk_id, score) tuples per query, best first
+        """
+        import faiss
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            self._refresh()
+            if self._index.ntotal == 0:
+                return [[] for _ in range(len(vectors))]
+            inner = faiss.downcast_index(self._index.index)
+            if nprobe and self._kind == "ivf":
+                inner.nprobe = nprobe
+            if ef_search and self._kind == "hnsw":
+                inner.hnsw.efSearch = ef_search
+            # Over-fetch so results dropped as stale still leave k hits
+            fetch = min(self._index.ntotal, k + self._stale)
+            scores, ids = self._index.search(vectors, fetch)
+            live = self._live_ids({int(i) for i in ids.ravel() if i >= 0}) if self._stale else None
+        results = []
+        for row_ids, row_scores in zip(ids, scores):
+            hits = [(int(i), float(s)) for i, s in zip(row_ids, row_scores)
+                    if i >= 0 and (live is None or int(i) in live)]
+            results.append(hits[:k])
+        return results
+
+    def lexical_search(self, query, k=10, deadline=None):
+        """BM25 search (see BM25Index.search) over the same generation as search()."""
+        with self._lock:
+            self._refresh()
+            return self.lexical.search(query, k, deadline)
+
+    @contextmanager
+    def consistent(self):
+        """
+        Hold the store at one generation for the block, so several search()
+        and lexical_search() calls see the same chunks; saves and reloads in
+        this process wait until it ends.
+        """
+        with self._lock:
+            self._refresh()
+            yield self
+
+    def _live_ids(self, ids):
+        ids = list(ids)
+        live = set()
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            live.update(row[0] for row in self._db.execute(
+                f"SELECT id FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch
+            ))
+        return live
+
+    def get_chunks(self, ids):
+        """Return {id: {"source", "page", "index", "text"}} for the given chunk ids."""
+        ids = [int(i) for i in ids]
+        chunks = {}
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                for row in self._db.execute(
+                    f"SELECT id, source, page, idx, text FROM chunks WHERE id IN ({','.join('?' * len(batch))})",
+                    batch,
+                ):
+                    chunks[row[0]] = {"source": row[1], "page": row[2], "index": row[3], "text": row[4]}
+        return chunks
+
+    def save(self):
+        """
+        Persist the index if it changed, rebuilding it first when it is too
+        stale or the corpus outgrew its index kind.
+
+        Returns:
+            Whether index.faiss was written
+        """
+        import faiss
+
+        with self._lock, file_lock(self.lock_path):
+            self._refresh(locked=True)
+            count = self.count()
+            if (choose_index_kind(count) != self._kind
+                    or self._stale > REBUILD_STALE_FRACTION * max(count, 1)):
+                self._rebuild()
+            saved = self.lexical.save()
+            written = self._dirty
+            if written:
+                tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+                faiss.write_index(self._index, tmp_path)
+                os.replace(tmp_path, self.index_path)
+                self._dirty = False
+            if saved or written:
+                self._generation += 1
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (str(self._generation),)
+                    )
+            return written
+
+    def stats(self):
+        with self._lock:
+            self._refresh()
+            return {
+                "chunks": self.count(),
+                "indexed": self._index.ntotal,
+                "kind": self._kind,
+                "stale": self._stale,
+                "mmapped": not self._writable,
+                "model_id": self.model_id,
+                "lexical": self.lexical.stats(),
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class VectorStoreRegistry:
+    """
+    Keeps one open VectorStore per tenant.
+
+    Args:
+        root_for: Callable mapping a tenant to its index directory
+        embedder: Embedder whose dim and model_id the stores use
+    """
+
+    def __init__(self, root_for, embedder):
+        self.root_for = root_for
+        self.embedder = embedder
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def get(self, tenant):
+        with self._lock:
+            store = self._stores.get(tenant)
+            if store is None:
+                store = self._stores[tenant] = VectorStore(
+                    self.root_for(tenant), self.embedder.dim, self.embedder.model_id
+                )
+            return store
+
+    def close(self):
+        with self._lock:
+            stores, self._stores = self._stores, {}
+        for store in stores.values():
+            store.save()
+            store.close()
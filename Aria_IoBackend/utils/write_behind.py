@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WriteBehindBuffer:
+    """
+    Buffers non-critical document updates and flushes them in batches.
+
+    Updates to the same document are coalesced (later fields win) until a
+    flush, which happens every flush_interval seconds or as soon as
+    max_batch documents are pending. Whatever cannot be written on shutdown
+    is spooled to a JSON-lines file next to spool_path and replayed on the
+    next start, so only JSON-serialisable update values may be buffered.
+
+    Args:
+        backend: Datastore backend providing batch_update()
+        max_batch: Documents per batched write, and the size flush trigger
+        flush_interval: Maximum seconds an update waits before being flushed
+        spool_path: Base name of the per-process files that persist
+            unflushed updates on shutdown
+    """
+
+    def __init__(self, backend, max_batch=500, flush_interval=1.0, spool_path=None):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self._pending = {}
+        self._first_queued = {}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self._backing_off = False
+        self.updates = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_lag = 0.0
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def update(self, collection, doc_id, data):
+        """Queue a field update for collection/doc_id."""
+        self.start()
+        key = (collection, doc_id)
+        with self._cond:
+            self.updates += 1
+            if key in self._pending:
+                self.coalesced += 1
+                self._pending[key].update(data)
+            else:
+                self._pending[key] = dict(data)
+                self._first_queued[key] = time.monotonic()
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # After a failed flush wait a full interval even if the batch is full
+                if not self._stopping and (self._backing_off or len(self._pending) < self.max_batch):
+                    self._cond.wait(self.flush_interval)
+                if self._stopping:
+                    return
+            self.flush()
+
+    def _take(self):
+        with self._cond:
+            pending, self._pending = self._pending, {}
+            queued, self._first_queued = self._first_queued, {}
+        return pending, queued
+
+    def _restore(self, pending, queued):
+        # Put failed updates back without overwriting anything queued since
+        with self._cond:
+            for key, data in pending.items():
+                if key in self._pending:
+                    data.update(self._pending[key])
+                self._pending[key] = data
+                self._first_queued[key] = min(queued[key], self._first_queued.get(key, queued[key]))
+
+    def flush(self):
+        """Write all pending updates now. Returns the number of documents written."""
+        with self._flush_lock:
+            pending, queued = self._take()
+            if not pending:
+                return 0
+            keys = list(pending)
+            written = 0
+            self._backing_off = False
+            for start in range(0, len(keys), self.max_batch):
+                chunk = keys[start:start + self.max_batch]
+                try:
+                    self.backend.batch_update([(c, d, pending[(c, d)]) for c, d in chunk])
+                except Exception as e:
+                    self.failures += 1
+                    self._backing_off = True
+                    logger.error("Write-behind flush failed, will retry: %s", e)
+                    remaining = keys[start:]
+                    self._restore({k: pending[k] for k in remaining}, queued)
+                    break
+                now = time.monotonic()
+                self.last_lag = max(now - queued[key] for key in chunk)
+                self.batches += 1
+                written += len(chunk)
+            self.flushed += written
+            return written
+
+    def _spool(self):
+        pending, _ = self._take()
+        if not pending or not self.spool_path:
+            return len(pending)
+        # Every process spools to a file of its own, published by an atomic
+        # rename so a worker replaying at startup never reads it half written
+        path = f"{self.spool_path}.{os.getpid()}-{time.time_ns()}"
+        with open(path + ".tmp", "w") as f:
+            for (collection, doc_id), data in pending.items():
+                f.write(json.dumps({"collection": collection, "doc_id": doc_id, "data": data}) + "\n")
+        os.replace(path + ".tmp", path)
+        logger.warning("Spooled %d unflushed updates to %s", len(pending), path)
+        return 0
+
+    def _spool_files(self):
+        """Spool files waiting for replay, plus claims left by processes that died mid-replay."""
+        directory = os.path.dirname(self.spool_path) or "."
+        base = os.path.basename(self.spool_path)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        paths = []
+        for name in sorted(names):
+            # The bare spool path is what older versions wrote
+            if name != base and not name.startswith(base + "."):
+                continue
+            suffix = name[len(base) + 1:]
+            if suffix.endswith(".tmp") or suffix == "rejected":
+                continue
+            if suffix.startswith("claimed-") and _pid_alive(int(suffix.split("-")[1])):
+                continue
+            paths.append(os.path.join(directory, name))
+        return paths
+
+    def replay_spool(self):
+        """
+        Re-queue updates spooled by a previous shutdown. Returns how many were loaded.
+
+        Each file is claimed by renaming it first, so when several workers
+        start together every spooled update is replayed by exactly one.
+        Lines that can't be parsed, such as one cut short by a crash, are
+        logged and moved to <spool_path>.rejected.
+        """
+        if not self.spool_path:
+            return 0
+        loaded = 0
+        for number, path in enumerate(self._spool_files()):
+            claimed = f"{self.spool_path}.claimed-{os.getpid()}-{number}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # Another worker claimed it first
+                continue
+            rejected = []
+            with open(claimed, "rb") as f:
+                for line_number, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line.decode("utf-8"))
+                        collection, doc_id, data = entry["collection"], entry["doc_id"], entry["data"]
+                    except (ValueError, KeyError, TypeError) as e:
+                        logger.warning("Skipping unreadable line %d of spool %s: %s", line_number, path, e)
+                        rejected.append(line if line.endswith(b"\n") else line + b"\n")
+                        continue
+                    self.update(collection, doc_id, data)
+                    loaded += 1
+            if rejected:
+                with open(f"{self.spool_path}.rejected", "ab") as f:
+                    f.writelines(rejected)
+            os.remove(claimed)
+        return loaded
+
+    def stop(self):
+        """
+        Stop the flusher, write what is pending and spool anything that still fails.
+
+        Returns:
+            Number of updates that could neither be written nor spooled
+        """
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+        self.flush()
+        return self._spool()
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            oldest = min(self._first_queued.values(), default=now)
+            return {
+                "pending": len(self._pending),
+                "oldest_pending_age": now - oldest,
+                "last_flush_lag": self.last_lag,
+                "updates": self.updates,
+                "coalesced": self.coalesced,
+                "flushed": self.flushed,
+                "batches": self.batches,
+                "failures": self.failures,
+            }
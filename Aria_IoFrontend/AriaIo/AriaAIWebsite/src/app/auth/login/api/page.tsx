@@ -298,11 +298,21 @@ export default function Page() {
 
   const handleDomainSubmit = async (e: React.FormEvent) => {
     e.preventDefault();
+
+    if (apiKeys.length === 0) {
+      toast.error('Please create an API key first');
+      setShowCreateForm(true);
+      return;
+    }
     
     try {
       const response = await axios.post('https://mimirai-rag.onrender.com/add_domain', {
         email: userEmail,
         domain: domain
+      }, {
+        headers: {
+          'Authorization': `Bearer ${apiKeys[0].apiKey.trim()}`
+        }
       });
 
       toast.success(response.data.message || 'Domain added successfully!');